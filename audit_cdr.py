@@ -0,0 +1,119 @@
+# -*- mode: Python; tab-width: 4; indent-tabs-mode: nil; -*-
+# ex: set tabstop=4 :
+# Please do not change the lines above. See PEP 8, PEP 263.
+"""
+ Audit call detail records against a snapshot of the rules
+
+ The rules are read from redis, from the legacy data or from a snapshot
+ file written by --save-snapshot, which can be edited to audit a proposed
+ rule set. The numbers are streamed from a CSV or parquet file and
+ evaluated a chunk at a time, see phone_rule_engine.audit.
+"""
+import argparse
+import csv
+import time
+
+import redis
+
+from phone_rule_engine import RuleOperations
+from phone_rule_engine import audit
+from phone_rule_engine.trie import R_RESTRICT
+import phone_legacy_data
+
+DECISION_NAMES = {
+    audit.ALLOW: "allow", audit.RESTRICT: "restrict", audit.NO_RULE: ""
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Evaluate the numbers of a CSV or parquet file offline'
+    )
+    parser.add_argument("input", help="CSV file with a header or parquet")
+    parser.add_argument("--column", default="number",
+                        help="column holding the phone numbers")
+    parser.add_argument("--trial-column",
+                        help="column holding the trial flag of each call")
+    parser.add_argument("--org-column",
+                        help="column holding the organization of each call")
+    parser.add_argument("--chunk-size", type=int, default=audit.CHUNK_SIZE,
+                        help="rows evaluated at a time")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--snapshot",
+                        help="read the rules from a snapshot file")
+    source.add_argument("--legacy", action="store_true",
+                        help="use the hardcoded legacy rules")
+    parser.add_argument("--host", default="localhost",
+                        help="redis host to read the rules from")
+    parser.add_argument("--port", default="6379",
+                        help="redis port to read the rules from")
+    parser.add_argument("--save-snapshot",
+                        help="write the rules used to a snapshot file")
+    parser.add_argument("--output",
+                        help="write the decision of each number to a CSV")
+    return parser.parse_args()
+
+
+def load_rules(args):
+    if args.snapshot:
+        return audit.RuleSnapshot.load(args.snapshot)
+    if args.legacy:
+        # the same rules import_legacy.py loads
+        return audit.RuleSnapshot(
+            {
+                prefix: R_RESTRICT
+                for prefix in
+                phone_legacy_data.RESTRICTED_OUTBOUND_PAYING_PREFIXES
+            },
+            {
+                prefix: R_RESTRICT
+                for prefix in
+                phone_legacy_data.RESTRICTED_OUTBOUND_TRIAL_PREFIXES
+            },
+            {}
+        )
+    return audit.RuleSnapshot.from_redis(RuleOperations(
+        redis.StrictRedis(host=args.host, port=args.port)
+    ))
+
+
+def main():
+    args = parse_args()
+    snapshot = load_rules(args)
+    if args.save_snapshot:
+        snapshot.save(args.save_snapshot)
+    read = audit.read_csv
+    if args.input.endswith(".parquet"):
+        read = audit.read_parquet
+    chunks = read(
+        args.input, args.column, args.trial_column, args.org_column,
+        args.chunk_size
+    )
+    output = writer = None
+    if args.output:
+        output = open(args.output, "w", newline="")
+        writer = csv.writer(output)
+        writer.writerow((args.column, "decision"))
+    totals = {"allowed": 0, "restricted": 0, "no_rule": 0}
+    started = time.perf_counter()
+    try:
+        for numbers, is_trial, org_ids in chunks:
+            decisions = snapshot.evaluate(numbers, is_trial, org_ids)
+            for name, count in audit.count_decisions(decisions).items():
+                totals[name] += count
+            if writer is not None:
+                writer.writerows(
+                    (number, DECISION_NAMES[decision])
+                    for number, decision in zip(numbers, decisions.tolist())
+                )
+    finally:
+        if output is not None:
+            output.close()
+    print("{} numbers in {:.1f}s".format(
+        sum(totals.values()), time.perf_counter() - started
+    ))
+    print("{allowed} allowed, {restricted} restricted, {no_rule} no rule"
+          .format(**totals))
+
+if __name__ == "__main__":
+    main()
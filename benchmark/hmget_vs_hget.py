@@ -0,0 +1,146 @@
+# -*- mode: Python; tab-width: 4; indent-tabs-mode: nil; -*-
+# ex: set tabstop=4 :
+# Please do not change the lines above. See PEP 8, PEP 263.
+"""
+ Compare the HMGET per tier lookup of phone.redis.lua with the previous
+ implementation that issued one HGET per prefix length.
+
+ Loads the legacy data under a random key prefix, runs the same queries trough
+ both scripts and reports the latency and the number of redis commands each
+ decision took. Run with the repository root on the PYTHONPATH:
+
+    python benchmark/hmget_vs_hget.py --port 6379
+"""
+import argparse
+import random
+import time
+from uuid import uuid4
+
+import redis
+
+from phone_rule_engine import RuleOperations
+import phone_legacy_data
+
+# the lookup as it was before, one HGET per prefix and tier, without logging;
+# KEYS[3] is the hash of the organization, which stores the codes a and r
+HGET_SCRIPT = """
+local codes = {a='allow', r='restrict'}
+local get_rule = function(key, field)
+    local rule = redis.call('HGET', key, field)
+    if rule == 'allow' or rule == 'restrict' then return rule end
+    return nil
+end
+local get_org_rule = function(key, field)
+    local code = redis.call('HGET', key, field)
+    if code then return codes[code] end
+    return nil
+end
+local with_prefixes = function(phone_no, fn)
+    for i=string.len(phone_no), 1, -1 do
+        local ret = fn(string.sub(phone_no, 1, i))
+        if ret ~= nil then return ret end
+    end
+end
+local phone_no = ARGV[1]
+local isTrial = (string.upper(ARGV[2]) == 'TRUE')
+local org_id = ARGV[3]
+if org_id ~= '' then
+    local ret = with_prefixes(phone_no, function(prefix)
+        return get_org_rule(KEYS[3], prefix)
+    end)
+    if ret ~= nil then return ret end
+end
+if isTrial then
+    local ret = with_prefixes(phone_no, function(prefix)
+        return get_rule(KEYS[2], prefix)
+    end)
+    if ret ~= nil then return ret end
+end
+return with_prefixes(phone_no, function(prefix)
+    return get_rule(KEYS[1], prefix)
+end)
+"""
+
+ORG_ID = "954e022d-1508-4c51-84f5-85fc4d0dc1f2"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Compare HMGET and HGET based rule lookups'
+    )
+    parser.add_argument("--host", default="localhost",
+                        help="redis host to connect to")
+    parser.add_argument("--port", default="6379",
+                        help="redis port to connect to")
+    parser.add_argument("--queries", default=10000, type=int,
+                        help="number of queries to run trough each script")
+    return parser.parse_args()
+
+
+def load_rules(rule_ops):
+    for prefix in phone_legacy_data.RESTRICTED_OUTBOUND_PAYING_PREFIXES:
+        rule_ops.push_generic_rule(prefix, rule_ops.R_RESTRICT)
+    for prefix in phone_legacy_data.RESTRICTED_OUTBOUND_TRIAL_PREFIXES:
+        rule_ops.push_trial_rule(prefix, rule_ops.R_RESTRICT)
+    rule_ops.push_org_rule("1242", rule_ops.R_ALLOW, ORG_ID)
+
+
+def sample_queries(count):
+    """ Mostly numbers without a rule, as in production """
+    rnd = random.Random(42)
+    prefixes = sorted(phone_legacy_data.RESTRICTED_OUTBOUND_PAYING_PREFIXES)
+    queries = []
+    for _ in range(count):
+        if rnd.random() < 0.2:
+            number = rnd.choice(prefixes)
+        else:
+            number = str(rnd.randint(1, 9))
+        number += "".join(
+            rnd.choice("0123456789") for _ in range(12 - len(number))
+        )
+        queries.append((
+            number,
+            rnd.random() < 0.3,
+            ORG_ID if rnd.random() < 0.1 else ""
+        ))
+    return queries
+
+
+def commands_called(client):
+    return sum(
+        stats["calls"] for name, stats in client.info("commandstats").items()
+        if name in ("cmdstat_hget", "cmdstat_hmget")
+    )
+
+
+def run(name, client, queries, query):
+    before = commands_called(client)
+    start = time.perf_counter()
+    for phone_no, is_trial, org_id in queries:
+        query(phone_no, is_trial, org_id)
+    elapsed = time.perf_counter() - start
+    commands = commands_called(client) - before
+    print("{:>6}: {:8.1f} us/decision {:6.2f} hash commands/decision".format(
+        name, elapsed / len(queries) * 1e6, commands / len(queries)
+    ))
+
+
+def main():
+    args = parse_args()
+    client = redis.StrictRedis(host=args.host, port=args.port)
+    rule_ops = RuleOperations(client, "bench-" + str(uuid4()), warmup=True)
+    hget_script = client.register_script(HGET_SCRIPT)
+    keys = list(rule_ops._keys[:2])
+    try:
+        load_rules(rule_ops)
+        queries = sample_queries(args.queries)
+        run("HGET", client, queries, lambda *args: hget_script(
+            keys=keys + [rule_ops._org_key(args[2])], args=args
+        ))
+        run("HMGET", client, queries, rule_ops.query_rule)
+    finally:
+        client.delete(*client.keys(rule_ops.key_prefix + "*"))
+
+
+if __name__ == "__main__":
+    main()
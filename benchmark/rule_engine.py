@@ -0,0 +1,345 @@
+# -*- mode: Python; tab-width: 4; indent-tabs-mode: nil; -*-
+# ex: set tabstop=4 :
+# Please do not change the lines above. See PEP 8, PEP 263.
+"""
+ Measure the latency and throughput of the rule lookups
+
+ Runs the same queries against each backend:
+
+    redis   RuleOperations.query_rule against a running redis
+    trie    the in process RuleTrie, what RuleCache serves from
+    legacy  dict lookups walking the prefixes, as the hardcoded
+            implementation over phone_legacy_data did
+
+ The rule sets are either the legacy data or synthetic ones with the given
+ number of prefixes, and the queries sweep the ratio of trial users, of
+ users of organizations with specific rules and of numbers that have a rule.
+ Reports p50 and p99 latency and ops/sec for every combination. Run with the
+ repository root on the PYTHONPATH:
+
+    python benchmark/rule_engine.py --sizes legacy,600,60000
+    python benchmark/rule_engine.py --backends trie,legacy --sizes 6000000
+    python benchmark/rule_engine.py --backends redis --replica-ports 6380
+
+ The results can be stored with --save-baseline and compared to in later
+ runs with --baseline, the exit status is 1 if any latency regressed by more
+ than --tolerance.
+"""
+import argparse
+import json
+import random
+import sys
+import time
+from uuid import uuid4
+
+import redis
+
+from phone_rule_engine import RuleOperations
+from phone_rule_engine.replicas import ReplicaSet
+from phone_rule_engine.trie import RuleTrie, R_ALLOW, R_RESTRICT
+import phone_legacy_data
+
+BACKENDS = ("redis", "trie", "legacy")
+ORG_COUNT = 10
+NUMBER_LENGTH = 12
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the rule lookups'
+    )
+    parser.add_argument("--host", default="localhost",
+                        help="redis host to connect to")
+    parser.add_argument("--port", default="6379",
+                        help="redis port to connect to")
+    parser.add_argument("--replica-ports", default="", type=_names,
+                        help="ports of the replicas to query on the host")
+    parser.add_argument("--backends", default=",".join(BACKENDS),
+                        type=_names, help="backends to benchmark")
+    parser.add_argument("--sizes", default="legacy,600,60000", type=_names,
+                        help="legacy or the number of synthetic prefixes")
+    parser.add_argument("--trial-ratios", default="0,0.3", type=_ratios,
+                        help="ratios of trial users to sweep")
+    parser.add_argument("--org-ratios", default="0,0.1", type=_ratios,
+                        help="ratios of organization users to sweep")
+    parser.add_argument("--hit-ratios", default="0.2,0.8", type=_ratios,
+                        help="ratios of numbers with a rule to sweep")
+    parser.add_argument("--queries", default=5000, type=int,
+                        help="number of queries per combination")
+    parser.add_argument("--baseline",
+                        help="fail if slower than the results in this file")
+    parser.add_argument("--tolerance", default=0.25, type=float,
+                        help="allowed slowdown against the baseline")
+    parser.add_argument("--save-baseline",
+                        help="store the results in this file")
+    return parser.parse_args()
+
+
+def _names(value):
+    return [name for name in value.split(",") if name]
+
+
+def _ratios(value):
+    return [float(ratio) for ratio in _names(value)]
+
+
+class RuleSet(object):
+    """ The rules of each tier as {prefix: rule} dicts, organization rules
+        as {org_id: {prefix: rule}}
+    """
+
+    def __init__(self, generic, trial, org):
+        self.generic = generic
+        self.trial = trial
+        self.org = org
+
+    @classmethod
+    def legacy(cls):
+        """ The hardcoded rules, with a single organization exception """
+        return cls(
+            dict.fromkeys(
+                phone_legacy_data.RESTRICTED_OUTBOUND_PAYING_PREFIXES,
+                R_RESTRICT
+            ),
+            dict.fromkeys(
+                phone_legacy_data.RESTRICTED_OUTBOUND_TRIAL_PREFIXES,
+                R_RESTRICT
+            ),
+            {"org-0": {"1242": R_ALLOW}}
+        )
+
+    @classmethod
+    def synthetic(cls, size, rnd):
+        """ size prefixes, half generic, 40% trial and 10% spread over the
+            organizations
+
+            No prefix starts with 9, so numbers without a rule are easy to
+            come by.
+        """
+        prefixes = set()
+        while len(prefixes) < size:
+            prefixes.add(str(rnd.randint(1, 8)) + "".join(
+                rnd.choice("0123456789") for _ in range(rnd.randint(2, 9))
+            ))
+        prefixes = sorted(prefixes)
+        rnd.shuffle(prefixes)
+        rules = [rnd.choice((R_ALLOW, R_RESTRICT)) for _ in prefixes]
+        generic_end = size // 2
+        trial_end = generic_end + size * 4 // 10
+        org = {}
+        for i in range(trial_end, size):
+            org_id = "org-{}".format(i % ORG_COUNT)
+            org.setdefault(org_id, {})[prefixes[i]] = rules[i]
+        return cls(
+            dict(zip(prefixes[:generic_end], rules[:generic_end])),
+            dict(zip(prefixes[generic_end:trial_end],
+                     rules[generic_end:trial_end])),
+            org
+        )
+
+    def queries(self, count, trial_ratio, org_ratio, hit_ratio, rnd):
+        """ (phone_no, is_trial, org_id) tuples in the given mix """
+        generic = sorted(self.generic)
+        trial = sorted(self.trial)
+        orgs = sorted(self.org)
+        org_prefixes = {org_id: sorted(self.org[org_id]) for org_id in orgs}
+        queries = []
+        for _ in range(count):
+            is_trial = rnd.random() < trial_ratio
+            org_id = ""
+            if orgs and rnd.random() < org_ratio:
+                org_id = rnd.choice(orgs)
+            if rnd.random() < hit_ratio:
+                candidates = generic
+                if org_id and org_prefixes[org_id]:
+                    candidates = org_prefixes[org_id]
+                elif is_trial and trial:
+                    candidates = trial
+                number = self._pad(rnd.choice(candidates), rnd)
+            else:
+                number = self._miss(rnd)
+            queries.append((number, is_trial, org_id))
+        return queries
+
+    def _miss(self, rnd):
+        """ A number that no rule applies to """
+        while True:
+            number = self._pad("9", rnd)
+            if not any(
+                    number[:i] in rules
+                    for rules in [self.generic, self.trial] +
+                    list(self.org.values())
+                    for i in range(1, len(number) + 1)):
+                return number
+
+    @staticmethod
+    def _pad(prefix, rnd):
+        return prefix + "".join(
+            rnd.choice("0123456789")
+            for _ in range(NUMBER_LENGTH - len(prefix))
+        )
+
+
+def legacy_lookup(rule_set):
+    """ The dict lookup of the hardcoded implementation: walk the prefixes
+        from the longest for each tier
+    """
+    def longest(rules, phone_no):
+        for i in range(len(phone_no), 0, -1):
+            rule = rules.get(phone_no[:i])
+            if rule is not None:
+                return rule
+        return None
+
+    def query(phone_no, is_trial, org_id):
+        rule = None
+        if org_id in rule_set.org:
+            rule = longest(rule_set.org[org_id], phone_no)
+        if rule is None and is_trial:
+            rule = longest(rule_set.trial, phone_no)
+        if rule is None:
+            rule = longest(rule_set.generic, phone_no)
+        if rule is None:
+            return None
+        return rule == R_ALLOW
+    return query
+
+
+class RedisBackend(object):
+    """ Loads the rules under a random key prefix, removed on close """
+
+    def __init__(self, client, rule_set, replicas=None):
+        self.client = client
+        self.rule_ops = RuleOperations(
+            client, "bench-" + str(uuid4()), warmup=True, replicas=replicas
+        )
+        self.rule_ops.replace_rules(
+            rule_set.generic, rule_set.trial, rule_set.org
+        )
+        if replicas:
+            # let the replicas catch up before querying them
+            client.execute_command("WAIT", len(replicas), 10000)
+        self.query = self.rule_ops.query_rule
+
+    def close(self):
+        keys = list(self.client.scan_iter(self.rule_ops.key_prefix + "*"))
+        if keys:
+            self.client.delete(*keys)
+
+
+class LocalBackend(object):
+    """ A backend that answers in process """
+
+    def __init__(self, query):
+        self.query = query
+
+    def close(self):
+        pass
+
+
+def open_backend(name, rule_set, args):
+    if name == "redis":
+        replicas = None
+        if args.replica_ports:
+            replicas = ReplicaSet([
+                redis.StrictRedis(host=args.host, port=port)
+                for port in args.replica_ports
+            ])
+        return RedisBackend(
+            redis.StrictRedis(host=args.host, port=args.port), rule_set,
+            replicas
+        )
+    if name == "trie":
+        return LocalBackend(RuleTrie.from_hashes(
+            rule_set.generic, rule_set.trial, rule_set.org
+        ).query_rule)
+    if name == "legacy":
+        return LocalBackend(legacy_lookup(rule_set))
+    raise ValueError("Unknown backend: {}".format(name))
+
+
+def measure(query, queries):
+    """ Returns the p50 and p99 latency in microseconds and the ops/sec """
+    latencies = []
+    clock = time.perf_counter
+    start = clock()
+    for phone_no, is_trial, org_id in queries:
+        before = clock()
+        query(phone_no, is_trial, org_id)
+        latencies.append(clock() - before)
+    elapsed = clock() - start
+    latencies.sort()
+    return {
+        "p50": latencies[len(latencies) // 2] * 1e6,
+        "p99": latencies[int(len(latencies) * 0.99)] * 1e6,
+        "ops": len(latencies) / elapsed,
+    }
+
+
+def regressions(results, baseline, tolerance):
+    """ The scenarios with a latency worse than the baseline allows """
+    slower = []
+    for scenario, result in sorted(results.items()):
+        expected = baseline.get(scenario)
+        if expected is None:
+            continue
+        for metric in ("p50", "p99"):
+            if result[metric] > expected[metric] * (1 + tolerance):
+                slower.append("{} {} {:.1f} us, baseline {:.1f} us".format(
+                    scenario, metric, result[metric], expected[metric]
+                ))
+    return slower
+
+
+def main():
+    args = parse_args()
+    rnd = random.Random(42)
+    results = {}
+    print("{:<40} {:>10} {:>10} {:>12}".format(
+        "scenario", "p50 us", "p99 us", "ops/sec"
+    ))
+    for size in args.sizes:
+        if size == "legacy":
+            rule_set = RuleSet.legacy()
+        else:
+            rule_set = RuleSet.synthetic(int(size), rnd)
+        mixes = [
+            (trial, org, hit) for trial in args.trial_ratios
+            for org in args.org_ratios for hit in args.hit_ratios
+        ]
+        queries = {
+            mix: rule_set.queries(args.queries, *mix, rnd=rnd)
+            for mix in mixes
+        }
+        for name in args.backends:
+            backend = open_backend(name, rule_set, args)
+            try:
+                for mix in mixes:
+                    scenario = "{}/{}/trial={}/org={}/hit={}".format(
+                        name, size, *mix
+                    )
+                    result = results[scenario] = measure(
+                        backend.query, queries[mix]
+                    )
+                    print("{:<40} {:>10.1f} {:>10.1f} {:>12.0f}".format(
+                        scenario, result["p50"], result["p99"],
+                        result["ops"]
+                    ))
+            finally:
+                backend.close()
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as baseline:
+            json.dump(results, baseline, indent=4, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            slower = regressions(results, json.load(baseline), args.tolerance)
+        if slower:
+            print("Latency regressed against the baseline:")
+            for line in slower:
+                print("  " + line)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+# -*- mode: Python; tab-width: 4; indent-tabs-mode: nil; -*-
+# ex: set tabstop=4 :
+# Please do not change the lines above. See PEP 8, PEP 263.
+"""
+ Measure how phone_rule_engine.screen scales with the worker processes
+
+ Writes a list of random numbers to a temporary file and screens it against
+ the legacy data for a trial user, in the calling process and with each of
+ the given numbers of workers. Reports the time per million numbers and the
+ speedup over screening in process, which can't exceed the CPU count. No
+ redis needed, run with the repository root on the PYTHONPATH:
+
+    python benchmark/screen_workers.py --numbers 4000000 --workers 2,4,8
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from phone_rule_engine import screen
+from phone_rule_engine.trie import R_RESTRICT
+import phone_legacy_data
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Compare screening in process and with worker pools'
+    )
+    parser.add_argument("--numbers", default=2000000, type=int,
+                        help="length of the list to screen")
+    parser.add_argument("--workers", default="2,4",
+                        help="comma separated numbers of workers to try")
+    return parser.parse_args()
+
+
+def legacy_rules():
+    return (
+        {prefix: R_RESTRICT for prefix
+         in phone_legacy_data.RESTRICTED_OUTBOUND_PAYING_PREFIXES},
+        {prefix: R_RESTRICT for prefix
+         in phone_legacy_data.RESTRICTED_OUTBOUND_TRIAL_PREFIXES},
+        {},
+    )
+
+
+def write_numbers(path, count):
+    rnd = random.Random(22)
+    with open(path, "w") as numbers:
+        for _ in range(count // 10000):
+            numbers.write("".join(
+                "{}\n".format(rnd.randint(10 ** 10, 10 ** 11 - 1))
+                for _ in range(10000)
+            ))
+
+
+def run(path, directory, rules, workers):
+    started = time.perf_counter()
+    allowed, restricted = screen.screen_file(
+        path, os.path.join(directory, "allowed"),
+        os.path.join(directory, "restricted"), rules, True, None, workers
+    )
+    return time.perf_counter() - started, allowed + restricted
+
+
+def main():
+    args = parse_args()
+    rules = legacy_rules()
+    print("{} CPUs".format(os.cpu_count()))
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "numbers")
+        write_numbers(path, args.numbers)
+        baseline, count = run(path, directory, rules, 1)
+        print("in process: {:6.2f}s per million numbers".format(
+            baseline / count * 1e6
+        ))
+        for workers in [int(each) for each in args.workers.split(",")]:
+            elapsed, _ = run(path, directory, rules, workers)
+            print("{:2} workers: {:6.2f}s per million numbers, {:.2f}x".format(
+                workers, elapsed / count * 1e6, baseline / elapsed
+            ))
+
+
+if __name__ == "__main__":
+    main()
@@ -27,43 +27,48 @@ def parse_args():
                         help="redis host to connect to")
     parser.add_argument("--port", default="6379",
                         help="redis port to connect to")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="only show what would change")
+    parser.add_argument("--blobs", action="store_true",
+                        help="build the blobs of the tiers as well")
     return parser.parse_args()
 
 
-def check_for_existing(rule_ops, samples):
-    return any((
-        rule_ops.query_rule(prefix) is not None for prefix in samples
-    ))
+def print_diff(diff):
+    for tier, changes in sorted(diff.items()):
+        print("{} rules: {} added, {} removed, {} changed".format(
+            tier,
+            len(changes["added"]),
+            len(changes["removed"]),
+            len(changes["changed"])
+        ))
 
 
 def main():
     args = parse_args()
     rule_ops = RuleOperations(
-        redis.StrictRedis(host=args.host, port=args.port)
+        redis.StrictRedis(host=args.host, port=args.port),
+        blobs=args.blobs
     )
-    generic_restrictions = sorted(phone_legacy_data.RESTRICTED_OUTBOUND_PAYING_PREFIXES.keys())
-
-    if check_for_existing(rule_ops, (generic_restrictions[0], generic_restrictions[10])):
-        print("Rules were already laoded. Refusign to do any changes")
-        return
-
-    for prefix in generic_restrictions:
-        rule_ops.push_generic_rule(prefix, rule_ops.R_RESTRICT)
-        # add the rule as a prefix rule as well to speed up queries for trial
-        # users.
-        # this will avoid some redis lookups at the expense fo using up more
-        # memory
-        rule_ops.push_trial_rule(prefix, rule_ops.R_RESTRICT)
-    print("Imported {} general rules".format(
-        len(generic_restrictions)
-    ))
-
-    trial_restrictions=phone_legacy_data.RESTRICTED_OUTBOUND_TRIAL_PREFIXES.keys()
-    for prefix in trial_restrictions:
-        rule_ops.push_trial_rule(prefix, rule_ops.R_RESTRICT)
-    print("Imported {} trial rules".format(
-        len(trial_restrictions)
-    ))
+    # trial users are served from the effective trial rules, which have the
+    # generic rules overlaid, no need to load these as trial rules as well
+    generic = {
+        prefix: rule_ops.R_RESTRICT
+        for prefix in phone_legacy_data.RESTRICTED_OUTBOUND_PAYING_PREFIXES
+    }
+    trial = {
+        prefix: rule_ops.R_RESTRICT
+        for prefix in phone_legacy_data.RESTRICTED_OUTBOUND_TRIAL_PREFIXES
+    }
+    # the whole rule set is swapped in at once, so loading it again is safe
+    diff = rule_ops.replace_rules(generic, trial, dry_run=args.dry_run)
+    print_diff(diff)
+    if args.dry_run:
+        print("Dry run, nothing was changed")
+    else:
+        print("Imported {} general and {} trial rules".format(
+            len(generic), len(trial)
+        ))
 
 if __name__ == "__main__":
     main()
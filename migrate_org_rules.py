@@ -0,0 +1,53 @@
+# -*- mode: Python; tab-width: 4; indent-tabs-mode: nil; -*-
+# ex: set tabstop=4 :
+# Please do not change the lines above. See PEP 8, PEP 263.
+"""
+ Move the organization rules from the rules:org hash shared by all the
+ organizations to the compact hash of each organization, and build the
+ prefix indexes and the effective trial rules of the generic and trial rules
+
+ Run once when upgrading, the rule scripts only read the new layout. Until
+ then trial users are decided from the trial and generic rules separately,
+ as before. Safe to run again, rules pushed since are kept.
+"""
+import redis
+import argparse
+from phone_rule_engine import RuleOperations
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Migrate the organization rules to per organization hashes'
+    )
+    parser.add_argument("--host", default="localhost",
+                        help="redis host to connect to")
+    parser.add_argument("--port", default="6379",
+                        help="redis port to connect to")
+    parser.add_argument("--key-prefix", default="",
+                        help="key prefix the rules are stored under")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="only show what would be migrated")
+    parser.add_argument("--blobs", action="store_true",
+                        help="build the blobs of the tiers as well")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    rule_ops = RuleOperations(
+        redis.StrictRedis(host=args.host, port=args.port), args.key_prefix,
+        blobs=args.blobs
+    )
+    org = rule_ops.migrate_org_rules(dry_run=args.dry_run)
+    for org_id, rules in sorted(org.items()):
+        print("{}: {} rules".format(org_id, len(rules)))
+    if args.dry_run:
+        print("Dry run, nothing was changed")
+    else:
+        print("Migrated the rules of {} organizations".format(len(org)))
+        rule_ops.rebuild_prefix_lengths()
+        rule_ops.rebuild_effective_trial()
+        print("Rebuilt the prefix indexes and the effective trial rules")
+
+if __name__ == "__main__":
+    main()
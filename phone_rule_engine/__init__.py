@@ -3,50 +3,826 @@
 # Please do not change the lines above. See PEP 8, PEP 263.
 """ Operations to deal with phone prefix rules """
 
+from contextlib import contextmanager
 from functools import lru_cache
+import hashlib
+import itertools
+import json
 import os
+import time
+
+from phone_rule_engine import blob
+from phone_rule_engine.bulk import effective_trial_rules, rules_diff
+from phone_rule_engine.bulk import legacy_org_rules, org_fields
+from phone_rule_engine.explain import RuleMatch, explanation, decode_matches
+from phone_rule_engine.metrics import DecisionTrace
+from phone_rule_engine.trie import RuleTrie, decode, decode_hash, decode_rule
+from phone_rule_engine.trie import RULE_CODES, R_ALLOW, R_RESTRICT
+from phone_rule_engine.trie import TIER_GENERIC, TIER_TRIAL, TIER_ORG
+from phone_rule_engine.trie import TIER_ALL
 
 LUA_SCRIPT_NAME = "phone.redis.lua"
+LUA_MANY_SCRIPT_NAME = "phone.many.redis.lua"
+LUA_LIB_NAME = "phone.lib.redis.lua"
+LUA_EFFECTIVE_SCRIPT_NAME = "phone.effective.redis.lua"
+LUA_EXPLAIN_SCRIPT_NAME = "phone.explain.redis.lua"
+LUA_DELETE_SCRIPT_NAME = "phone.delete.redis.lua"
+LUA_DELETE_ORG_SCRIPT_NAME = "phone.delete.org.redis.lua"
+LUA_COMPILE_SCRIPT_NAME = "phone.compile.redis.lua"
+LUA_BLOB_SCRIPT_NAME = "phone.blob.redis.lua"
+# numbers evaluated by a single script call in query_rules_many, keeps any one
+# call short so redis can serve other clients in between
+BATCH_CHUNK_SIZE = 250
+# fields written by a single HMSET when replacing all the rules
+BULK_CHUNK_SIZE = 1000
+# in cluster mode all the keys but the organization hashes share this hash
+# tag, so the scripts only ever touch keys of a single slot
+CLUSTER_HASH_TAG = "{rules}"
+TIER_KEYS = {
+    TIER_GENERIC: "rules",
+    TIER_TRIAL: "rules:trial",
+    TIER_ORG: "rules:org",
+}
 
 class RuleOperations(object):
-    """ Operations to deal with phone prefix rules """
+    """ Operations to deal with phone prefix rules
+
+        With cluster set, redis is expected to be a redis.cluster.RedisCluster
+        client. The organization hashes are then spread over the cluster by
+        their hash tag, all the other keys share a slot. Organization rules
+        are looked up with a plain HMGET on their own node, the scripts only
+        decide on the generic and trial rules. Writes are not atomic across
+        slots, and organization decisions are not counted in the stats.
+
+        With replicas, a phone_rule_engine.replicas.ReplicaSet of the
+        replicas of redis, the queries are answered by the replicas and
+        redis only takes the writes. The queries sampled for the stats write
+        the counters, those still go to redis, as do the snapshots the
+        caches load.
+
+        With metrics, a phone_rule_engine.metrics.RuleMetrics, the latency
+        of query_rule is recorded and some of the queries are traced.
+
+        With blobs, query_rule decides with a single GET of the string each
+        tier and organization is serialized into, see phone_rule_engine.blob.
+        Traces, explanations and batches still read the hashes. Once a
+        client with blobs wrote or compile_blobs() ran, every write
+        serializes the tiers it changed again in the same transaction,
+        whether blobs is set on the writing client or not. Rules written by
+        other means need compile_blobs().
+    """
 
-    def __init__(self, redis, key_prefix=""):
+    def __init__(self, redis, key_prefix="", warmup=False, debug=False,
+                 stats_every=0, cluster=False, replicas=None, metrics=None,
+                 blobs=False):
+        if cluster and replicas:
+            raise ValueError(
+                "Use read_from_replicas of the cluster client instead"
+            )
         self.redis = redis
+        self.replicas = replicas
+        self.metrics = metrics
         self.key_prefix = key_prefix
         if self.key_prefix:
             self.key_prefix += ":"
+        self.cluster = cluster
+        self.blobs = blobs
+        # the prefix of all the keys but the organization hashes
+        self._shared_prefix = self.key_prefix
+        if cluster:
+            self._shared_prefix += CLUSTER_HASH_TAG + ":"
         self.R_RESTRICT = "restrict"
         self.R_ALLOW = "allow"
+        self.version_key = self._shared_prefix + "rules:version"
+        self.changes_channel = self.key_prefix + "rules:changes"
+        self.stats_key = self._shared_prefix + "rules:stats"
+        # the ids of the organizations with specific rules, each has its own
+        # hash, see _org_key
+        self.orgs_key = self._shared_prefix + "rules:orgs"
+        # trial rules overlaid on the generic rules, see
+        # phone.effective.redis.lua
+        self.effective_trial_key = \
+            self._shared_prefix + "rules:trial:effective"
+        # set by compile_blobs and the writes with blobs, the writes of
+        # every client keep the blobs up to date while it exists
+        self.blobs_key = self._shared_prefix + "rules:blobs"
+        # log every step of the decisions in the redis log, for debugging only
+        self.debug = debug
+        # count decisions and warnings in redis for one in every stats_every
+        # queries, 0 disables counting
+        self.stats_every = stats_every
+        self._calls = itertools.count()
+        self._keys = self._rule_keys()
+        self._blob_keys = self._rule_blob_keys()
+        self._script = self._register_script(LUA_SCRIPT_NAME)
+        self._many_script = self._register_script(LUA_MANY_SCRIPT_NAME)
+        self._effective_script = self._register_script(
+            LUA_EFFECTIVE_SCRIPT_NAME, lib=False
+        )
+        # left out of warmup, only support tools explain decisions and rules
+        # are rarely deleted
+        self._explain_script = self._register_script(LUA_EXPLAIN_SCRIPT_NAME)
+        self._delete_script = self._register_script(
+            LUA_DELETE_SCRIPT_NAME, lib=False
+        )
+        self._delete_org_script = self._register_script(
+            LUA_DELETE_ORG_SCRIPT_NAME, lib=False
+        )
+        self._compile_script = self._register_script(
+            LUA_COMPILE_SCRIPT_NAME, lib=False
+        )
+        self._blob_script = self._register_script(LUA_BLOB_SCRIPT_NAME)
+        if warmup or cluster:
+            # cluster pipelines can't fall back to loading a script
+            self.warmup()
+
+    def warmup(self):
+        """ Load the scripts in redis ahead of the first query
+
+            Not required for correctness, a script missing from redis ( e.x.
+            after SCRIPT FLUSH or a failover ) is loaded on first use.
+        """
+        for script in self._warmup_scripts():
+            script.sha = self.redis.script_load(script.script)
+
+    def _warmup_scripts(self):
+        """ The scripts warmup loads, those of the writes and queries """
+        scripts = [self._script, self._many_script, self._effective_script]
+        if self.blobs:
+            scripts.extend((self._compile_script, self._blob_script))
+        return scripts
+
+    @property
+    def script_sha(self):
+        """ The SHA1 the query script is invoked by, for diagnostics """
+        return self._script.sha
+
+    def _register_script(self, name, lib=True):
+        """ Create the long lived handle of a script
+
+            The SHA1 is computed up front so that the first call is an
+            EVALSHA that only falls back to loading the script if redis
+            doesn't know it yet.
+        """
+        source = self._load_script(name, lib)
+        script = self.redis.register_script(source)
+        script.sha = hashlib.sha1(source.encode('utf-8')).hexdigest()
+        return script
 
     def push_generic_rule(self, prefix, rule):
         """ Sets a generic rule for the specific prefix """
-        self._push_rule("rules", prefix, rule)
+        self._push_rule(TIER_GENERIC, prefix, rule)
 
     def push_trial_rule(self, prefix, rule):
         """ Sets a trial specific rule for the specific prefix """
-        self._push_rule("rules:trial", prefix, rule)
+        self._push_rule(TIER_TRIAL, prefix, rule)
 
     def push_org_rule(self, prefix, rule, org_id):
         """ Push an organization sepcific rule  """
+        pipe = self._pipeline()
+        self._queue_org_rule(pipe, prefix, rule, org_id)
+        self._notify(pipe, TIER_ORG, org_id)
+
+    def _queue_org_rule(self, pipe, prefix, rule, org_id):
+        """ Validate and queue the writes of an organization rule on pipe """
         prefix = self._prefix(prefix)
         rule = self._rule(rule)
-        self.redis.hset(self.key_prefix + "rules:org", org_id, "enable")
-        self.redis.hset(
-            self.key_prefix + "rules:org",
-            "{}:{}".format(org_id, prefix),
-            rule
+        pipe.hset(self._org_key(org_id), prefix, RULE_CODES[rule])
+        pipe.sadd(self.orgs_key, org_id)
+
+    def delete_generic_rule(self, prefix):
+        """ Remove the generic rule for prefix
+
+            Returns the rule that was removed, None if there was none.
+        """
+        return self._delete_rule(TIER_GENERIC, prefix)
+
+    def delete_trial_rule(self, prefix):
+        """ Remove the trial specific rule for prefix
+
+            Returns the rule that was removed, None if there was none.
+        """
+        return self._delete_rule(TIER_TRIAL, prefix)
+
+    def delete_org_rule(self, prefix, org_id):
+        """ Remove an organization specific rule
+
+            Returns the rule that was removed, None if there was none. An
+            organization is no longer listed once its last rule is gone.
+        """
+        previous = self._delete_org_rules(org_id, [self._prefix(prefix)])
+        return decode_rule(previous[0])
+
+    def clear_org(self, org_id):
+        """ Remove all the rules of an organization
+
+            Returns the removed rules as {prefix: rule}.
+        """
+        return self._cleared_rules(self._delete_org_rules(org_id, []))
+
+    def _delete_rule(self, tier, prefix):
+        """ Remove the rule for prefix from a tier, with its stems and
+            length if no other rule uses them, and update the effective
+            trial rules
+        """
+        pipe = self._pipeline()
+        calls = self._delete_calls(tier, self._prefix(prefix))
+        if self.cluster:
+            # cluster pipelines can't run scripts
+            previous = [
+                script(keys=keys, args=args) for script, keys, args in calls
+            ][0]
+            self._notify(pipe, tier)
+        else:
+            for script, keys, args in calls:
+                script(keys=keys, args=args, client=pipe)
+            previous = self._notify(pipe, tier)[0]
+        return decode_rule(previous[0])
+
+    def _delete_calls(self, tier, prefix):
+        """ The (script, keys, args) calls deleting the rule for prefix """
+        return (
+            (self._delete_script, (
+                self._key(tier), self._lengths_key(tier),
+                self._stems_key(tier)
+            ), (prefix, )),
+            (self._effective_script, self._effective_keys(), (prefix, )),
+            # only rebuilds the indexes of the effective trial rules
+            (self._delete_script, self._effective_keys()[2:5], ()),
+        )
+
+    def _delete_org_rules(self, org_id, prefixes):
+        """ Remove the rules for prefixes, or all of them, from the hash of
+            an organization, returns the removed rules as the script does
+        """
+        key = self._org_key(org_id)
+        args = [org_id] + prefixes
+        pipe = self._pipeline()
+        if self.cluster:
+            # the set of organizations is on another slot
+            previous, left = self._delete_org_script(keys=(key, ), args=args)
+            if not left:
+                pipe.srem(self.orgs_key, org_id)
+            self._notify(pipe, TIER_ORG, org_id)
+            return previous
+        self._delete_org_script(
+            keys=(key, self.orgs_key), args=args, client=pipe
+        )
+        return self._notify(pipe, TIER_ORG, org_id)[0][0]
+
+    @staticmethod
+    def _cleared_rules(previous):
+        """ The {prefix: rule} of the HGETALL reply of a cleared org """
+        return {
+            decode(prefix): decode_rule(rule)
+            for prefix, rule in zip(previous[::2], previous[1::2])
+        }
+
+    def push_rules_bulk(self, generic=None, trial=None, org=None):
+        """ Set many rules in one round trip
+
+            generic and trial are {prefix: rule} dicts, org is an
+            {org_id: {prefix: rule}} dict. Everything is validated before
+            anything is written, the rules, their indexes and the effective
+            trial rules are then written in one transaction, so readers see
+            all of the changes or none. In cluster mode the writes are only
+            atomic per slot.
+
+            Returns the rules that were replaced, as a dict with the same
+            shape by tier, None for the prefixes that had no rule.
+        """
+        changes = self._bulk_changes(generic, trial, org)
+        if not any(changes.values()):
+            return changes
+        pipe = self._pipeline()
+        prefixes = self._queue_bulk(pipe, changes)
+        tier, org_id = self._bulk_event(changes)
+        if self.cluster:
+            # cluster pipelines can't run scripts
+            results = pipe.execute()
+            if prefixes:
+                self._effective_script(
+                    keys=self._effective_keys(), args=prefixes
+                )
+            self._notify(pipe, tier, org_id, changes[TIER_ORG])
+        else:
+            if prefixes:
+                self._effective_script(
+                    keys=self._effective_keys(), args=prefixes, client=pipe
+                )
+            results = self._notify(pipe, tier, org_id, changes[TIER_ORG])
+        return self._bulk_previous(changes, results)
+
+    @contextmanager
+    def transaction(self):
+        """ Collect rule changes and push them with push_rules_bulk on exit
+
+            Yields a RuleTransaction, which has the push methods of
+            RuleOperations and validates each change as it's made. Nothing
+            is written if the block raises. The replaced rules are left in
+            its previous attribute.
+        """
+        changes = RuleTransaction(self)
+        yield changes
+        changes.previous = self.push_rules_bulk(
+            changes.generic, changes.trial, changes.org
+        )
+
+    def _bulk_changes(self, generic, trial, org):
+        """ The validated changes of push_rules_bulk by tier """
+        return {
+            TIER_GENERIC: self._validated(generic or {}),
+            TIER_TRIAL: self._validated(trial or {}),
+            TIER_ORG: {
+                org_id: self._validated(rules)
+                for org_id, rules in (org or {}).items() if rules
+            },
+        }
+
+    @staticmethod
+    def _bulk_reads(changes):
+        """ The (tier, org_id, prefixes) of the rules read before writing
+            the changes, in the order they are queued
+        """
+        reads = [
+            (tier, None, sorted(changes[tier]))
+            for tier in (TIER_GENERIC, TIER_TRIAL) if changes[tier]
+        ]
+        reads.extend(
+            (TIER_ORG, org_id, sorted(rules))
+            for org_id, rules in sorted(changes[TIER_ORG].items())
+        )
+        return reads
+
+    def _queue_bulk(self, pipe, changes):
+        """ Queue reading the rules the changes replace, then the writes
+
+            Returns the generic and trial prefixes that changed, for the
+            effective trial rules.
+        """
+        for tier, org_id, prefixes in self._bulk_reads(changes):
+            key = self._org_key(org_id) if org_id else self._key(tier)
+            pipe.hmget(key, prefixes)
+        for tier in (TIER_GENERIC, TIER_TRIAL):
+            rules = changes[tier]
+            if not rules:
+                continue
+            _queue_hmset(pipe, self._key(tier), rules)
+            pipe.execute_command(
+                'ZADD', self._lengths_key(tier), *_tier_lengths(rules)
+            )
+            _queue_hmset(pipe, self._stems_key(tier), _stems(rules))
+        for org_id, rules in sorted(changes[TIER_ORG].items()):
+            _queue_hmset(pipe, self._org_key(org_id), {
+                prefix: RULE_CODES[rule] for prefix, rule in rules.items()
+            })
+        if changes[TIER_ORG]:
+            pipe.sadd(self.orgs_key, *sorted(changes[TIER_ORG]))
+        return sorted(set(changes[TIER_GENERIC]) | set(changes[TIER_TRIAL]))
+
+    @staticmethod
+    def _bulk_event(changes):
+        """ The (tier, org_id) of the change event of push_rules_bulk """
+        tiers = [
+            tier for tier in (TIER_GENERIC, TIER_TRIAL) if changes[tier]
+        ]
+        orgs = changes[TIER_ORG]
+        if len(tiers) == 1 and not orgs:
+            return tiers[0], None
+        if not tiers and len(orgs) == 1:
+            return TIER_ORG, next(iter(orgs))
+        return TIER_ALL, None
+
+    def _bulk_previous(self, changes, results):
+        """ The replaced rules from the results of _queue_bulk """
+        previous = {TIER_GENERIC: {}, TIER_TRIAL: {}, TIER_ORG: {}}
+        for (tier, org_id, prefixes), rules in zip(
+                self._bulk_reads(changes), results):
+            rules = dict(zip(prefixes, (
+                decode_rule(rule) if rule is not None else None
+                for rule in rules
+            )))
+            if org_id:
+                previous[TIER_ORG][org_id] = rules
+            else:
+                previous[tier] = rules
+        return previous
+
+    def migrate_org_rules(self, dry_run=False):
+        """ Move the organization rules from the former rules:org hash to
+            the hash of each organization
+
+            Rules already in the hash of the organization are kept. Returns
+            the migrated rules as {org_id: {prefix: rule}}, nothing is
+            written with dry_run.
+        """
+        legacy = decode_hash(self.redis.hgetall(self._key(TIER_ORG)))
+        org = legacy_org_rules(legacy)
+        if dry_run:
+            return org
+        pipe = self._pipeline()
+        for org_id, rules in sorted(org.items()):
+            for prefix, rule in sorted(rules.items()):
+                pipe.hsetnx(self._org_key(org_id), prefix, RULE_CODES[rule])
+            pipe.sadd(self.orgs_key, org_id)
+        pipe.delete(
+            self._key(TIER_ORG),
+            self._key(TIER_ORG) + ":lengths",
+            self._key(TIER_ORG) + ":stems"
+        )
+        self._notify(pipe, TIER_ALL, org_ids=org)
+        return org
+
+    def rebuild_effective_trial(self):
+        """ Recompute the effective trial rules from scratch
+
+            They are kept up to date by the push methods, this is only needed
+            for rules written by other means. Like a push it bumps the
+            version and publishes a change event, of every tier as the
+            generic and trial rules changed as well, and with blobs
+            recompiles those of the generic, trial and effective rules.
+        """
+        pipe = self._pipeline()
+        if self.cluster:
+            # cluster pipelines can't run scripts
+            self._effective_script(keys=self._effective_keys(), args=("", ))
+        else:
+            self._effective_script(
+                keys=self._effective_keys(), args=("", ), client=pipe
+            )
+        self._notify(pipe, TIER_ALL)
+
+    def _effective_keys(self):
+        """ The keys phone.effective.redis.lua expects """
+        return (
+            self._key(TIER_GENERIC),
+            self._key(TIER_TRIAL),
+            self.effective_trial_key,
+            self.effective_trial_key + ":lengths",
+            self.effective_trial_key + ":stems",
+            self._stems_key(TIER_GENERIC),
+            self._stems_key(TIER_TRIAL)
+        )
+
+    def compile_blobs(self):
+        """ Rebuild the blobs of every tier and organization
+
+            Also marks the blobs in use, so that the writes of every client
+            keep them up to date from then on. Only needed once, and for
+            rules written by other means.
+        """
+        self.redis.set(self.blobs_key, 1)
+        pipe = self._pipeline()
+        self._queue_compile(pipe, self._blob_calls(
+            TIER_ALL, org_ids=self.org_ids()
+        ))
+        pipe.execute()
+
+    def load_blobs(self):
+        """ Read the version and the blobs of every tier and organization
+
+            The blobs are read with a single MGET, in a transaction retried
+            if the rules change while the organizations are listed. In
+            cluster mode the blobs are read after the version, as snapshot
+            does. Returns a (version, generic, trial, orgs) tuple like
+            snapshot, with the rules decoded to {prefix: rule} dicts.
+        """
+        if self.cluster:
+            version = self.redis.get(self.version_key)
+            org_ids = self.org_ids()
+            # cluster pipelines don't take MGET
+            pipe = self._pipeline()
+            for key in self._loaded_blob_keys(org_ids):
+                pipe.get(key)
+            blobs = pipe.execute()
+        else:
+            org_ids = []
+
+            def read(pipe):
+                org_ids[:] = sorted(
+                    decode(org_id) for org_id in pipe.smembers(self.orgs_key)
+                )
+                pipe.multi()
+                pipe.get(self.version_key)
+                pipe.mget(self._loaded_blob_keys(org_ids))
+
+            version, blobs = self.redis.transaction(read, self.version_key)
+        return self._blobs_result(version, org_ids, blobs)
+
+    def _loaded_blob_keys(self, org_ids):
+        """ The keys of the blobs load_blobs reads """
+        return [
+            self._blob_key(key) for key in
+            [self._key(TIER_GENERIC), self._key(TIER_TRIAL)] +
+            [self._org_key(org_id) for org_id in org_ids]
+        ]
+
+    @staticmethod
+    def _blobs_result(version, org_ids, blobs):
+        """ The load_blobs tuple of the generic, trial and organization
+            blobs
+        """
+        return (
+            int(version or 0), blob.unpack(blobs[0]), blob.unpack(blobs[1]),
+            {
+                org_id: blob.unpack(org_blob)
+                for org_id, org_blob in zip(org_ids, blobs[2:]) if org_blob
+            }
+        )
+
+    def rebuild_prefix_lengths(self):
+        """ Recompute the indexes of the prefix lengths and stems in use
+
+            The scripts only probe the prefix lengths some rule of the tier
+            (or organization) has, and only up to the longest prefix of the
+            number some rule starts with. The push methods keep the indexes
+            up to date, this is only needed for rules written by other means
+            or to drop the stems of removed rules.
+        """
+        pipe = self.redis.pipeline(transaction=False)
+        for key in (self._key(TIER_GENERIC), self._key(TIER_TRIAL),
+                    self.effective_trial_key):
+            pipe.hkeys(key)
+        generic, trial, effective = pipe.execute()
+        indexes = {
+            self._lengths_key(TIER_GENERIC): _tier_lengths(generic),
+            self._lengths_key(TIER_TRIAL): _tier_lengths(trial),
+            self.effective_trial_key + ":lengths": _tier_lengths(effective),
+        }
+        stems = {
+            self._stems_key(TIER_GENERIC): _stems(generic),
+            self._stems_key(TIER_TRIAL): _stems(trial),
+            self.effective_trial_key + ":stems": _stems(effective),
+        }
+        pipe = self._pipeline()
+        for key, members in indexes.items():
+            pipe.delete(key)
+            if members:
+                pipe.execute_command('ZADD', key, *members)
+        for key, fields in stems.items():
+            pipe.delete(key)
+            _queue_hmset(pipe, key, fields)
+        pipe.execute()
+
+    def replace_rules(self, generic, trial, org=None, dry_run=False):
+        """ Replace all the generic and trial rules in one go
+
+            generic and trial are {prefix: rule} dicts, org is an
+            {org_id: {prefix: rule}} dict that replaces the organization
+            rules as well if given.
+
+            The rules are written to staging keys trough a single pipeline
+            and renamed over the live keys in one transaction, so queries
+            never see a half loaded rule set. In cluster mode the renames
+            are only atomic per slot. Returns the differences to the
+            rules in redis per tier, as rules_diff does. Nothing is written
+            with dry_run.
+        """
+        generic = self._validated(generic)
+        trial = self._validated(trial)
+        _, live_generic, live_trial, live_orgs = self.snapshot()
+        diff = {
+            TIER_GENERIC: rules_diff(decode_hash(live_generic), generic),
+            TIER_TRIAL: rules_diff(decode_hash(live_trial), trial),
+        }
+        hashes = {
+            self._key(TIER_GENERIC): generic,
+            self._key(TIER_TRIAL): trial,
+            self.effective_trial_key: effective_trial_rules(generic, trial),
+        }
+        sets = {}
+        if org is not None:
+            org = {
+                org_id: self._validated(rules)
+                for org_id, rules in org.items() if rules
+            }
+            diff[TIER_ORG] = rules_diff(
+                org_fields({
+                    org_id: {
+                        decode(prefix): decode_rule(rule)
+                        for prefix, rule in rules.items()
+                    }
+                    for org_id, rules in live_orgs.items()
+                }),
+                org_fields(org)
+            )
+            for org_id in live_orgs:
+                hashes[self._org_key(org_id)] = {}
+            for org_id, rules in org.items():
+                hashes[self._org_key(org_id)] = {
+                    prefix: RULE_CODES[rule] for prefix, rule in rules.items()
+                }
+            sets[self.orgs_key] = sorted(org)
+        if dry_run:
+            return diff
+
+        indexes = {}
+        for key in (self._key(TIER_GENERIC), self._key(TIER_TRIAL),
+                    self.effective_trial_key):
+            indexes[key + ":lengths"] = _tier_lengths(hashes[key])
+            hashes[key + ":stems"] = _stems(hashes[key])
+        pipe = self.redis.pipeline(transaction=False)
+        for key, fields in hashes.items():
+            pipe.delete(key + ":staging")
+            _queue_hmset(pipe, key + ":staging", fields)
+        for key, members in indexes.items():
+            pipe.delete(key + ":staging")
+            if members:
+                pipe.execute_command('ZADD', key + ":staging", *members)
+        for key, members in sets.items():
+            pipe.delete(key + ":staging")
+            if members:
+                pipe.sadd(key + ":staging", *members)
+        pipe.execute()
+
+        contents = dict(hashes)
+        contents.update(indexes)
+        contents.update(sets)
+        pipe = self._pipeline()
+        for key, content in contents.items():
+            if content:
+                # cluster pipelines only take RENAME as a raw command
+                pipe.execute_command('RENAME', key + ":staging", key)
+            else:
+                pipe.delete(key)
+        # the blobs of the organizations replaced away are deleted as well
+        self._notify(
+            pipe, TIER_ALL,
+            org_ids=set(live_orgs) | set(org) if org is not None else ()
+        )
+        return diff
+
+    def _validated(self, rules):
+        """ Validate and normalize a {prefix: rule} dict """
+        return {
+            self._prefix(prefix): self._rule(rule)
+            for prefix, rule in rules.items()
+        }
+
+    def get_version(self):
+        """ The current version of the rules, bumped on every change """
+        return int(self.redis.get(self.version_key) or 0)
+
+    def snapshot(self):
+        """ Read the version and all the rule hashes in one transaction
+
+            Returns a (version, generic, trial, orgs) tuple, orgs being the
+            hash of each organization by org_id. The transaction is retried
+            if the rules change while the organizations are listed. In
+            cluster mode the hashes are read without a transaction, after
+            the version, so the rules are never older than the version.
+        """
+        if self.cluster:
+            version = self.redis.get(self.version_key)
+            org_ids = self.org_ids()
+            pipe = self._pipeline()
+            self._queue_snapshot(pipe, org_ids)
+            result = pipe.execute()
+            result[0] = version
+            return self._snapshot_result(org_ids, result)
+        org_ids = []
+
+        def read(pipe):
+            org_ids[:] = sorted(
+                decode(org_id) for org_id in pipe.smembers(self.orgs_key)
+            )
+            pipe.multi()
+            self._queue_snapshot(pipe, org_ids)
+
+        result = self.redis.transaction(read, self.version_key)
+        return self._snapshot_result(org_ids, result)
+
+    def _queue_snapshot(self, pipe, org_ids):
+        """ Queue the reads of a snapshot of the rules on pipe """
+        pipe.get(self.version_key)
+        pipe.hgetall(self._key(TIER_GENERIC))
+        pipe.hgetall(self._key(TIER_TRIAL))
+        for org_id in org_ids:
+            pipe.hgetall(self._org_key(org_id))
+
+    @staticmethod
+    def _snapshot_result(org_ids, result):
+        """ The snapshot tuple from the result of _queue_snapshot """
+        version, generic, trial = result[:3]
+        return (
+            int(version or 0), generic, trial,
+            dict(zip(org_ids, result[3:]))
+        )
+
+    def load_tier(self, tier):
+        """ Read a single tier, returns a (version, rules) tuple """
+        pipe = self._pipeline()
+        pipe.get(self.version_key)
+        pipe.hgetall(self._key(tier))
+        version, rules = pipe.execute()
+        return int(version or 0), rules
+
+    def load_org(self, org_id):
+        """ Read the rules of a single organization
+
+            Returns a (version, rules) tuple.
+        """
+        pipe = self._pipeline()
+        pipe.get(self.version_key)
+        pipe.hgetall(self._org_key(org_id))
+        version, rules = pipe.execute()
+        return int(version or 0), rules
+
+    def org_ids(self):
+        """ The organizations that have specific rules """
+        return sorted(
+            decode(org_id) for org_id in self.redis.smembers(self.orgs_key)
         )
 
     @lru_cache()
-    def _load_script(self):
-        """ Loads the path specified in argumenta and memoizes """
-        path = os.path.join(
-            os.path.dirname(os.path.realpath(__file__)),
-            LUA_SCRIPT_NAME
+    def _load_script(self, name=LUA_SCRIPT_NAME, lib=True):
+        """ Loads the script with the shared functions prepended, unless lib
+            is False, and memoizes
+        """
+        def read(name):
+            path = os.path.join(
+                os.path.dirname(os.path.realpath(__file__)),
+                name
+            )
+            with open(path, 'r') as script:
+                return script.read()
+        if not lib:
+            return read(name)
+        return read(LUA_LIB_NAME) + "\n" + read(name)
+
+    def _rule_keys(self):
+        """ The keys the rule scripts expect, see _query_keys for the
+            organization
+        """
+        return (
+            self._key(TIER_GENERIC),
+            self._key(TIER_TRIAL),
+            self._key(TIER_ORG),
+            self.stats_key,
+            self.effective_trial_key,
+            self._lengths_key(TIER_GENERIC),
+            self.effective_trial_key + ":lengths",
+            self._stems_key(TIER_GENERIC),
+            self.effective_trial_key + ":stems"
+        )
+
+    def _rule_blob_keys(self):
+        """ The keys phone.blob.redis.lua expects """
+        return (
+            self._blob_key(self._key(TIER_GENERIC)),
+            self._blob_key(self._key(TIER_TRIAL)),
+            self._blob_key(self.effective_trial_key),
+            self._key(TIER_ORG),
+            self.stats_key
         )
-        with open(path, 'r') as script:
-            return script.read()
+
+    def _query_keys(self, org_id, blobs=False):
+        """ The keys of a query script call, with the hash of the
+            organization, or its blob, in place of the organization tier
+            when there's one
+        """
+        keys, index = self._keys, 2
+        if blobs:
+            keys, index = self._blob_keys, 3
+        if not org_id:
+            return keys
+        org_key = self._org_key(org_id)
+        if blobs:
+            org_key = self._blob_key(org_key)
+        return keys[:index] + (org_key, ) + keys[index + 1:]
+
+    def _many_keys(self, args):
+        """ The keys of a batch script call: those of the query script
+            followed by the hashes of the organizations, in the order they
+            first appear in args
+        """
+        org_keys = []
+        for org_id in args[4::3]:
+            if org_id and self._org_key(org_id) not in org_keys:
+                org_keys.append(self._org_key(org_id))
+        return self._keys + tuple(org_keys)
+
+    def _script_flags(self):
+        """ The logging flag and stats weight passed to the scripts
+
+            A sampled call increments the counters by stats_every, so they
+            approximate the real totals.
+        """
+        weight = 0
+        if self.stats_every and next(self._calls) % self.stats_every == 0:
+            weight = self.stats_every
+        return ("1" if self.debug else "0", weight)
+
+    def get_stats(self):
+        """ The decision and warning counters recorded by the scripts
+
+            Only populated when stats_every is set. Decisions are counted as
+            decision:<tier>:<rule> or decision:none, warnings as warn:<kind>.
+        """
+        return {
+            decode(field): int(value)
+            for field, value in self.redis.hgetall(self.stats_key).items()
+        }
 
     def query_rule(self, phone_no, is_trial=False, org_id=None):
         """ Query redis for the policy to apply
@@ -57,19 +833,318 @@ class RuleOperations(object):
 
             Raises ValueError if invalid rule is found in redis
         """
-        lua_script = self.redis.register_script(
-            self._load_script()
-        )
-        ret = lua_script(
-            keys=(
-                self.key_prefix + 'rules',
-                self.key_prefix + 'rules:trial',
-                self.key_prefix + 'rules:org'
-            ),
-            args=(
-                phone_no, is_trial, org_id
+        if self.metrics is None:
+            return self._query_rule(phone_no, is_trial, org_id)
+        if self.metrics.sampled():
+            return self.trace_rule(phone_no, is_trial, org_id).decision
+        started = time.perf_counter()
+        decision = self._query_rule(phone_no, is_trial, org_id)
+        self.metrics.observe(time.perf_counter() - started)
+        return decision
+
+    def _query_rule(self, phone_no, is_trial, org_id):
+        """ query_rule without the metrics """
+        if self.cluster and org_id:
+            if self.blobs:
+                decision = self._blob_decision(self.redis.get(
+                    self._blob_key(self._org_key(org_id))
+                ), phone_no)
+            else:
+                decision = self._org_decision(self.redis.hmget(
+                    self._org_key(org_id), _prefixes(phone_no)
+                ))
+            if decision is not None:
+                return decision
+            org_id = None
+        ret = self._query(
+            self._query_args(phone_no, is_trial, org_id), self.blobs
+        )
+        return self._decision(ret)
+
+    def trace_rule(self, phone_no, is_trial=False, org_id=None):
+        """ Query the policy to apply and how it was decided
+
+            Returns a phone_rule_engine.metrics.DecisionTrace with the
+            decision query_rule would return, the tier and the prefix of the
+            deciding rule, the number of rule fields read and the time spent
+            in redis and on the whole call. Traces are not counted in the
+            stats, and recorded in the metrics if there are any.
+        """
+        started = time.perf_counter()
+        trace = None
+        if self.cluster and org_id:
+            prefixes = _prefixes(phone_no)
+            rule, prefix = self._org_rule(
+                prefixes, self.redis.hmget(self._org_key(org_id), prefixes)
             )
+            if rule is not None:
+                trace = DecisionTrace(
+                    rule == R_ALLOW, TIER_ORG, prefix, len(prefixes), 0, 0
+                )
+            org_id = None
+        if trace is None:
+            trace = self._trace(self._query(
+                self._trace_args(phone_no, is_trial, org_id)
+            ))
+        trace = trace._replace(seconds=time.perf_counter() - started)
+        if self.metrics is not None:
+            self.metrics.observe_trace(trace)
+        return trace
+
+    def _trace_args(self, phone_no, is_trial, org_id):
+        """ The arguments of a traced query, never counted in the stats """
+        return (
+            phone_no,
+            str(is_trial),
+            org_id if org_id is not None else "",
+            "1" if self.debug else "0",
+            0,
+            "1"
         )
+
+    @classmethod
+    def _trace(cls, ret):
+        """ The DecisionTrace of the result of a traced query """
+        decision, tier, prefix, probes, micros = ret
+        return DecisionTrace(
+            cls._decision(decision),
+            decode(tier) or None,
+            decode(prefix) or None,
+            int(probes),
+            int(micros) / 1e6,
+            0
+        )
+
+    def _query(self, args, blobs=False):
+        """ Run the query script, or with blobs the one deciding from the
+            blobs, on a replica unless the call is counted in the stats
+        """
+        script, keys = self._script, self._query_keys(args[2])
+        if blobs:
+            script, keys = self._blob_script, self._query_keys(args[2], True)
+        if self.replicas and not args[4]:
+            ret, = self.replicas.evalsha(
+                script, [(keys, args)],
+                lambda: [script(keys=keys, args=args)]
+            )
+            return ret
+        return script(keys=keys, args=args)
+
+    @classmethod
+    def _org_decision(cls, rules):
+        """ The decision of the longest valid organization rule
+
+            rules are the values of the organization hash for the prefixes
+            of the phone number, longest first. Used in cluster mode, where the
+            organization hashes are on other nodes than the scripts run on.
+        """
+        rule, _ = cls._org_rule(itertools.repeat(None), rules)
+        if rule is None:
+            return None
+        return rule == R_ALLOW
+
+    @staticmethod
+    def _blob_decision(org_blob, phone_no):
+        """ The decision of the organization rules in org_blob, used like
+            _org_decision in cluster mode
+        """
+        rule, _ = blob.longest(org_blob, phone_no)
+        if rule is None:
+            return None
+        return rule == R_ALLOW
+
+    @staticmethod
+    def _org_rule(prefixes, rules):
+        """ The longest valid organization rule and its prefix, or None and
+            None, rules being the values for the prefixes
+        """
+        for prefix, rule in zip(prefixes, rules):
+            rule = decode_rule(rule)
+            if rule in (R_ALLOW, R_RESTRICT):
+                return rule, prefix
+        return None, None
+
+    def _query_args(self, phone_no, is_trial, org_id):
+        """ The arguments of the query script
+
+            Passed as strings, newer redis clients refuse booleans and None.
+        """
+        return (
+            phone_no,
+            str(is_trial),
+            org_id if org_id is not None else ""
+        ) + self._script_flags()
+
+    def query_rules_many(self, numbers, is_trial=False, org_id=None,
+                         chunk_size=BATCH_CHUNK_SIZE):
+        """ Query the policy for many phone numbers in one round trip
+
+            Each item of numbers is either a phone number, to which is_trial
+            and org_id apply, or a (phone_no, is_trial, org_id) tuple.
+            Returns a list with True, False or None for each number, as
+            query_rule would.
+
+            The numbers are evaluated chunk_size at a time by separate script
+            calls sent in one pipeline, so a large batch doesn't block redis.
+        """
+        if self.cluster:
+            return self._query_cluster_many(
+                numbers, is_trial, org_id, chunk_size
+            )
+        chunks = self._many_args(numbers, is_trial, org_id, chunk_size)
+        if not chunks:
+            return []
+        if self.replicas and not any(args[1] for args in chunks):
+            results = self._run_on_replicas(self._many_script, chunks)
+        else:
+            results = self._run_chunks(self._many_script, chunks)
+        return [self._decision(ret) for chunk in results for ret in chunk]
+
+    def _run_chunks(self, script, chunks):
+        """ Run the batch script calls on redis, in one pipeline unless in
+            cluster mode where pipelines can't run scripts
+        """
+        if self.cluster:
+            return [
+                script(keys=self._many_keys(args), args=args)
+                for args in chunks
+            ]
+        pipe = self.redis.pipeline(transaction=False)
+        for args in chunks:
+            script(keys=self._many_keys(args), args=args, client=pipe)
+        return pipe.execute()
+
+    def _run_on_replicas(self, script, chunks):
+        """ Run the batch script calls on a replica, falling back to redis
+        """
+        return self.replicas.evalsha(
+            script, [(self._many_keys(args), args) for args in chunks],
+            lambda: self._run_chunks(script, chunks)
+        )
+
+    def _query_cluster_many(self, numbers, is_trial, org_id, chunk_size):
+        """ query_rules_many in cluster mode
+
+            The organization hashes are read in one pipeline, the numbers
+            no organization rule decided on are sent to the batch script.
+        """
+        numbers = _triplets(numbers, is_trial, org_id)
+        decisions = [
+            None if rule is None else rule == R_ALLOW
+            for rule, _ in self._org_rules_many(numbers)
+        ]
+        undecided = [i for i, decision in enumerate(decisions)
+                     if decision is None]
+        chunks = self._many_args(
+            [(numbers[i][0], numbers[i][1], None) for i in undecided],
+            is_trial, None, chunk_size
+        )
+        results = [
+            ret for chunk in self._run_chunks(self._many_script, chunks)
+            for ret in chunk
+        ]
+        for i, ret in zip(undecided, results):
+            decisions[i] = self._decision(ret)
+        return decisions
+
+    def _org_rules_many(self, numbers):
+        """ The longest valid organization rule and its prefix for each
+            (phone_no, is_trial, org_id), read in one pipeline
+
+            Used in cluster mode, None and None for the numbers without an
+            organization or rule.
+        """
+        rules = [(None, None)] * len(numbers)
+        with_org = [i for i, number in enumerate(numbers) if number[2]]
+        if not with_org:
+            return rules
+        pipe = self.redis.pipeline(transaction=False)
+        for i in with_org:
+            phone_no, _, number_org_id = numbers[i]
+            pipe.hmget(self._org_key(number_org_id), _prefixes(phone_no))
+        for i, values in zip(with_org, pipe.execute()):
+            rules[i] = self._org_rule(_prefixes(numbers[i][0]), values)
+        return rules
+
+    def explain_rule(self, phone_no, is_trial=False, org_id=None):
+        """ Explain the policy to apply
+
+            Returns a phone_rule_engine.explain.Explanation: the decision
+            query_rule would return, the tier and the prefix of the deciding
+            rule and the rules of the lower tiers it shadows, found by a
+            single script call. The script is separate from the query
+            script, and only loaded once used.
+        """
+        return self.explain_rules_many([(phone_no, is_trial, org_id)])[0]
+
+    def explain_rules_many(self, numbers, is_trial=False, org_id=None,
+                           chunk_size=BATCH_CHUNK_SIZE):
+        """ Explain the policy for many phone numbers in one round trip
+
+            numbers are as for query_rules_many, returns an Explanation for
+            each of them, see explain_rule.
+        """
+        numbers = _triplets(numbers, is_trial, org_id)
+        if not numbers:
+            return []
+        org_rules = [(None, None)] * len(numbers)
+        if self.cluster:
+            org_rules = self._org_rules_many(numbers)
+            numbers = [(number[0], number[1], None) for number in numbers]
+        chunks = self._many_args(
+            numbers, is_trial, org_id, chunk_size,
+            flags=("1" if self.debug else "0", 0)
+        )
+        if self.replicas:
+            results = self._run_on_replicas(self._explain_script, chunks)
+        else:
+            results = self._run_chunks(self._explain_script, chunks)
+        return self._explanations(org_rules, results)
+
+    @staticmethod
+    def _explanations(org_rules, results):
+        """ The Explanation of each number from the results of the explain
+            script calls, with the organization rules found client side in
+            cluster mode
+        """
+        explanations = []
+        matches = (ret for chunk in results for ret in chunk)
+        for (rule, prefix), number_matches in zip(org_rules, matches):
+            number_matches = decode_matches(number_matches)
+            if rule is not None:
+                number_matches.insert(0, RuleMatch(TIER_ORG, prefix, rule))
+            explanations.append(explanation(number_matches))
+        return explanations
+
+    def _many_args(self, numbers, is_trial, org_id, chunk_size, flags=None):
+        """ The arguments of the batch script calls, one per chunk
+
+            Each starts with flags, the script flags of a query by default.
+        """
+        args = []
+        for number in numbers:
+            if isinstance(number, (tuple, list)):
+                phone_no, number_is_trial, number_org_id = number
+            else:
+                phone_no, number_is_trial, number_org_id = \
+                    number, is_trial, org_id
+            args.extend((
+                phone_no,
+                str(number_is_trial),
+                number_org_id if number_org_id is not None else ""
+            ))
+        step = chunk_size * 3
+        return [
+            (flags or self._script_flags()) + tuple(args[start:start + step])
+            for start in range(0, len(args), step)
+        ]
+
+    @staticmethod
+    def _decision(ret):
+        """ Convert the result of the script to True, False or None
+
+            Raises ValueError if invalid rule is found in redis
+        """
         if ret:
             ret = ret.decode('ascii')
             if ret == "allow":
@@ -80,6 +1155,15 @@ class RuleOperations(object):
         else:
             return None
 
+    def compile_rules(self):
+        """ Load all the rules from redis into an in process RuleTrie
+
+            The hashes are read in a single transaction, so the result is a
+            consistent snapshot that answers query_rule without round trips.
+        """
+        _, generic, trial, org = self.snapshot()
+        return RuleTrie.from_hashes(generic, trial, org)
+
     def _rule(self, rule):
         """ Validate and normalize the rule """
         rule = rule.lower()
@@ -99,11 +1183,233 @@ class RuleOperations(object):
             )
         return prefix
 
-    def _push_rule(self, key, prefix, rule):
-        """ Adds the rule for prefix to the specific key in redis
+    def _key(self, tier):
+        """ The redis key holding the rules of a tier """
+        return self._shared_prefix + TIER_KEYS[tier]
+
+    def _lengths_key(self, tier):
+        """ The redis key of the sorted set of prefix lengths in use """
+        return self._key(tier) + ":lengths"
+
+    def _stems_key(self, tier):
+        """ The redis key of the hash of every prefix of the rule prefixes """
+        return self._key(tier) + ":stems"
+
+    @staticmethod
+    def _blob_key(key):
+        """ The redis key of the blob of the rules at key, see
+            phone_rule_engine.blob
+        """
+        return key + ":blob"
+
+    def _org_key(self, org_id):
+        """ The redis key of the rules of an organization
+
+            A hash of prefix to rule code, the org_id is a hash tag so the
+            organizations are spread over the slots of a cluster.
+        """
+        return "{}{}:{{{}}}".format(
+            self.key_prefix, TIER_KEYS[TIER_ORG], org_id
+        )
+
+    def _push_rule(self, tier, prefix, rule):
+        """ Adds the rule for prefix to the key of the tier in redis
 
             Returns any rule that was set previusly
         """
+        pipe = self._pipeline()
+        prefix = self._queue_rule(pipe, tier, prefix, rule)
+        if self.cluster:
+            # cluster pipelines can't run scripts
+            pipe.execute()
+            self._effective_script(
+                keys=self._effective_keys(), args=(prefix, )
+            )
+        else:
+            self._effective_script(
+                keys=self._effective_keys(),
+                args=(prefix, ),
+                client=pipe
+            )
+        self._notify(pipe, tier)
+
+    def _pipeline(self):
+        """ A pipeline applied as a transaction, but for cluster mode where
+            transactions can't span slots
+        """
+        return self.redis.pipeline(transaction=not self.cluster)
+
+    def _queue_rule(self, pipe, tier, prefix, rule):
+        """ Validate and queue the writes of a rule on pipe
+
+            The effective trial rules are left for the caller to update, the
+            script call differs for blocking and asyncio clients. Returns the
+            normalized prefix.
+        """
         prefix = self._prefix(prefix)
         rule = self._rule(rule)
-        self.redis.hset(self.key_prefix + key, prefix, rule.lower())
+        pipe.hset(self._key(tier), prefix, rule.lower())
+        pipe.execute_command(
+            'ZADD', self._lengths_key(tier), len(prefix), len(prefix)
+        )
+        pipe.execute_command(
+            'HMSET', self._stems_key(tier), *_flatten(_stems([prefix]))
+        )
+        return prefix
+
+    def _notify(self, pipe, tier, org_id=None, org_ids=()):
+        """ Apply the changes queued in pipe, bump the version and publish
+            a change event so local caches can reload the tier (or org)
+
+            The write and the version bump happen in one transaction, the
+            event carries the new version so subscribers can detect missed
+            events. With the blobs in use, the blobs of the tier, of org_id
+            and of org_ids are rebuilt before the version is bumped. Returns
+            the results of pipe, the new version last.
+        """
+        results = []
+        if self.blobs:
+            pipe.set(self.blobs_key, 1)
+        if self.blobs or self.redis.exists(*self._blobs_in_use_keys()):
+            results = self._queue_compile(
+                pipe, self._blob_calls(tier, org_id, org_ids)
+            )
+        pipe.incr(self.version_key)
+        results += pipe.execute()
+        self.redis.publish(
+            self.changes_channel,
+            self._change_event(results[-1], tier, org_id)
+        )
+        return results
+
+    def _blobs_in_use_keys(self):
+        """ The keys of which any tells the writes to rebuild the blobs
+
+            The mark compile_blobs sets, or the generic blob for blobs built
+            before it did.
+        """
+        return (self.blobs_key, self._blob_key(self._key(TIER_GENERIC)))
+
+    def _blob_calls(self, tier, org_id=None, org_ids=()):
+        """ The keys and arguments of the compile script calls rebuilding
+            the blobs of a change, one call per slot
+
+            The effective trial rules change with either tier. The hashes
+            of the organizations hold rule codes rather than keywords.
+        """
+        shared = []
+        if tier in (TIER_GENERIC, TIER_ALL):
+            shared.append(self._key(TIER_GENERIC))
+        if tier in (TIER_TRIAL, TIER_ALL):
+            shared.append(self._key(TIER_TRIAL))
+        if tier != TIER_ORG:
+            shared.append(self.effective_trial_key)
+        org_ids = sorted(set(org_ids) | ({org_id} if org_id else set()))
+        calls = [([self._org_key(each)], ("1", )) for each in org_ids]
+        if shared:
+            calls.insert(0, (shared, ("0", ) * len(shared)))
+        return [
+            (tuple(x for key in keys for x in (key, self._blob_key(key))),
+             args)
+            for keys, args in calls
+        ]
+
+    def _queue_compile(self, pipe, calls):
+        """ Queue the compile script calls on pipe
+
+            In cluster mode pipelines can't run scripts, pipe is executed
+            first and its results returned, so the blobs are rebuilt after
+            the rules are written.
+        """
+        if not self.cluster:
+            for keys, args in calls:
+                self._compile_script(keys=keys, args=args, client=pipe)
+            return []
+        results = pipe.execute()
+        for keys, args in calls:
+            self._compile_script(keys=keys, args=args)
+        return results
+
+    @staticmethod
+    def _change_event(version, tier, org_id=None):
+        """ The message published on the changes channel """
+        event = {"version": version, "tier": tier}
+        if org_id is not None:
+            event["org_id"] = org_id
+        return json.dumps(event)
+
+
+class RuleTransaction(object):
+    """ Rule changes collected by RuleOperations.transaction
+
+        A later change to a prefix replaces an earlier one.
+    """
+
+    def __init__(self, rule_ops):
+        self.rule_ops = rule_ops
+        self.generic = {}
+        self.trial = {}
+        self.org = {}
+        # the rules the changes replaced, once pushed
+        self.previous = None
+
+    def push_generic_rule(self, prefix, rule):
+        """ Sets a generic rule for the specific prefix """
+        self.generic.update(self.rule_ops._validated({prefix: rule}))
+
+    def push_trial_rule(self, prefix, rule):
+        """ Sets a trial specific rule for the specific prefix """
+        self.trial.update(self.rule_ops._validated({prefix: rule}))
+
+    def push_org_rule(self, prefix, rule, org_id):
+        """ Push an organization sepcific rule  """
+        self.org.setdefault(org_id, {}).update(
+            self.rule_ops._validated({prefix: rule})
+        )
+
+
+def _tier_lengths(fields):
+    """ The members of a tier length index: each length scored by itself """
+    lengths = set(len(decode(field)) for field in fields)
+    return [x for length in sorted(lengths) for x in (length, length)]
+
+
+def _stems(fields):
+    """ The fields of a tier stems index: every prefix of every field,
+        including the empty one
+    """
+    stems = {}
+    for field in fields:
+        field = decode(field)
+        for i in range(len(field) + 1):
+            stems[field[:i]] = 1
+    return stems
+
+
+def _flatten(fields):
+    """ The field value pairs of a dict as HMSET arguments """
+    return [x for item in sorted(fields.items()) for x in item]
+
+
+def _queue_hmset(pipe, key, fields):
+    """ Queue writing fields to the hash at key, BULK_CHUNK_SIZE at a time """
+    items = _flatten(fields)
+    step = BULK_CHUNK_SIZE * 2
+    for start in range(0, len(items), step):
+        pipe.execute_command('HMSET', key, *items[start:start + step])
+
+
+def _prefixes(phone_no):
+    """ The prefixes of a phone number, longest first """
+    return [phone_no[:i] for i in range(len(phone_no), 0, -1)]
+
+
+def _triplets(numbers, is_trial, org_id):
+    """ The (phone_no, is_trial, org_id) of each item of numbers, see
+        query_rules_many
+    """
+    return [
+        tuple(number) if isinstance(number, (tuple, list))
+        else (number, is_trial, org_id)
+        for number in numbers
+    ]
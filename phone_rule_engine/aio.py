@@ -0,0 +1,319 @@
+# -*- mode: Python; tab-width: 4; indent-tabs-mode: nil; -*-
+# ex: set tabstop=4 :
+# Please do not change the lines above. See PEP 8, PEP 263.
+""" Operations to deal with phone prefix rules from asyncio code """
+
+import asyncio
+from contextlib import asynccontextmanager
+import time
+
+from phone_rule_engine import RuleOperations, RuleTransaction
+from phone_rule_engine import BATCH_CHUNK_SIZE, _triplets
+from phone_rule_engine.trie import RuleTrie, decode, decode_rule
+from phone_rule_engine.trie import TIER_GENERIC, TIER_TRIAL, TIER_ORG
+
+
+def _needs_blocking_client(name):
+    """ A method of RuleOperations that AsyncRuleOperations doesn't offer
+    """
+    def method(self, *args, **kwargs):
+        raise NotImplementedError(
+            "{} needs a blocking redis client, use RuleOperations".format(name)
+        )
+    method.__name__ = name
+    method.__doc__ = """ Not offered, see AsyncRuleOperations """
+    return method
+
+
+class AsyncRuleOperations(RuleOperations):
+    """ Operations to deal with phone prefix rules without blocking
+
+        Same API as RuleOperations, with the redis calls being coroutines.
+        Expects an asyncio redis client, such as redis.asyncio.StrictRedis,
+        and uses the same scripts, keys and validation.
+
+        The maintenance operations ( rebuild_effective_trial,
+        rebuild_prefix_lengths, compile_blobs, migrate_org_rules,
+        replace_rules ), load_blobs, load_tier, load_org, org_ids, cluster
+        mode, replicas and RuleCache need a blocking client and
+        RuleOperations, the methods raise NotImplementedError here.
+
+        The constructor can't await loading the scripts, call
+        await warmup() instead of passing warmup=True.
+    """
+
+    def __init__(self, redis, key_prefix="", warmup=False, *args, **kwargs):
+        if warmup:
+            raise ValueError(
+                "Call await warmup() to load the scripts of an asyncio client"
+            )
+        if kwargs.get("cluster") or kwargs.get("replicas"):
+            raise ValueError(
+                "Cluster mode and replicas need a blocking redis client"
+            )
+        super().__init__(redis, key_prefix, False, *args, **kwargs)
+
+    migrate_org_rules = _needs_blocking_client("migrate_org_rules")
+    rebuild_effective_trial = _needs_blocking_client("rebuild_effective_trial")
+    compile_blobs = _needs_blocking_client("compile_blobs")
+    load_blobs = _needs_blocking_client("load_blobs")
+    rebuild_prefix_lengths = _needs_blocking_client("rebuild_prefix_lengths")
+    replace_rules = _needs_blocking_client("replace_rules")
+    load_tier = _needs_blocking_client("load_tier")
+    load_org = _needs_blocking_client("load_org")
+    org_ids = _needs_blocking_client("org_ids")
+
+    async def warmup(self):
+        """ Load the scripts in redis ahead of the first query """
+        for script in self._warmup_scripts():
+            script.sha = await self.redis.script_load(script.script)
+
+    async def push_generic_rule(self, prefix, rule):
+        """ Sets a generic rule for the specific prefix """
+        await self._push_rule(TIER_GENERIC, prefix, rule)
+
+    async def push_trial_rule(self, prefix, rule):
+        """ Sets a trial specific rule for the specific prefix """
+        await self._push_rule(TIER_TRIAL, prefix, rule)
+
+    async def push_org_rule(self, prefix, rule, org_id):
+        """ Push an organization sepcific rule  """
+        pipe = self.redis.pipeline()
+        self._queue_org_rule(pipe, prefix, rule, org_id)
+        await self._notify(pipe, TIER_ORG, org_id)
+
+    async def delete_generic_rule(self, prefix):
+        """ Remove the generic rule for prefix, see
+            RuleOperations.delete_generic_rule
+        """
+        return await self._delete_rule(TIER_GENERIC, prefix)
+
+    async def delete_trial_rule(self, prefix):
+        """ Remove the trial specific rule for prefix """
+        return await self._delete_rule(TIER_TRIAL, prefix)
+
+    async def delete_org_rule(self, prefix, org_id):
+        """ Remove an organization specific rule """
+        previous = await self._delete_org_rules(
+            org_id, [self._prefix(prefix)]
+        )
+        return decode_rule(previous[0])
+
+    async def clear_org(self, org_id):
+        """ Remove all the rules of an organization """
+        return self._cleared_rules(await self._delete_org_rules(org_id, []))
+
+    async def _delete_rule(self, tier, prefix):
+        """ See RuleOperations._delete_rule """
+        pipe = self.redis.pipeline()
+        for script, keys, args in self._delete_calls(
+                tier, self._prefix(prefix)):
+            await script(keys=keys, args=args, client=pipe)
+        previous = (await self._notify(pipe, tier))[0]
+        return decode_rule(previous[0])
+
+    async def _delete_org_rules(self, org_id, prefixes):
+        """ See RuleOperations._delete_org_rules """
+        pipe = self.redis.pipeline()
+        await self._delete_org_script(
+            keys=(self._org_key(org_id), self.orgs_key),
+            args=[org_id] + prefixes, client=pipe
+        )
+        return (await self._notify(pipe, TIER_ORG, org_id))[0][0]
+
+    async def push_rules_bulk(self, generic=None, trial=None, org=None):
+        """ Set many rules in one round trip
+
+            See RuleOperations.push_rules_bulk
+        """
+        changes = self._bulk_changes(generic, trial, org)
+        if not any(changes.values()):
+            return changes
+        pipe = self.redis.pipeline()
+        prefixes = self._queue_bulk(pipe, changes)
+        if prefixes:
+            await self._effective_script(
+                keys=self._effective_keys(), args=prefixes, client=pipe
+            )
+        tier, org_id = self._bulk_event(changes)
+        results = await self._notify(pipe, tier, org_id, changes[TIER_ORG])
+        return self._bulk_previous(changes, results)
+
+    @asynccontextmanager
+    async def transaction(self):
+        """ Collect rule changes and push them with push_rules_bulk on exit
+
+            See RuleOperations.transaction
+        """
+        changes = RuleTransaction(self)
+        yield changes
+        changes.previous = await self.push_rules_bulk(
+            changes.generic, changes.trial, changes.org
+        )
+
+    async def get_version(self):
+        """ The current version of the rules, bumped on every change """
+        return int(await self.redis.get(self.version_key) or 0)
+
+    async def snapshot(self):
+        """ Read the version and all the rule hashes in one transaction
+
+            See RuleOperations.snapshot
+        """
+        org_ids = []
+
+        async def read(pipe):
+            org_ids[:] = sorted(
+                decode(org_id)
+                for org_id in await pipe.smembers(self.orgs_key)
+            )
+            pipe.multi()
+            self._queue_snapshot(pipe, org_ids)
+
+        result = await self.redis.transaction(read, self.version_key)
+        return self._snapshot_result(org_ids, result)
+
+    async def compile_rules(self):
+        """ Load all the rules from redis into an in process RuleTrie """
+        _, generic, trial, org = await self.snapshot()
+        return RuleTrie.from_hashes(generic, trial, org)
+
+    async def get_stats(self):
+        """ The decision and warning counters recorded by the scripts """
+        stats = await self.redis.hgetall(self.stats_key)
+        return {decode(field): int(value) for field, value in stats.items()}
+
+    async def query_rule(self, phone_no, is_trial=False, org_id=None):
+        """ Query redis for the policy to apply
+
+            Returns True if the  phone_no is allowed, False if it's restricted
+            or None if there's no rule
+        """
+        if self.metrics is not None and self.metrics.sampled():
+            return (await self.trace_rule(phone_no, is_trial, org_id)).decision
+        started = time.perf_counter()
+        script = self._blob_script if self.blobs else self._script
+        ret = await script(
+            keys=self._query_keys(org_id, self.blobs),
+            args=self._query_args(phone_no, is_trial, org_id)
+        )
+        if self.metrics is not None:
+            self.metrics.observe(time.perf_counter() - started)
+        return self._decision(ret)
+
+    async def trace_rule(self, phone_no, is_trial=False, org_id=None):
+        """ Query the policy to apply and how it was decided
+
+            See RuleOperations.trace_rule
+        """
+        started = time.perf_counter()
+        trace = self._trace(await self._script(
+            keys=self._query_keys(org_id),
+            args=self._trace_args(phone_no, is_trial, org_id)
+        ))
+        trace = trace._replace(seconds=time.perf_counter() - started)
+        if self.metrics is not None:
+            self.metrics.observe_trace(trace)
+        return trace
+
+    async def query_rules_many(self, numbers, is_trial=False, org_id=None,
+                               chunk_size=BATCH_CHUNK_SIZE):
+        """ Query the policy for many phone numbers in one round trip
+
+            See RuleOperations.query_rules_many
+        """
+        chunks = self._many_args(numbers, is_trial, org_id, chunk_size)
+        if not chunks:
+            return []
+        pipe = self.redis.pipeline(transaction=False)
+        for args in chunks:
+            await self._many_script(
+                keys=self._many_keys(args), args=args, client=pipe
+            )
+        return [
+            self._decision(ret)
+            for chunk in await pipe.execute() for ret in chunk
+        ]
+
+    async def explain_rule(self, phone_no, is_trial=False, org_id=None):
+        """ Explain the policy to apply
+
+            See RuleOperations.explain_rule
+        """
+        return (await self.explain_rules_many(
+            [(phone_no, is_trial, org_id)]
+        ))[0]
+
+    async def explain_rules_many(self, numbers, is_trial=False, org_id=None,
+                                 chunk_size=BATCH_CHUNK_SIZE):
+        """ Explain the policy for many phone numbers in one round trip
+
+            See RuleOperations.explain_rules_many
+        """
+        numbers = _triplets(numbers, is_trial, org_id)
+        if not numbers:
+            return []
+        chunks = self._many_args(
+            numbers, is_trial, org_id, chunk_size,
+            flags=("1" if self.debug else "0", 0)
+        )
+        pipe = self.redis.pipeline(transaction=False)
+        for args in chunks:
+            await self._explain_script(
+                keys=self._many_keys(args), args=args, client=pipe
+            )
+        return self._explanations(
+            [(None, None)] * len(numbers), await pipe.execute()
+        )
+
+    async def query_rules_concurrently(self, numbers, is_trial=False,
+                                       org_id=None, concurrency=50):
+        """ Query the policy for many phone numbers with concurrent calls
+
+            Unlike query_rules_many every number is a separate script call,
+            at most concurrency of them in flight, so the answers can be
+            served by separate connections of the pool. Items of numbers are
+            as for query_rules_many, the results are in the same order.
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def query(number):
+            if not isinstance(number, (tuple, list)):
+                number = (number, is_trial, org_id)
+            async with semaphore:
+                return await self.query_rule(*number)
+
+        return await asyncio.gather(*(query(number) for number in numbers))
+
+    async def _push_rule(self, tier, prefix, rule):
+        """ Adds the rule for prefix to the key of the tier in redis """
+        pipe = self.redis.pipeline()
+        prefix = self._queue_rule(pipe, tier, prefix, rule)
+        await self._effective_script(
+            keys=self._effective_keys(),
+            args=(prefix, ),
+            client=pipe
+        )
+        await self._notify(pipe, tier)
+
+    async def _notify(self, pipe, tier, org_id=None, org_ids=()):
+        """ Apply the changes queued in pipe, bump the version and publish
+            a change event, see RuleOperations._notify
+        """
+        if self.blobs:
+            pipe.set(self.blobs_key, 1)
+        in_use = self.blobs or await self.redis.exists(
+            *self._blobs_in_use_keys()
+        )
+        if in_use:
+            for keys, args in self._blob_calls(tier, org_id, org_ids):
+                await self._compile_script(
+                    keys=keys, args=args, client=pipe
+                )
+        pipe.incr(self.version_key)
+        results = await pipe.execute()
+        await self.redis.publish(
+            self.changes_channel,
+            self._change_event(results[-1], tier, org_id)
+        )
+        return results
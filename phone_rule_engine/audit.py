@@ -0,0 +1,250 @@
+# -*- mode: Python; tab-width: 4; indent-tabs-mode: nil; -*-
+# ex: set tabstop=4 :
+# Please do not change the lines above. See PEP 8, PEP 263.
+""" Offline evaluation of large batches of phone numbers, e.x. call detail
+    records, against a snapshot of the rules
+
+    Each tier is kept as one sorted array of integer prefixes per prefix
+    length, a batch of numbers is matched with one searchsorted per length,
+    longest first. Needs numpy, and pyarrow to read parquet files.
+"""
+
+import csv
+import json
+
+import numpy as np
+
+from phone_rule_engine.trie import R_ALLOW, R_RESTRICT
+from phone_rule_engine.trie import decode, decode_hash, decode_rule
+from phone_rule_engine.trie import is_trial_flag
+
+try:
+    import pyarrow.parquet as parquet
+except ImportError:
+    parquet = None
+
+# the decision codes of evaluate()
+ALLOW = 1
+RESTRICT = 0
+NO_RULE = -1
+DECISIONS = {ALLOW: True, RESTRICT: False, NO_RULE: None}
+# longer numbers and rules don't fit an int64, the numbers are matched on
+# their first MAX_DIGITS digits
+MAX_DIGITS = 18
+POWERS = 10 ** np.arange(MAX_DIGITS + 1, dtype=np.int64)
+CHUNK_SIZE = 1000000
+
+
+class PrefixTable(object):
+    """ The rules of a tier as sorted integer prefixes, by prefix length
+
+        The prefix length is kept along with the integer, so prefixes
+        starting with 0 are matched like any other.
+    """
+
+    def __init__(self, rules):
+        by_length = {}
+        for prefix, rule in rules.items():
+            if rule in (R_ALLOW, R_RESTRICT) and prefix.isdigit() and \
+                    len(prefix) <= MAX_DIGITS:
+                by_length.setdefault(len(prefix), []).append(
+                    (int(prefix), rule == R_ALLOW)
+                )
+        self.lengths = sorted(by_length, reverse=True)
+        self._prefixes = {}
+        self._allows = {}
+        for length, entries in by_length.items():
+            entries.sort()
+            self._prefixes[length] = np.array(
+                [prefix for prefix, _ in entries], dtype=np.int64
+            )
+            self._allows[length] = np.array(
+                [allows for _, allows in entries], dtype=bool
+            )
+
+    def __len__(self):
+        return sum(len(prefixes) for prefixes in self._prefixes.values())
+
+    def match(self, values, digits):
+        """ Find the longest rule matching each number
+
+            values are the numbers as int64 and digits their lengths.
+            Returns two boolean arrays: whether a rule matched and whether
+            that rule allows.
+        """
+        matched = np.zeros(len(values), dtype=bool)
+        allows = np.zeros(len(values), dtype=bool)
+        for length in self.lengths:
+            rows = np.flatnonzero(~matched & (digits >= length))
+            if not len(rows):
+                continue
+            heads = values[rows] // POWERS[digits[rows] - length]
+            prefixes = self._prefixes[length]
+            found = np.minimum(
+                np.searchsorted(prefixes, heads), len(prefixes) - 1
+            )
+            hits = prefixes[found] == heads
+            matched[rows[hits]] = True
+            allows[rows[hits]] = self._allows[length][found[hits]]
+        return matched, allows
+
+
+class RuleSnapshot(object):
+    """ The generic, trial and organization rules, ready for evaluate()
+
+        Gives the same answers as RuleOperations.query_rule: organization
+        specific rules take precedence over trial rules, which take
+        precedence over generic ones, and within a tier the longest
+        matching prefix wins.
+    """
+
+    def __init__(self, generic, trial, orgs, version=None):
+        self.version = version
+        self.rules = {"generic": generic, "trial": trial, "orgs": orgs}
+        self.generic = PrefixTable(generic)
+        self.trial = PrefixTable(trial)
+        self.orgs = {
+            org_id: PrefixTable(rules) for org_id, rules in orgs.items()
+        }
+
+    @classmethod
+    def from_redis(cls, rule_ops):
+        """ Load the rules with RuleOperations.snapshot() """
+        version, generic, trial, orgs = rule_ops.snapshot()
+        return cls(
+            decode_hash(generic), decode_hash(trial),
+            {
+                decode(org_id): {
+                    decode(prefix): decode_rule(rule)
+                    for prefix, rule in rules.items()
+                }
+                for org_id, rules in orgs.items()
+            },
+            decode(version)
+        )
+
+    @classmethod
+    def load(cls, path):
+        """ Load the rules from a file written by save() """
+        with open(path) as snapshot:
+            data = json.load(snapshot)
+        return cls(
+            data["generic"], data["trial"], data["orgs"], data.get("version")
+        )
+
+    def save(self, path):
+        """ Write the rules to a JSON file, to be edited or loaded later """
+        with open(path, "w") as snapshot:
+            json.dump(
+                dict(self.rules, version=self.version), snapshot,
+                indent=2, sort_keys=True
+            )
+
+    def evaluate(self, numbers, is_trial=False, org_ids=None):
+        """ Decide a batch of phone numbers
+
+            is_trial is either a single flag or one per number, org_ids is
+            None or the org_id of each number, None for the numbers without
+            one. Returns an int8 array of ALLOW, RESTRICT or NO_RULE.
+            Numbers are matched as given, like query_rule does, those that
+            aren't all digits have no rule.
+        """
+        values, digits = _parse(numbers)
+        decisions = np.full(len(values), NO_RULE, dtype=np.int8)
+        self._apply(self.generic, values, digits, decisions)
+        if isinstance(is_trial, (list, tuple, np.ndarray)):
+            flags, trial = np.unique(
+                np.asarray(is_trial, dtype=str), return_inverse=True
+            )
+            trial = np.array(
+                [is_trial_flag(flag) for flag in flags], dtype=bool
+            )[trial]
+            rows = np.flatnonzero(trial)
+            self._apply(self.trial, values, digits, decisions, rows)
+        elif is_trial_flag(is_trial):
+            self._apply(self.trial, values, digits, decisions)
+        if org_ids is not None:
+            rows_by_org = {}
+            for row, org_id in enumerate(org_ids):
+                if org_id in self.orgs:
+                    rows_by_org.setdefault(org_id, []).append(row)
+            for org_id, rows in rows_by_org.items():
+                self._apply(
+                    self.orgs[org_id], values, digits, decisions,
+                    np.array(rows, dtype=np.int64)
+                )
+        return decisions
+
+    @staticmethod
+    def _apply(table, values, digits, decisions, rows=None):
+        """ Overwrite the decisions where a rule of table matches """
+        if not table.lengths:
+            return
+        if rows is None:
+            matched, allows = table.match(values, digits)
+            decisions[matched] = allows[matched]
+        elif len(rows):
+            matched, allows = table.match(values[rows], digits[rows])
+            decisions[rows[matched]] = allows[matched]
+
+
+def _parse(numbers):
+    """ The numbers as int64, truncated to MAX_DIGITS, and their lengths
+
+        Numbers that aren't all digits get a length of 0, so nothing
+        matches them.
+    """
+    numbers = np.asarray(numbers).astype("<U{}".format(MAX_DIGITS))
+    valid = np.char.isdigit(numbers)
+    digits = np.where(valid, np.char.str_len(numbers), 0).astype(np.int64)
+    values = np.where(valid, numbers, "0").astype(np.int64)
+    return values, digits
+
+
+def read_csv(path, column, trial_column=None, org_column=None,
+             chunk_size=CHUNK_SIZE):
+    """ Stream the numbers of a CSV file with a header, chunk_size rows at
+        a time, yields (numbers, is_trial, org_ids) as evaluate() takes them
+    """
+    with open(path, newline="") as source:
+        reader = csv.reader(source)
+        header = next(reader)
+        number = header.index(column)
+        trial = header.index(trial_column) if trial_column else None
+        org = header.index(org_column) if org_column else None
+        while True:
+            rows = [row for _, row in zip(range(chunk_size), reader)]
+            if not rows:
+                return
+            yield (
+                [row[number] for row in rows],
+                [row[trial] for row in rows] if trial is not None else False,
+                [row[org] or None for row in rows] if org is not None
+                else None,
+            )
+
+
+def read_parquet(path, column, trial_column=None, org_column=None,
+                 chunk_size=CHUNK_SIZE):
+    """ Same as read_csv for a parquet file, one record batch at a time """
+    if parquet is None:
+        raise ValueError("Reading parquet files needs pyarrow")
+    columns = [name for name in (column, trial_column, org_column) if name]
+    for batch in parquet.ParquetFile(path).iter_batches(
+            batch_size=chunk_size, columns=columns):
+        data = batch.to_pydict()
+        yield (
+            data[column],
+            data[trial_column] if trial_column else False,
+            data[org_column] if org_column else None,
+        )
+
+
+def count_decisions(decisions):
+    """ The number of allowed, restricted and undecided numbers """
+    counts = np.bincount(decisions + 1, minlength=3)
+    return {
+        "allowed": int(counts[ALLOW + 1]),
+        "restricted": int(counts[RESTRICT + 1]),
+        "no_rule": int(counts[NO_RULE + 1]),
+    }
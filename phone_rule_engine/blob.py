@@ -0,0 +1,129 @@
+# -*- mode: Python; tab-width: 4; indent-tabs-mode: nil; -*-
+# ex: set tabstop=4 :
+# Please do not change the lines above. See PEP 8, PEP 263.
+""" The rules of a tier serialized into a single string
+
+    phone.compile.redis.lua writes one such blob per tier and organization,
+    phone.blob.redis.lua decides with a single GET of each, and local caches
+    decode them with unpack() or look numbers up with longest() directly.
+
+    A blob is MAGIC, the number of sections as two digits, then the length
+    of the prefixes and the number of records of each section, as two and
+    seven digits, longest prefixes first. The sections follow in the same
+    order, each a sorted run of records of the prefix followed by its rule
+    code. Records of a section have the same width and only digits where
+    they differ, so a binary search compares them the same way in Lua and
+    Python. An empty tier has no blob.
+"""
+
+from phone_rule_engine.trie import RULE_CODES, RULES_BY_CODE, decode
+
+MAGIC = "PRT1"
+# longer prefixes don't fit the header, no phone number is that long
+MAX_LENGTH = 99
+SECTION_HEADER = 9
+
+
+def pack(rules, codes=False):
+    """ The blob of a {prefix: rule} dict, rules as keywords, or as codes
+        if codes is set, as in the organization hashes
+
+        Invalid rules and prefixes that aren't all digits are left out, as
+        the lookups ignore them. Returns "" if no rule is left.
+    """
+    sections = {}
+    for prefix, rule in rules.items():
+        prefix = decode(prefix)
+        code = _code(decode(rule), codes)
+        if code is not None and prefix.isdigit() and \
+                len(prefix) <= MAX_LENGTH:
+            sections.setdefault(len(prefix), []).append(prefix + code)
+    if not sections:
+        return ""
+    lengths = sorted(sections, reverse=True)
+    header = [MAGIC, "{:02d}".format(len(lengths))]
+    header.extend(
+        "{:02d}{:07d}".format(length, len(sections[length]))
+        for length in lengths
+    )
+    return "".join(header) + "".join(
+        "".join(sorted(sections[length])) for length in lengths
+    )
+
+
+def _code(rule, codes):
+    """ The rule code of a rule keyword, or of a code if codes is set, None
+        if invalid
+    """
+    if codes:
+        return rule if rule in RULES_BY_CODE else None
+    return RULE_CODES.get(rule)
+
+
+def sections(blob):
+    """ The (length, offset, count) of each section of a blob, longest
+        prefixes first
+
+        Raises ValueError if blob isn't one.
+    """
+    blob = decode(blob) or ""
+    if not blob:
+        return []
+    if not blob.startswith(MAGIC):
+        raise ValueError("Not a rule blob: {!r}".format(blob[:16]))
+    count = int(blob[len(MAGIC):len(MAGIC) + 2])
+    offset = len(MAGIC) + 2 + count * SECTION_HEADER
+    found = []
+    for start in range(len(MAGIC) + 2, offset, SECTION_HEADER):
+        length = int(blob[start:start + 2])
+        records = int(blob[start + 2:start + SECTION_HEADER])
+        found.append((length, offset, records))
+        offset += records * (length + 1)
+    return found
+
+
+def unpack(blob):
+    """ The {prefix: rule} dict of a blob, rules as keywords """
+    blob = decode(blob) or ""
+    rules = {}
+    for length, offset, count in sections(blob):
+        width = length + 1
+        for start in range(offset, offset + count * width, width):
+            rules[blob[start:start + length]] = \
+                RULES_BY_CODE[blob[start + length]]
+    return rules
+
+
+def longest(blob, phone_no):
+    """ The rule with the longest prefix of phone_no in blob
+
+        Returns a (rule, prefix) tuple, (None, None) if there's none.
+        Decodes nothing but the header, use unpack() for many lookups.
+    """
+    blob = decode(blob) or ""
+    for length, offset, count in sections(blob):
+        if length > len(phone_no):
+            continue
+        prefix = phone_no[:length]
+        code = _find(blob, length, offset, count, prefix)
+        if code is not None:
+            return RULES_BY_CODE[code], prefix
+    return None, None
+
+
+def _find(blob, length, offset, count, prefix):
+    """ Binary search a section for prefix, returns its rule code or None
+    """
+    width = length + 1
+    low, high = 0, count - 1
+    while low <= high:
+        middle = (low + high) // 2
+        start = offset + middle * width
+        found = blob[start:start + length]
+        if found == prefix:
+            return blob[start + length]
+        if found < prefix:
+            low = middle + 1
+        else:
+            high = middle - 1
+    return None
@@ -0,0 +1,68 @@
+# -*- mode: Python; tab-width: 4; indent-tabs-mode: nil; -*-
+# ex: set tabstop=4 :
+# Please do not change the lines above. See PEP 8, PEP 263.
+""" Helpers to compute a whole rule set up front, for bulk loading """
+
+from phone_rule_engine.trie import ORG_ENABLE, R_ALLOW, R_RESTRICT
+
+
+def effective_trial_rules(generic, trial):
+    """ The trial rules overlaid on the generic ones
+
+        Same as phone.effective.redis.lua computes incrementally: a generic
+        rule is only effective for trial users if there is no trial rule for
+        it or for any shorter prefix of it.
+    """
+    effective = dict(trial)
+    for prefix, rule in generic.items():
+        if prefix in effective:
+            continue
+        if not any(prefix[:i] in trial for i in range(1, len(prefix))):
+            effective[prefix] = rule
+    return effective
+
+
+def org_fields(org):
+    """ The rules of {org_id: {prefix: rule}} as {org_id:prefix: rule} """
+    return {
+        "{}:{}".format(org_id, prefix): rule
+        for org_id, rules in org.items() for prefix, rule in rules.items()
+    }
+
+
+def legacy_org_rules(fields):
+    """ The rules of the former rules:org hash as {org_id: {prefix: rule}}
+
+        The hash held org_id:prefix fields, and an org_id field set to enable
+        for each organization with rules in use. The rules of organizations
+        without it never applied and are left out.
+    """
+    org = {}
+    for field, rule in fields.items():
+        org_id, _, prefix = field.rpartition(":")
+        if org_id and prefix.isdigit() and rule in (R_ALLOW, R_RESTRICT) \
+                and fields.get(org_id) == ORG_ENABLE:
+            org.setdefault(org_id, {})[prefix] = rule
+    return org
+
+
+def rules_diff(current, new):
+    """ Compare two {prefix: rule} dicts
+
+        Returns a dict with the added and removed rules, and the changed ones
+        as prefix: (current, new).
+    """
+    return {
+        "added": {
+            prefix: rule for prefix, rule in new.items()
+            if prefix not in current
+        },
+        "removed": {
+            prefix: rule for prefix, rule in current.items()
+            if prefix not in new
+        },
+        "changed": {
+            prefix: (current[prefix], rule) for prefix, rule in new.items()
+            if prefix in current and current[prefix] != rule
+        },
+    }
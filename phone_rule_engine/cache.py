@@ -0,0 +1,203 @@
+# -*- mode: Python; tab-width: 4; indent-tabs-mode: nil; -*-
+# ex: set tabstop=4 :
+# Please do not change the lines above. See PEP 8, PEP 263.
+""" Local rule cache kept up to date by the change events from redis """
+
+from collections import OrderedDict
+import json
+import threading
+import time
+
+from phone_rule_engine.trie import RuleTrie, decode, decode_hash, is_trial_flag
+from phone_rule_engine.trie import TIER_GENERIC, TIER_TRIAL, TIER_ORG
+from phone_rule_engine.trie import TIER_ALL
+
+
+class RuleCache(object):
+    """ Serves query_rule from a compiled RuleTrie
+
+        Every write trough RuleOperations bumps the rule version and
+        publishes an event naming the tier (and organization) that changed,
+        the cache reloads only that part. A gap in the versions means events
+        were missed, in which case everything is reloaded.
+    """
+
+    def __init__(self, rule_ops):
+        self.rule_ops = rule_ops
+        self.version = None
+        self.trie = None
+        self._hashes = {TIER_GENERIC: {}, TIER_TRIAL: {}, TIER_ORG: {}}
+
+    def reload(self):
+        """ Load a consistent snapshot of all the rules, from the blobs if
+            the rule operations keep them
+        """
+        if self.rule_ops.blobs:
+            version, generic, trial, orgs = self.rule_ops.load_blobs()
+        else:
+            version, generic, trial, orgs = self.rule_ops.snapshot()
+        self._hashes = {
+            TIER_GENERIC: decode_hash(generic),
+            TIER_TRIAL: decode_hash(trial),
+            TIER_ORG: {
+                org_id: decode_hash(rules) for org_id, rules in orgs.items()
+            },
+        }
+        self._compile(version)
+
+    def reload_tier(self, tier, version):
+        """ Reload the generic or trial tier after the change at version """
+        _, rules = self.rule_ops.load_tier(tier)
+        self._hashes[tier] = decode_hash(rules)
+        self._compile(version)
+
+    def reload_org(self, org_id, version):
+        """ Reload the rules of one organization after the change at version
+        """
+        _, rules = self.rule_ops.load_org(org_id)
+        orgs = dict(self._hashes[TIER_ORG])
+        orgs[org_id] = decode_hash(rules)
+        self._hashes[TIER_ORG] = orgs
+        self._compile(version)
+
+    def _compile(self, version):
+        """ Swap in a freshly compiled trie, queries in flight keep using
+            the previous one
+        """
+        self.trie = RuleTrie.from_hashes(
+            self._hashes[TIER_GENERIC],
+            self._hashes[TIER_TRIAL],
+            self._hashes[TIER_ORG],
+        )
+        self.version = version
+
+    def handle_event(self, message):
+        """ React to a change event published by RuleOperations """
+        event = json.loads(decode(message["data"]))
+        version = event["version"]
+        if self.version is not None and version <= self.version:
+            return
+        if self.version is None or version != self.version + 1 \
+                or event["tier"] == TIER_ALL:
+            self.reload()
+        elif event["tier"] == TIER_ORG:
+            self.reload_org(event["org_id"], version)
+        else:
+            self.reload_tier(event["tier"], version)
+
+    def refresh_if_stale(self):
+        """ Reload everything if the version in redis moved on
+
+            A safety net for when the pub/sub connection was interrupted.
+            Returns True if a reload was needed.
+        """
+        if self.rule_ops.get_version() == self.version:
+            return False
+        self.reload()
+        return True
+
+    def subscribe(self, sleep_time=0.1):
+        """ Subscribe to the change events and load the rules
+
+            Returns the thread processing the events, call stop() on it to
+            unsubscribe. The rules are loaded after subscribing so that no
+            change is missed in between.
+        """
+        pubsub = self.rule_ops.redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{self.rule_ops.changes_channel: self.handle_event})
+        self.reload()
+        return pubsub.run_in_thread(sleep_time=sleep_time)
+
+    def query_rule(self, phone_no, is_trial=False, org_id=None):
+        """ Same contract as RuleOperations.query_rule """
+        if self.trie is None:
+            self.reload()
+        return self.trie.query_rule(phone_no, is_trial, org_id)
+
+
+class DecisionCache(object):
+    """ Remembers the decisions of RuleOperations.query_rule
+
+        Bounded to the max_size most recently used decisions, each kept for
+        at most ttl seconds. Every decision is dropped when the rules change:
+        subscribe() follows the change events of RuleOperations, the ttl
+        only limits how long a decision outlives a missed event. Safe to
+        share between the threads of a worker.
+    """
+
+    def __init__(self, rule_ops, max_size=10000, ttl=60, clock=time.monotonic):
+        self.rule_ops = rule_ops
+        self.max_size = max_size
+        self.ttl = ttl
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self._clock = clock
+        self._decisions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def query_rule(self, phone_no, is_trial=False, org_id=None):
+        """ Same contract as RuleOperations.query_rule """
+        key = self._key(phone_no, is_trial, org_id)
+        now = self._clock()
+        with self._lock:
+            cached = self._decisions.get(key)
+            if cached is not None and cached[0] > now:
+                self._decisions.move_to_end(key)
+                self.hits += 1
+                return cached[1]
+            self.misses += 1
+            version = self.version
+        # queried as keyed, so every form of a number gets the same answer
+        decision = self.rule_ops.query_rule(*key)
+        with self._lock:
+            # a change event arrived during the query, the decision might
+            # be from before it
+            if version == self.version:
+                self._decisions[key] = (now + self.ttl, decision)
+                self._decisions.move_to_end(key)
+                while len(self._decisions) > self.max_size:
+                    self._decisions.popitem(last=False)
+        return decision
+
+    @staticmethod
+    def _key(phone_no, is_trial, org_id):
+        """ Calls that query_rule decides the same share a key, the
+            normalized (phone_no, is_trial, org_id) they are queried with
+        """
+        if phone_no.startswith("+"):
+            phone_no = phone_no[1:]
+        return phone_no, is_trial_flag(is_trial), org_id or None
+
+    def stats(self):
+        """ The hit and miss counters and the number of cached decisions """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._decisions),
+                "version": self.version,
+            }
+
+    def invalidate(self, version=None):
+        """ Drop every decision, version is that of the rules from now on """
+        with self._lock:
+            self._decisions.clear()
+            self.version = version
+
+    def handle_event(self, message):
+        """ React to a change event published by RuleOperations """
+        version = json.loads(decode(message["data"]))["version"]
+        if self.version is None or version > self.version:
+            self.invalidate(version)
+
+    def subscribe(self, sleep_time=0.1):
+        """ Subscribe to the change events
+
+            Returns the thread processing the events, call stop() on it to
+            unsubscribe.
+        """
+        pubsub = self.rule_ops.redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{self.rule_ops.changes_channel: self.handle_event})
+        self.invalidate(self.rule_ops.get_version())
+        return pubsub.run_in_thread(sleep_time=sleep_time)
@@ -0,0 +1,59 @@
+# -*- mode: Python; tab-width: 4; indent-tabs-mode: nil; -*-
+# ex: set tabstop=4 :
+# Please do not change the lines above. See PEP 8, PEP 263.
+""" Explanations of the decisions, see RuleOperations.explain_rule """
+
+from collections import namedtuple
+
+from phone_rule_engine.trie import R_ALLOW, decode
+
+# a rule matching a phone number
+RuleMatch = namedtuple("RuleMatch", ("tier", "prefix", "rule"))
+
+Explanation = namedtuple("Explanation", (
+    # True, False or None, as query_rule returns
+    "decision",
+    # the tier and prefix of the deciding rule, None if there's none
+    "tier",
+    "prefix",
+    # the RuleMatch of each lower tier the deciding rule takes precedence over
+    "shadowed",
+))
+
+
+def explanation(matches):
+    """ The Explanation from the rules matching a number, in the order of
+        precedence of their tiers
+    """
+    if not matches:
+        return Explanation(None, None, None, ())
+    deciding = matches[0]
+    return Explanation(
+        deciding.rule == R_ALLOW, deciding.tier, deciding.prefix,
+        tuple(matches[1:])
+    )
+
+
+def decode_matches(matches):
+    """ The RuleMatch tuples of the matches the explain script returned """
+    return [
+        RuleMatch(decode(tier), decode(prefix), decode(rule))
+        for tier, prefix, rule in matches
+    ]
+
+
+def group_by_prefix(numbers, explanations, decision=False):
+    """ Group the numbers by the rule that decided them
+
+        numbers and explanations are in the same order, as passed to and
+        returned by explain_rules_many. Only the numbers with the given
+        decision are grouped, the restricted ones by default. Returns
+        {(tier, prefix): [number, ...]}.
+    """
+    groups = {}
+    for number, explained in zip(numbers, explanations):
+        if explained.decision is decision and explained.tier is not None:
+            groups.setdefault(
+                (explained.tier, explained.prefix), []
+            ).append(number)
+    return groups
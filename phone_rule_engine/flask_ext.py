@@ -0,0 +1,186 @@
+# -*- mode: Python; tab-width: 4; indent-tabs-mode: nil; -*-
+# ex: set tabstop=4 :
+# Please do not change the lines above. See PEP 8, PEP 263.
+""" Flask extension serving the rules from a warmed up RuleOperations """
+
+import logging
+
+from flask import jsonify
+from flask import Response
+import redis
+from redis.exceptions import RedisError
+
+from phone_rule_engine import RuleOperations
+from phone_rule_engine.cache import DecisionCache, RuleCache
+from phone_rule_engine.metrics import RuleMetrics, CONTENT_TYPE
+
+logger = logging.getLogger(__name__)
+
+CACHE_NONE = "none"
+# remember the decisions of recently dialed numbers, see DecisionCache
+CACHE_DECISIONS = "decisions"
+# keep all the rules in process, see RuleCache
+CACHE_RULES = "rules"
+
+DEFAULT_CONFIG = {
+    "REDIS_URL": "redis://localhost:6379/0",
+    "PHONE_RULES_KEY_PREFIX": "",
+    # connections per worker, requests wait up to the pool timeout for one
+    # once they are all in use
+    "PHONE_RULES_POOL_SIZE": 20,
+    "PHONE_RULES_POOL_TIMEOUT": 5,
+    # connections opened by warm(), so the first requests don't pay for
+    # the connection setup
+    "PHONE_RULES_POOL_PRELOAD": 4,
+    "PHONE_RULES_SOCKET_KEEPALIVE": True,
+    "PHONE_RULES_SOCKET_TIMEOUT": 5,
+    "PHONE_RULES_CACHE": CACHE_NONE,
+    "PHONE_RULES_DECISION_CACHE_SIZE": 10000,
+    "PHONE_RULES_DECISION_CACHE_TTL": 60,
+    # warm up from init_app, set to False when the app is loaded before the
+    # workers fork and call warm() in each worker instead
+    "PHONE_RULES_WARM_ON_INIT": True,
+    "PHONE_RULES_READY_URL": "/ready",
+    # time the queries and trace one in every PHONE_RULES_TRACE_EVERY of
+    # them, served in the Prometheus text format
+    "PHONE_RULES_METRICS": False,
+    "PHONE_RULES_TRACE_EVERY": 100,
+    "PHONE_RULES_METRICS_URL": "/metrics",
+    # decide from the blobs of the tiers, see RuleOperations.compile_blobs
+    "PHONE_RULES_BLOBS": False,
+}
+# any number will do, the query only makes sure the rule path is hot
+PROBE_NUMBER = "0"
+
+
+class FlaskRuleEngine(object):
+    """ Gives a Flask app a RuleOperations with its own connection pool
+
+        warm() opens connections of the pool, loads the scripts and the
+        configured local cache, then runs a probe query. The readiness
+        endpoint answers 503 until that succeeded, retrying it on every
+        probe, so a load balancer only sends traffic to hot workers.
+    """
+
+    def __init__(self, app=None):
+        self.redis = None
+        self.rule_ops = None
+        self.cache = None
+        self.metrics = None
+        self.ready = False
+        self._config = None
+        self._events = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        for key, value in DEFAULT_CONFIG.items():
+            app.config.setdefault(key, value)
+        self._config = app.config
+        self.redis = self._client(app.config)
+        if app.config["PHONE_RULES_METRICS"]:
+            self.metrics = RuleMetrics(
+                trace_every=int(app.config["PHONE_RULES_TRACE_EVERY"])
+            )
+            app.add_url_rule(
+                app.config["PHONE_RULES_METRICS_URL"], "phone_rules_metrics",
+                self.render_metrics
+            )
+        self.rule_ops = RuleOperations(
+            self.redis, app.config["PHONE_RULES_KEY_PREFIX"],
+            metrics=self.metrics, blobs=app.config["PHONE_RULES_BLOBS"]
+        )
+        self.cache = self._cache(app.config)
+        app.extensions["phone_rules"] = self
+        app.add_url_rule(
+            app.config["PHONE_RULES_READY_URL"], "phone_rules_ready",
+            self.readiness
+        )
+        if app.config["PHONE_RULES_WARM_ON_INIT"]:
+            self.warm()
+
+    @staticmethod
+    def _client(config):
+        """ A client with a bounded pool of kept alive connections """
+        pool = redis.BlockingConnectionPool.from_url(
+            config["REDIS_URL"],
+            max_connections=config["PHONE_RULES_POOL_SIZE"],
+            timeout=config["PHONE_RULES_POOL_TIMEOUT"],
+            socket_keepalive=config["PHONE_RULES_SOCKET_KEEPALIVE"],
+            socket_timeout=config["PHONE_RULES_SOCKET_TIMEOUT"],
+        )
+        return redis.StrictRedis(connection_pool=pool)
+
+    def _cache(self, config):
+        """ The configured local cache, if any """
+        kind = config["PHONE_RULES_CACHE"]
+        if kind == CACHE_DECISIONS:
+            return DecisionCache(
+                self.rule_ops,
+                max_size=int(config["PHONE_RULES_DECISION_CACHE_SIZE"]),
+                ttl=float(config["PHONE_RULES_DECISION_CACHE_TTL"])
+            )
+        if kind == CACHE_RULES:
+            return RuleCache(self.rule_ops)
+        if kind == CACHE_NONE:
+            return None
+        raise ValueError("Unknown PHONE_RULES_CACHE: {}".format(kind))
+
+    def query_rule(self, phone_no, is_trial=False, org_id=None):
+        """ Same contract as RuleOperations.query_rule, answered by the
+            local cache if there is one
+        """
+        if self.cache is not None:
+            return self.cache.query_rule(phone_no, is_trial, org_id)
+        return self.rule_ops.query_rule(phone_no, is_trial, org_id)
+
+    def warm(self):
+        """ Get the rule path hot, returns True once it is
+
+            Errors talking to redis are logged, warm() can be called again.
+        """
+        if self.ready:
+            return True
+        try:
+            self._open_connections(self._config["PHONE_RULES_POOL_PRELOAD"])
+            self.rule_ops.warmup()
+            if self.cache is not None and self._events is None:
+                self._events = self.cache.subscribe()
+            self.rule_ops.query_rule(PROBE_NUMBER)
+        except RedisError as error:
+            logger.warning("Rule engine not ready yet: %s", error)
+            return False
+        self.ready = True
+        return True
+
+    def _open_connections(self, count):
+        """ Connect count connections of the pool and return them to it """
+        pool = self.redis.connection_pool
+        connections = []
+        try:
+            for _ in range(count):
+                connection = pool.get_connection("PING")
+                connections.append(connection)
+                connection.connect()
+        finally:
+            for connection in connections:
+                pool.release(connection)
+
+    def readiness(self):
+        """ The readiness endpoint: 200 once warm, 503 until then """
+        if not self.warm():
+            return jsonify({"ready": False}), 503
+        return jsonify({"ready": True, "script": self.rule_ops.script_sha})
+
+    def render_metrics(self):
+        """ The metrics endpoint """
+        return Response(self.metrics.render(), content_type=CONTENT_TYPE)
+
+    def close(self):
+        """ Stop following the change events and close the connections """
+        if self._events is not None:
+            self._events.stop()
+            self._events.join()
+            self._events = None
+        self.redis.connection_pool.disconnect()
+        self.ready = False
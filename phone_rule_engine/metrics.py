@@ -0,0 +1,130 @@
+# -*- mode: Python; tab-width: 4; indent-tabs-mode: nil; -*-
+# ex: set tabstop=4 :
+# Please do not change the lines above. See PEP 8, PEP 263.
+""" Client side metrics of the rule lookups, in the Prometheus text format """
+
+from collections import namedtuple
+import itertools
+import threading
+
+# seconds
+LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1
+)
+# rule fields read by the script
+PROBE_BUCKETS = (0, 1, 2, 4, 8, 16, 32)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+DecisionTrace = namedtuple("DecisionTrace", (
+    # True, False or None, as query_rule returns
+    "decision",
+    # the tier that decided: org, trial, generic or None
+    "tier",
+    # the prefix of the deciding rule or None
+    "prefix",
+    # the rule fields the script read
+    "probes",
+    # spent deciding in redis, and on the whole call
+    "server_seconds",
+    "seconds",
+))
+
+
+class Histogram(object):
+    """ Counts observations into cumulative buckets """
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+    def samples(self, name):
+        """ The lines of the histogram in the text format """
+        lines = [
+            '{}_bucket{{le="{}"}} {}'.format(name, bound, count)
+            for bound, count in zip(self.buckets, self.counts)
+        ]
+        lines.append('{}_bucket{{le="+Inf"}} {}'.format(name, self.count))
+        lines.append("{}_sum {}".format(name, self.sum))
+        lines.append("{}_count {}".format(name, self.count))
+        return lines
+
+
+class RuleMetrics(object):
+    """ Latency histograms and decision traces of RuleOperations
+
+        Every query_rule call is timed. One in every trace_every calls is
+        run as a trace, recording the tier that decided, the rules fields
+        read and the time spent in redis, 0 disables the sampling. Traces
+        asked for with trace_rule are recorded as well. Safe to share
+        between threads.
+    """
+
+    def __init__(self, trace_every=100, namespace="phone_rules"):
+        self.trace_every = trace_every
+        self.namespace = namespace
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.traced_latency = Histogram(LATENCY_BUCKETS)
+        self.server_latency = Histogram(LATENCY_BUCKETS)
+        self.probes = Histogram(PROBE_BUCKETS)
+        self.decisions = {}
+        self._calls = itertools.count()
+        self._lock = threading.Lock()
+
+    def sampled(self):
+        """ True if the next query is to be traced """
+        return bool(self.trace_every) and \
+            next(self._calls) % self.trace_every == 0
+
+    def observe(self, seconds):
+        """ Record the latency of a query """
+        with self._lock:
+            self.latency.observe(seconds)
+
+    def observe_trace(self, trace):
+        """ Record a DecisionTrace """
+        key = (trace.tier or "none", {
+            True: "allow", False: "restrict"
+        }.get(trace.decision, "none"))
+        with self._lock:
+            self.latency.observe(trace.seconds)
+            self.traced_latency.observe(trace.seconds)
+            self.server_latency.observe(trace.server_seconds)
+            self.probes.observe(trace.probes)
+            self.decisions[key] = self.decisions.get(key, 0) + 1
+
+    def render(self):
+        """ All the metrics in the Prometheus text exposition format """
+        name = (self.namespace + "_{}").format
+        lines = []
+        with self._lock:
+            for metric, histogram, text in (
+                    ("query_seconds", self.latency,
+                     "Client side latency of the rule queries"),
+                    ("traced_query_seconds", self.traced_latency,
+                     "Client side latency of the traced rule queries"),
+                    ("traced_server_seconds", self.server_latency,
+                     "Time the traced rule queries spent deciding in redis"),
+                    ("traced_probes", self.probes,
+                     "Rule fields read by the traced rule queries")):
+                lines.append("# HELP {} {}".format(name(metric), text))
+                lines.append("# TYPE {} histogram".format(name(metric)))
+                lines.extend(histogram.samples(name(metric)))
+            metric = name("traced_decisions_total")
+            lines.append(
+                "# HELP {} Traced rule queries by deciding tier".format(metric)
+            )
+            lines.append("# TYPE {} counter".format(metric))
+            for (tier, decision), count in sorted(self.decisions.items()):
+                lines.append('{}{{tier="{}",decision="{}"}} {}'.format(
+                    metric, tier, decision, count
+                ))
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,28 @@
+--[[--
+-- Decide on a phone number from the rule blobs, see phone.compile.redis.lua
+--
+-- Same arguments and answer as phone.redis.lua, but tracing. Every tier is
+-- read with a single GET of its blob.
+--]]--
+local phone_no=ARGV[1]
+local isTrial=(string.upper(ARGV[2]) == 'TRUE')
+local org_id=ARGV[3]
+log_enabled=(ARGV[4] == '1')
+stats_weight=tonumber(ARGV[5]) or 0
+
+local blob_keys={
+    generic=KEYS[1],
+    trial=KEYS[2],
+    effective_trial=KEYS[3],
+    org=KEYS[4]
+}
+stats_key=KEYS[5]
+
+if log_enabled then
+    redis.log(redis.LOG_NOTICE,
+        'called with blobs:', blob_keys.generic, blob_keys.effective_trial,
+        'and arguments:', phone_no, isTrial, org_id
+    )
+end
+
+return (decide_and_count(blob_keys, phone_no, isTrial, org_id, decide_blobs))
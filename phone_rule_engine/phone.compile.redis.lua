@@ -0,0 +1,65 @@
+--[[--
+-- Serialize rule hashes into the blobs phone.blob.redis.lua decides with
+--
+-- Each blob is the header of the sections, one per prefix length, longest
+-- first, then the sorted records of each section: the prefix followed by the
+-- rule code. See phone_rule_engine/blob.py for the layout, this writes the
+-- same bytes as its pack(). Invalid rules and prefixes that aren't all digits
+-- are left out, an empty hash deletes the blob.
+--
+-- KEYS: pairs of a rule hash ( of a tier, the effective trial rules or an
+--   organization ) and the key of its blob
+-- ARGV: for each pair, '1' if the hash holds the rule codes of an
+--   organization, '0' if rule keywords
+-- @Returns: the number of rules written to each blob
+--]]--
+local MAGIC = 'PRT1'
+local MAX_LENGTH = 99
+local keyword_codes = {allow='a', restrict='r'}
+local org_codes = {a='a', r='r'}
+
+local compile = function(rules_key, blob_key, codes)
+    local sections = {}
+    local lengths = {}
+    local written = 0
+    local rules = redis.call('HGETALL', rules_key)
+    for i=1, #rules, 2 do
+        local prefix = rules[i]
+        local code = codes[rules[i + 1]]
+        local length = string.len(prefix)
+        if code and length <= MAX_LENGTH and string.find(prefix, '^%d+$') then
+            if not sections[length] then
+                sections[length] = {}
+                lengths[#lengths + 1] = length
+            end
+            local records = sections[length]
+            records[#records + 1] = prefix .. code
+            written = written + 1
+        end
+    end
+    if written == 0 then
+        redis.call('DEL', blob_key)
+        return 0
+    end
+    table.sort(lengths, function(a, b) return a > b end)
+    local header = {MAGIC, string.format('%02d', #lengths)}
+    local data = {}
+    for _, length in ipairs(lengths) do
+        local records = sections[length]
+        -- records of a section only differ in digits, any collation sorts
+        -- them by bytes
+        table.sort(records)
+        header[#header + 1] = string.format('%02d%07d', length, #records)
+        data[#data + 1] = table.concat(records)
+    end
+    redis.call('SET', blob_key, table.concat(header) .. table.concat(data))
+    return written
+end
+
+local written = {}
+for i=1, #KEYS, 2 do
+    local codes = keyword_codes
+    if ARGV[(i + 1) / 2] == '1' then codes = org_codes end
+    written[#written + 1] = compile(KEYS[i], KEYS[i + 1], codes)
+end
+return written
@@ -0,0 +1,34 @@
+--[[--
+-- Delete rules of an organisation
+--
+-- Redis drops the hash of the organisation with its last rule, the
+-- organisation is then removed from the set of organisations with rules as
+-- well, so its users are decided by the trial and generic rules only.
+--
+-- KEYS[1]: the rule hash of the organisation
+-- KEYS[2]: the set of the organisations with rules, left out in cluster mode
+--   where it is on another slot and the caller has to update it
+-- ARGV[1]: the organisation id
+-- ARGV[2..]: the prefixes to delete, none to delete all the rules
+-- @Returns: the rules that were deleted, as HMGET of the prefixes or as
+--   HGETALL when deleting all of them, and the number of rules left
+--]]--
+local org_key=KEYS[1]
+local orgs_key=KEYS[2]
+local org_id=ARGV[1]
+
+local previous
+if #ARGV > 1 then
+    local prefixes = {unpack(ARGV, 2)}
+    previous = redis.call('HMGET', org_key, unpack(prefixes))
+    redis.call('HDEL', org_key, unpack(prefixes))
+else
+    previous = redis.call('HGETALL', org_key)
+    redis.call('DEL', org_key)
+end
+
+local left = redis.call('HLEN', org_key)
+if left == 0 and orgs_key then
+    redis.call('SREM', orgs_key, org_id)
+end
+return {previous, left}
@@ -0,0 +1,50 @@
+--[[--
+-- Delete rules of a tier and rebuild its prefix length and stems indexes
+--
+-- The indexes only ever grow while rules are pushed, after a delete they are
+-- rebuilt from the rules left, so the lookups stop probing lengths and stems
+-- no rule uses anymore. Rebuilding reads every rule of the tier, fine for the
+-- occasional delete.
+--
+-- KEYS: the rule hash of a tier (or the effective trial rules), its prefix
+--   length and stems indexes
+-- ARGV: the prefixes to delete, none to only rebuild the indexes
+-- @Returns: the rules that were deleted, false for prefixes without one
+--]]--
+local rules_key=KEYS[1]
+local lengths_key=KEYS[2]
+local stems_key=KEYS[3]
+
+local previous = {}
+if #ARGV > 0 then
+    previous = redis.call('HMGET', rules_key, unpack(ARGV))
+    redis.call('HDEL', rules_key, unpack(ARGV))
+end
+
+redis.call('DEL', lengths_key, stems_key)
+local lengths = {}
+local stems = {}
+for _, field in ipairs(redis.call('HKEYS', rules_key)) do
+    local length = string.len(field)
+    if not lengths[length] then
+        lengths[length] = true
+        redis.call('ZADD', lengths_key, length, length)
+    end
+    for i=0, length do
+        stems[string.sub(field, 1, i)] = true
+    end
+end
+local fields = {}
+for stem, _ in pairs(stems) do
+    fields[#fields + 1] = stem
+    fields[#fields + 1] = 1
+    -- keeps the arguments of a single call well below the Lua stack limit
+    if #fields >= 1000 then
+        redis.call('HMSET', stems_key, unpack(fields))
+        fields = {}
+    end
+end
+if #fields > 0 then
+    redis.call('HMSET', stems_key, unpack(fields))
+end
+return previous
@@ -0,0 +1,186 @@
+--[[--
+-- Maintain the effective trial rules: the trial rules overlaid on the generic ones
+--
+-- Trial users are decided by the trial rules first and only fall back to the
+-- generic ones if no trial prefix matches, so a generic rule is only effective
+-- for trial users if there is no trial rule for it or for any shorter prefix
+-- of it. With that, the longest prefix in the effective hash gives the same
+-- decision as walking the trial and then the generic rules.
+--
+-- KEYS: the generic, trial and effective trial rule hashes, the prefix length
+--   and stems indexes of the effective trial rules, and the stems indexes of the
+--   generic and trial rules
+-- ARGV: the prefixes that changed, the effective rules are recomputed for them
+--   and for all the more specific prefixes. '' rebuilds everything.
+--
+-- The more specific prefixes are found by walking the stems indexes down from
+-- each changed prefix, so a single rule write only reads the rules under it.
+-- Only a rebuild of everything reads every field of the hashes.
+--
+-- Stems of removed rules are left in place, they only make lookups check more
+-- prefixes than needed until the next rebuild.
+--]]--
+local generic_rules=KEYS[1]
+local trial_rules=KEYS[2]
+local effective_rules=KEYS[3]
+local effective_lengths=KEYS[4]
+local effective_stems=KEYS[5]
+local generic_stems=KEYS[6]
+local trial_stems=KEYS[7]
+local changed = {}
+local everything = false
+for _, prefix in ipairs(ARGV) do
+    changed[prefix] = true
+    if prefix == '' then
+        everything = true
+    end
+end
+
+if everything then
+    redis.call('DEL', effective_stems)
+end
+
+local valid = function(rule)
+    if rule == 'allow' or rule == 'restrict' then
+        return rule
+    end
+    return nil
+end
+
+local add_stems = function(prefix)
+    --[[--
+    -- Record prefix and all its prefixes, including the empty one, as stems
+    --]]--
+    local stems = {'', 1}
+    for i=1, string.len(prefix) do
+        stems[#stems + 1] = string.sub(prefix, 1, i)
+        stems[#stems + 1] = 1
+    end
+    redis.call('HMSET', effective_stems, unpack(stems))
+end
+
+local is_changed = function(field)
+    --[[--
+    -- @Returns: true if field or any prefix of it changed
+    --]]--
+    if everything then
+        return true
+    end
+    for i=1, string.len(field) do
+        if changed[string.sub(field, 1, i)] then
+            return true
+        end
+    end
+    return false
+end
+
+local has_trial_ancestor = function(prefix)
+    --[[--
+    -- @Returns: true if there's a valid trial rule for any prefix of prefix
+    --]]--
+    local ancestors = {}
+    for i=1, string.len(prefix) do
+        ancestors[i] = string.sub(prefix, 1, i)
+    end
+    local rules = redis.call('HMGET', trial_rules, unpack(ancestors))
+    for i=1, #ancestors do
+        if valid(rules[i]) then
+            return true
+        end
+    end
+    return false
+end
+
+-- children probed by a single HMGET, keeps the arguments well below the Lua
+-- stack limit
+local CHILDREN_PER_CALL = 1000
+
+local stems_under = function(stems_key, prefix, add)
+    --[[--
+    -- Call add with prefix and every stem under it, level by level
+    --
+    -- @Returns: false if there's no stems index, as for rules written before
+    --   the index existed
+    --]]--
+    if redis.call('HEXISTS', stems_key, '') == 0 then
+        return false
+    end
+    local level = {}
+    if redis.call('HEXISTS', stems_key, prefix) == 1 then
+        level[1] = prefix
+    end
+    while #level > 0 do
+        local children = {}
+        for _, stem in ipairs(level) do
+            add(stem)
+            for digit=0, 9 do
+                children[#children + 1] = stem .. digit
+            end
+        end
+        level = {}
+        for start=1, #children, CHILDREN_PER_CALL do
+            local chunk = {}
+            for i=start, math.min(start + CHILDREN_PER_CALL - 1, #children) do
+                chunk[#chunk + 1] = children[i]
+            end
+            local found = redis.call('HMGET', stems_key, unpack(chunk))
+            for i=1, #chunk do
+                if found[i] then
+                    level[#level + 1] = chunk[i]
+                end
+            end
+        end
+    end
+    return true
+end
+
+-- all the fields that might be affected, sorted so that the writes are
+-- deterministic
+local seen = {}
+local fields = {}
+local add = function(field)
+    if not seen[field] then
+        seen[field] = true
+        fields[#fields + 1] = field
+    end
+end
+local indexes = {
+    {generic_rules, generic_stems},
+    {trial_rules, trial_stems},
+    {effective_rules, effective_stems},
+}
+for _, index in ipairs(indexes) do
+    local rules_key, stems_key = index[1], index[2]
+    local walked = not everything
+    if walked then
+        for prefix, _ in pairs(changed) do
+            walked = stems_under(stems_key, prefix, add) and walked
+        end
+    end
+    if not walked then
+        for _, field in ipairs(redis.call('HKEYS', rules_key)) do
+            if is_changed(field) then
+                add(field)
+            end
+        end
+    end
+end
+table.sort(fields)
+
+for _, field in ipairs(fields) do
+    local rule = valid(redis.call('HGET', trial_rules, field))
+    if rule == nil then
+        rule = valid(redis.call('HGET', generic_rules, field))
+        if rule ~= nil and has_trial_ancestor(field) then
+            rule = nil
+        end
+    end
+    if rule ~= nil then
+        redis.call('HSET', effective_rules, field, rule)
+        redis.call('ZADD', effective_lengths, string.len(field), string.len(field))
+        add_stems(field)
+    else
+        redis.call('HDEL', effective_rules, field)
+    end
+end
+return #fields
@@ -0,0 +1,53 @@
+--[[--
+-- Explain the decisions on a batch of phone numbers
+--
+-- ARGV starts with the logging flag and a stats weight that is ignored,
+-- followed by (phone_no, isTrial, org_id) triplets as for
+-- phone.many.redis.lua. Returns for each number the rules matching it, at most
+-- one per tier, in order of precedence: organisation, trial and generic. The
+-- first one decides, the others are shadowed by it. Each rule is an array of
+-- the tier, the prefix and the rule keyword. Nothing is counted in the stats.
+-- The keys are those of phone.many.redis.lua.
+--]]--
+local rule_keys={
+    generic=KEYS[1],
+    trial=KEYS[2],
+    generic_lengths=KEYS[6],
+    generic_stems=KEYS[8]
+}
+log_enabled=(ARGV[1] == '1')
+local org_keys = org_keys_of(10)
+
+local explain = function(phone_no, isTrial, org_id)
+    --[[--
+    -- @Returns: The array of rules matching the phone number
+    --]]--
+    local matches = {}
+    local add = function(tier, rule, prefix)
+        if rule ~= nil then
+            matches[#matches + 1] = {tier, prefix, rule}
+        end
+    end
+    if org_id ~= '' then
+        add('org', longest_rule(
+            org_keys[org_id], prefixes_of(phone_no, {}), true
+        ))
+    end
+    -- the trial rules themselves rather than the effective ones, those have
+    -- the generic rules overlaid
+    if isTrial then
+        add('trial', longest_rule(rule_keys.trial, prefixes_of(phone_no, {})))
+    end
+    add('generic', longest_rule(
+        rule_keys.generic,
+        candidates(phone_no, rule_keys.generic_lengths, rule_keys.generic_stems)
+    ))
+    return matches
+end
+
+local explanations = {}
+for i=3, #ARGV, 3 do
+    local isTrial=(string.upper(ARGV[i + 1]) == 'TRUE')
+    explanations[#explanations + 1] = explain(ARGV[i], isTrial, ARGV[i + 2])
+end
+return explanations
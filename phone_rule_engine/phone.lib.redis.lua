@@ -0,0 +1,551 @@
+-- Functions shared by the rule scripts, RuleOperations prepends this to each
+-- of them when loading.
+
+-- Set by the calling script from ARGV. Logging is off unless asked for on
+-- the call, building the messages costs CPU in the redis event loop on every
+-- decision.
+local log_enabled = false
+-- Decisions and warnings are counted in the stats hash, but only when the
+-- client samples the call, incrementing by the sampling interval.
+local stats_key = nil
+local stats_weight = 0
+-- Set by the calling script when the client asked for a trace of the
+-- decision, the rule fields read are counted either way.
+local trace_enabled = false
+local probes = 0
+
+local count = function(field)
+    --[[--
+    -- Increment a counter in the stats hash if this call is sampled
+    --
+    -- @Parameter: field
+    --    The name of the counter
+    --]]--
+    if stats_weight > 0 then
+        redis.call('HINCRBY', stats_key, field, stats_weight)
+    end
+end
+
+-- organisation rules are stored as a single character
+local rules_by_code = {a='allow', r='restrict'}
+
+local rule_allows = function(rule) 
+    return rule == 'allow'
+end
+local rule_restricts = function(rule) 
+    return rule == 'restrict'
+end
+
+local valid_rule = function(key, field, prefix_rule)
+    --[[--
+    -- Validate a rule read from redis 
+    --
+    -- Will also log a debug message if a rule is found and logging is enabled.
+    -- Any value other than the 'allow' and 'restrict' keywords is ignored with  
+    -- a warning.
+    --
+    -- @Parameter: key
+    --    The key of a redis hash
+    -- @Parameter: field 
+    --    The field in the redis hash denoted by key
+    -- @Parameter: prefix_rule 
+    --    The value redis returned for the field, false if there's none
+    -- @Returns: 
+    --    'allow' or 'restrict' if there is a specific rule at key and field or nil otherwhise
+    --]]--
+    if prefix_rule  then
+        if log_enabled then
+            redis.log(redis.LOG_DEBUG, 
+                'Found rule for key:', key, 'prefix:', field, ' policy is', string.upper(prefix_rule)
+            )
+        end
+        if rule_allows(prefix_rule) or rule_restricts(prefix_rule) then
+            return prefix_rule
+        else 
+            count('warn:invalid_rule')
+            if log_enabled then
+                redis.log(redis.LOG_WARNING, 
+                    'Invalid keyword for rule key:', key, 'prefix:', field, ' was ', prefix_rule,
+                    'but expected one of "allow" or "restrict"'
+                ) 
+            end
+            return nil
+        end
+    end
+    return nil
+end
+
+-- the prefix lengths in use read from the indexes, once per script call
+local lengths_cache = {}
+
+local lengths_of = function(index_key)
+    --[[--
+    -- Read the prefix lengths in use from an index
+    --
+    -- The index of a tier is a sorted set of the lengths scored by the length.
+    --
+    -- @Parameter: index_key
+    --  The key of the sorted set
+    -- @Returns: The array of lengths, longest first
+    --]]--
+    local lengths = lengths_cache[index_key]
+    if lengths ~= nil then 
+        return lengths
+    end
+    lengths = {}
+    for i, length in ipairs(redis.call('ZREVRANGE', index_key, 0, -1)) do 
+        lengths[i] = tonumber(length)
+    end
+    lengths_cache[index_key] = lengths
+    return lengths
+end
+
+local stem_depth = function(stems_key, phone_no)
+    --[[--
+    -- Find how many digits of the phone number some rule starts with
+    --
+    -- The stems index of a tier is a hash with a field for every prefix of every rule,
+    -- including the empty one, so a single HMGET tells where the rules under the phone 
+    -- number run out. If nothing starts with '40', no '40...' number has a rule longer 
+    -- than one digit.
+    --
+    -- @Parameter: stems_key
+    --  The key of the stems hash
+    -- @Parameter: phone_no
+    --  The phone number to look up
+    -- @Returns: The length of the longest prefix of the phone number that is a stem, or 
+    --  nil if there's no index, as for rules written before the index existed
+    --]]--
+    local fields = {''}
+    for i=1, string.len(phone_no) do 
+        fields[i + 1] = string.sub(phone_no, 1, i)
+    end
+    local stems = redis.call('HMGET', stems_key, unpack(fields))
+    if not stems[1] then 
+        return nil
+    end
+    local depth = 0
+    while stems[depth + 2] do 
+        depth = depth + 1
+    end
+    return depth
+end
+
+local prefixes_of = function(phone_no, lengths, depth)
+    --[[--
+    -- Generate the prefixes of the phone number that have a length in use, starting from 
+    -- the longest.
+    --
+    -- Every length is used if the index is empty, as for rules written before the index
+    -- existed.
+    --
+    -- @Parameter: phone_no
+    --  The phone number to generate the prefixes from
+    -- @Parameter: lengths
+    --  The prefix lengths in use, longest first
+    -- @Parameter: depth
+    --  Only prefixes up to this length are generated, nil for no limit
+    -- @Returns: The array of prefixes, longest first
+    --]]--
+    local prefixes = {}
+    local max_length = string.len(phone_no)
+    if depth ~= nil and depth < max_length then 
+        max_length = depth
+    end
+    if #lengths == 0 then 
+        for i=max_length, 1, -1 do 
+            prefixes[#prefixes + 1] = string.sub(phone_no, 1, i)
+        end
+        return prefixes
+    end
+    for _, length in ipairs(lengths) do 
+        if length <= max_length then 
+            prefixes[#prefixes + 1] = string.sub(phone_no, 1, length)
+        end
+    end
+    return prefixes
+end
+
+local candidates = function(phone_no, lengths_key, stems_key)
+    --[[--
+    -- The prefixes of the phone number a rule of the tier might be found at
+    --
+    -- The stems index is checked first, most numbers have no rule and are ruled out 
+    -- after the first digits without reading the lengths index or the rules.
+    --
+    -- @Returns: The array of prefixes, longest first, and the depth found by
+    --   stem_depth
+    --]]--
+    local depth = stem_depth(stems_key, phone_no)
+    if depth == 0 then 
+        return {}, depth
+    end
+    return prefixes_of(phone_no, lengths_of(lengths_key), depth), depth
+end
+
+local longest_rule = function(key, fields, codes)
+    --[[--
+    -- Fetch all the candidate fields of a tier with a single HMGET and pick the
+    -- first valid rule.
+    --
+    -- @Parameter: key
+    --  The key of the redis hash holding the rules of the tier
+    -- @Parameter: fields
+    --  The fields to look up, ordered from the longest prefix to the shortest
+    -- @Parameter: codes
+    --  true if the rules are stored as rule codes
+    -- @Returns: The first valid rule and the field it was found at, or nil
+    --]]--
+    if #fields == 0 then 
+        return nil
+    end
+    probes = probes + #fields
+    local rules = redis.call('HMGET', key, unpack(fields))
+    for i=1, #fields do 
+        local rule = rules[i]
+        if codes and rule then 
+            rule = rules_by_code[rule] or rule
+        end
+        local prefix_rule = valid_rule(key, fields[i], rule)
+        if prefix_rule ~= nil then 
+            return prefix_rule, fields[i]
+        end
+    end
+    return nil
+end
+
+local check_and_warn_org_restrictions = function(rule, org_id)
+    --[[--
+    -- Check if the rule belonging to an organization is restrictive and issue a warning 
+    --
+    -- @Parameter: rule 
+    --   An organization specific rule
+    -- @Parameter: org_id
+    --   The organisation Id the rule belongs to
+    -- @Returns: true if the rule is a restriction
+    --]]--
+    if rule_restricts(rule) then 
+        count('warn:org_restrict')
+        if log_enabled then
+            redis.log(redis.LOG_WARNING, 
+             'Found a restrictive rule for organisation with id: ', org_id, 
+             'Restrictions might apply for organisation only'
+            )
+        end
+        return true
+    end
+    return false
+end
+
+local check_and_warn_trial_restrictions = function(rule, prefix)
+    --[[--
+    -- Check if the trial specific rule is permissive and issue a warning
+    -- @Parameter: rule 
+    --   A trial specific rule 
+    -- @Parameter: prefix
+    --   The prefix the rule applies to
+    -- @Returns: true if  the rule is a permissive one 
+    --]]--
+    if rule_allows(rule) then
+        count('warn:trial_allow')
+        if log_enabled then
+            redis.log(redis.LOG_WARNING, 
+             'Found a permissive trial rule for prefix: ', prefix,
+             'Might allow some calls only in trial.'
+            )
+        end
+        return true
+    end
+    return false
+end
+
+local observed = function()
+    --[[--
+    -- @Returns: true if the call is logged, counted or traced, details that
+    --   are otherwise not needed for the decision are only looked up then
+    --]]--
+    return log_enabled or stats_weight > 0 or trace_enabled
+end
+
+local trial_rule = function(keys, phone_no)
+    --[[--
+    -- Look up the trial rules on their own, as decide did before the effective
+    -- trial rules. Only used while there are none, as after an upgrade before
+    -- rebuild_effective_trial ran, the generic rules are looked up after them.
+    --
+    -- @Returns: The longest valid trial rule and its prefix, or nil
+    --]]--
+    count('warn:no_effective_trial')
+    if log_enabled then
+        redis.log(redis.LOG_WARNING,
+            'No effective trial rules in:', keys.effective_trial,
+            'run rebuild_effective_trial'
+        )
+    end
+    local rule, prefix = longest_rule(keys.trial, prefixes_of(phone_no, {}))
+    check_and_warn_trial_restrictions(rule, prefix)
+    return rule, prefix
+end
+
+local decide = function(keys, phone_no, isTrial, org_id)
+    --[[--
+    -- Decide on the rule that applies to a phone number
+    --
+    -- @Parameter: keys
+    --   The keys of the redis hashes holding the rules, a table with generic,
+    --   trial and effective_trial, org: the hash of the organisation, the keys
+    --   of the prefix length indexes: generic_lengths and
+    --   effective_trial_lengths, and of the stems indexes: generic_stems and
+    --   effective_trial_stems
+    -- @Parameter: phone_no
+    --   The phone number to decide on
+    -- @Parameter: isTrial
+    --   true if trial rules apply
+    -- @Parameter: org_id
+    --   The organisation to consider specific rules for, nil or '' for none
+    -- @Returns: 'allow' or 'restrict' if a rule applies or nil otherwise, 
+    --   the tier that decided: 'org', 'trial' or 'generic' and the prefix of 
+    --   the deciding rule
+    --]]--
+
+    -- every tier is fetched with a single HMGET of the candidate prefixes, 
+    -- only the prefix lengths some rule of the tier has are considered, up to 
+    -- where the stems of the tier run out
+
+    -- check all org specific first, 
+    -- organisation might alow whole "12" prefix, but generic rules restrict "123"
+    local org_decision = nil
+    local org_prefix = nil
+    local trial_decision = nil
+
+    -- Org specific rules are expected in < 2% of users, each organisation with rules
+    -- has its own hash, a single HMGET of all the prefixes finds the rule or the 
+    -- missing key
+    if org_id and org_id ~= '' then
+        org_decision, org_prefix = longest_rule(
+            keys.org, prefixes_of(phone_no, {}), true
+        )
+        check_and_warn_org_restrictions(org_decision, org_id)
+    end
+    if org_decision ~= nil then return org_decision, 'org', org_prefix end
+
+    -- trial specific rules might be more restrictive with generic prefixes, the 
+    -- effective trial rules have them overlaid on the generic ones so a single 
+    -- lookup decides for trial users
+    if isTrial == true then
+        local prefixes, depth = candidates(
+            phone_no, keys.effective_trial_lengths, keys.effective_trial_stems
+        )
+        if depth == nil and redis.call('EXISTS', keys.effective_trial) == 0 then
+            local trial_prefix = nil
+            trial_decision, trial_prefix = trial_rule(keys, phone_no)
+            if trial_decision ~= nil then
+                return trial_decision, 'trial', trial_prefix
+            end
+        else
+            local trial_prefix = nil
+            trial_decision, trial_prefix = longest_rule(keys.effective_trial, prefixes)
+            if trial_decision == nil then return nil, nil, nil end
+            local tier = 'trial'
+            if observed() then
+                if redis.call('HGET', keys.trial, trial_prefix) == trial_decision then
+                    check_and_warn_trial_restrictions(trial_decision, trial_prefix)
+                else
+                    tier = 'generic'
+                end
+            end
+            return trial_decision, tier, trial_prefix
+        end
+    end
+
+    local prefixes = candidates(phone_no, keys.generic_lengths, keys.generic_stems)
+    local generic_decision, generic_prefix = longest_rule(keys.generic, prefixes)
+    if generic_decision ~= nil then 
+        return generic_decision, 'generic', generic_prefix 
+    end
+    return nil, nil, nil
+end
+
+local blob_sections = function(blob)
+    --[[--
+    -- Read the header of a rule blob written by phone.compile.redis.lua
+    --
+    -- @Parameter: blob
+    --   The blob, false if the tier has no rules
+    -- @Returns: An array of the sections, longest prefixes first, each a
+    --   table with the length of the prefixes, the offset of the first record
+    --   and the number of records
+    --]]--
+    local sections = {}
+    if not blob then
+        return sections
+    end
+    local count = tonumber(string.sub(blob, 5, 6))
+    local offset = 7 + count * 9
+    for i=0, count - 1 do
+        local start = 7 + i * 9
+        local section = {
+            length=tonumber(string.sub(blob, start, start + 1)),
+            offset=offset,
+            count=tonumber(string.sub(blob, start + 2, start + 8))
+        }
+        sections[#sections + 1] = section
+        offset = offset + section.count * (section.length + 1)
+    end
+    return sections
+end
+
+local blob_find = function(blob, section, prefix)
+    --[[--
+    -- Binary search a section of a rule blob for a prefix of its length
+    --
+    -- @Returns: The rule code of the prefix, nil if it has no rule
+    --]]--
+    probes = probes + 1
+    local width = section.length + 1
+    local low, high = 0, section.count - 1
+    while low <= high do
+        local middle = math.floor((low + high) / 2)
+        local start = section.offset + middle * width
+        local found = string.sub(blob, start, start + section.length - 1)
+        if found == prefix then
+            local code = start + section.length
+            return string.sub(blob, code, code)
+        elseif found < prefix then
+            low = middle + 1
+        else
+            high = middle - 1
+        end
+    end
+    return nil
+end
+
+local blob_rule = function(blob, phone_no)
+    --[[--
+    -- Find the rule with the longest prefix of the phone number in a blob
+    --
+    -- @Returns: 'allow' or 'restrict' and the prefix, nil if no rule applies
+    --]]--
+    for _, section in ipairs(blob_sections(blob)) do
+        if section.length <= string.len(phone_no) then
+            local prefix = string.sub(phone_no, 1, section.length)
+            local code = blob_find(blob, section, prefix)
+            if code then
+                return rules_by_code[code], prefix
+            end
+        end
+    end
+    return nil
+end
+
+local blob_has = function(blob, prefix, rule)
+    --[[--
+    -- @Returns: true if the blob has exactly the rule at prefix
+    --]]--
+    for _, section in ipairs(blob_sections(blob)) do
+        if section.length == string.len(prefix) then
+            return rules_by_code[blob_find(blob, section, prefix)] == rule
+        end
+    end
+    return false
+end
+
+local decide_blobs = function(keys, phone_no, isTrial, org_id)
+    --[[--
+    -- Decide like decide does, from the blobs of the tiers
+    --
+    -- @Parameter: keys
+    --   The keys of the blobs: generic, trial, effective_trial and org, that
+    --   of the organisation
+    -- @Returns: The decision, the tier and the prefix as decide does
+    --]]--
+    -- a single GET and a binary search per prefix length a tier has
+    if org_id and org_id ~= '' then
+        local rule, prefix = blob_rule(redis.call('GET', keys.org), phone_no)
+        check_and_warn_org_restrictions(rule, org_id)
+        if rule ~= nil then return rule, 'org', prefix end
+    end
+    if isTrial == true then
+        local rule, prefix = blob_rule(
+            redis.call('GET', keys.effective_trial), phone_no
+        )
+        if rule == nil then return nil, nil, nil end
+        local tier = 'trial'
+        if observed() then
+            if blob_has(redis.call('GET', keys.trial), prefix, rule) then
+                check_and_warn_trial_restrictions(rule, prefix)
+            else
+                tier = 'generic'
+            end
+        end
+        return rule, tier, prefix
+    end
+    local rule, prefix = blob_rule(redis.call('GET', keys.generic), phone_no)
+    if rule ~= nil then return rule, 'generic', prefix end
+    return nil, nil, nil
+end
+
+local org_keys_of = function(first_key)
+    --[[--
+    -- Map the organisations of a batch to the keys of their hashes
+    --
+    -- @Parameter: first_key
+    --   The index in KEYS of the hash of the first organisation, the others
+    --   follow in the order the organisations first appear in the
+    --   (phone_no, isTrial, org_id) triplets of ARGV, after the two flags
+    -- @Returns: A table of the key of each org_id
+    --]]--
+    local org_keys = {}
+    local next_key = first_key
+    for i=5, #ARGV, 3 do
+        if ARGV[i] ~= '' and org_keys[ARGV[i]] == nil then
+            org_keys[ARGV[i]] = KEYS[next_key]
+            next_key = next_key + 1
+        end
+    end
+    return org_keys
+end
+
+local decide_and_count = function(keys, phone_no, isTrial, org_id, decider)
+    --[[--
+    -- Decide like decide does and count the decision if the call is sampled
+    --
+    -- @Parameter: decider
+    --   The function deciding, decide unless given
+    -- @Returns: 'allow' or 'restrict' if a rule applies or nil otherwise,
+    --   the tier and the prefix as decide does
+    --]]--
+    local decision, tier, prefix = (decider or decide)(
+        keys, phone_no, isTrial, org_id
+    )
+    if decision ~= nil then
+        count('decision:' .. tier .. ':' .. decision)
+    else
+        count('decision:none')
+    end
+    return decision, tier, prefix
+end
+
+local micros = function()
+    --[[--
+    -- @Returns: The time of the redis server in microseconds
+    --]]--
+    local now = redis.call('TIME')
+    return tonumber(now[1]) * 1000000 + tonumber(now[2])
+end
+
+local decide_and_trace = function(keys, phone_no, isTrial, org_id)
+    --[[--
+    -- Decide like decide does and describe how
+    --
+    -- Only called for traces, which are never counted: reading the time is 
+    -- not deterministic, a script must not write after it on redis before 5.
+    --
+    -- @Returns: An array of the decision, the tier and the prefix, '' where
+    --   there's none, the number of rule fields read and the microseconds
+    --   spent deciding
+    --]]--
+    local started = micros()
+    local decision, tier, prefix = decide(keys, phone_no, isTrial, org_id)
+    return {decision or '', tier or '', prefix or '', probes, micros() - started}
+end
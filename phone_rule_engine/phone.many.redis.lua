@@ -0,0 +1,31 @@
+--[[--
+-- Decide on a batch of phone numbers in one call
+--
+-- ARGV starts with the logging flag and the stats weight, followed by
+-- (phone_no, isTrial, org_id) triplets, an empty org_id means no
+-- organisation. Returns the decision for each number in order, with '' in
+-- place of no decision as nil can't be stored in a Lua array. The hashes of
+-- the organisations follow the keys of phone.redis.lua, see org_keys_of.
+--]]--
+local rule_keys={
+    generic=KEYS[1],
+    trial=KEYS[2],
+    effective_trial=KEYS[5],
+    generic_lengths=KEYS[6],
+    effective_trial_lengths=KEYS[7],
+    generic_stems=KEYS[8],
+    effective_trial_stems=KEYS[9]
+}
+stats_key=KEYS[4]
+log_enabled=(ARGV[1] == '1')
+stats_weight=tonumber(ARGV[2]) or 0
+
+local org_keys = org_keys_of(10)
+local decisions = {}
+for i=3, #ARGV, 3 do
+    local isTrial=(string.upper(ARGV[i + 1]) == 'TRUE')
+    rule_keys.org = org_keys[ARGV[i + 2]]
+    local decision = decide_and_count(rule_keys, ARGV[i], isTrial, ARGV[i + 2])
+    decisions[#decisions + 1] = decision or ''
+end
+return decisions
@@ -0,0 +1,121 @@
+# -*- mode: Python; tab-width: 4; indent-tabs-mode: nil; -*-
+# ex: set tabstop=4 :
+# Please do not change the lines above. See PEP 8, PEP 263.
+""" Spread the rule lookups over read replicas """
+
+import itertools
+import time
+
+from redis.exceptions import ConnectionError, TimeoutError, NoScriptError
+
+from phone_rule_engine.trie import decode
+
+# errors after which a replica is left alone for a while
+REPLICA_ERRORS = (ConnectionError, TimeoutError)
+
+
+class ReplicaSet(object):
+    """ Runs read only script calls on the replicas in turn
+
+        A replica that fails to answer, or that check() finds disconnected
+        from its primary, is skipped for retry_after seconds. When no
+        replica is available the calls fall back to the primary.
+
+        Redis 7 and later run the calls as EVALSHA_RO, so a script can
+        never write to a replica, older versions as plain EVALSHA.
+    """
+
+    def __init__(self, replicas, retry_after=5, clock=time.monotonic):
+        self.replicas = list(replicas)
+        self.retry_after = retry_after
+        self._clock = clock
+        self._down_until = [0] * len(self.replicas)
+        self._turn = itertools.count()
+        self._commands = {}
+
+    def __len__(self):
+        return len(self.replicas)
+
+    def evalsha(self, script, calls, fallback):
+        """ Run script with each of the calls' keys and arguments, pairs of
+            tuples, on a replica
+
+            Returns the results in order, or those of fallback() if no
+            replica could answer.
+        """
+        for index in self._available():
+            try:
+                return self._run(index, script, calls)
+            except REPLICA_ERRORS:
+                self.mark_down(index)
+        return fallback()
+
+    def _available(self):
+        """ The indexes of the replicas to try, starting with the next one
+            in turn
+        """
+        now = self._clock()
+        start = next(self._turn)
+        for offset in range(len(self.replicas)):
+            index = (start + offset) % len(self.replicas)
+            if self._down_until[index] <= now:
+                yield index
+
+    def _run(self, index, script, calls):
+        """ Send the calls in one pipeline, loading the script if the
+            replica doesn't know it ( e.x. after a restart )
+        """
+        client = self.replicas[index]
+        command = self._command(index)
+        for attempt in (1, 2):
+            pipe = client.pipeline(transaction=False)
+            for keys, args in calls:
+                pipe.execute_command(
+                    command, script.sha, len(keys), *(tuple(keys) + args)
+                )
+            try:
+                return pipe.execute()
+            except NoScriptError:
+                if attempt == 2:
+                    raise
+                client.script_load(script.script)
+
+    def _command(self, index):
+        """ EVALSHA_RO if the replica supports it, memoized """
+        command = self._commands.get(index)
+        if command is None:
+            version = decode(
+                self.replicas[index].info("server")["redis_version"]
+            )
+            command = "EVALSHA"
+            if int(version.split(".")[0]) >= 7:
+                command = "EVALSHA_RO"
+            self._commands[index] = command
+        return command
+
+    def mark_down(self, index):
+        """ Skip the replica for the next retry_after seconds """
+        self._down_until[index] = self._clock() + self.retry_after
+        self._commands.pop(index, None)
+
+    def check(self):
+        """ Check that each replica is replicating its primary
+
+            A replica that lost the link to its primary serves stale rules,
+            it's skipped until the next check finds it up again. Meant to be
+            called periodically, returns a list with the health of each
+            replica.
+        """
+        healthy = []
+        for index, client in enumerate(self.replicas):
+            try:
+                info = client.info("replication")
+            except REPLICA_ERRORS:
+                info = {}
+            if decode(info.get("master_link_status")) == "up":
+                self._down_until[index] = 0
+                healthy.append(True)
+            else:
+                self.mark_down(index)
+                healthy.append(False)
+        return healthy
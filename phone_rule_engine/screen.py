@@ -0,0 +1,194 @@
+# -*- mode: Python; tab-width: 4; indent-tabs-mode: nil; -*-
+# ex: set tabstop=4 :
+# Please do not change the lines above. See PEP 8, PEP 263.
+""" Screen long lists of phone numbers in worker processes
+
+    The list is split in byte ranges, one per worker. Every worker compiles
+    the same snapshot of the rules into a RuleTrie once, reads the lines of
+    its own range straight from the file and writes the numbers it decided
+    to part files, without talking to redis. The parent process only
+    concatenates the parts in order, so no number goes through it and the
+    outputs keep the order of the input. Lists too small to make up for
+    starting the workers are screened in the calling process.
+"""
+
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+from phone_rule_engine.trie import RuleTrie, decode, decode_hash, decode_rule
+from phone_rule_engine.trie import R_RESTRICT
+
+CHUNK_SIZE = 10000
+# bytes of input per worker below which fewer workers are started, about
+# 80000 numbers: less than that is screened faster than a process starts
+MIN_RANGE_BYTES = 1 << 20
+READ_SIZE = 1 << 20
+
+# set in each worker by _init_worker
+_trie = None
+_call = None
+
+
+def rules_for(rule_ops, org_id=None):
+    """ The (generic, trial, orgs) rules a screen needs, read in one
+        snapshot, orgs holding the rules of org_id only
+    """
+    _, generic, trial, orgs = rule_ops.snapshot()
+    orgs = {decode(each): rules for each, rules in orgs.items()}
+    return (
+        decode_hash(generic), decode_hash(trial),
+        {
+            org_id: {
+                decode(prefix): decode_rule(rule)
+                for prefix, rule in orgs[org_id].items()
+            }
+        } if org_id in orgs else {}
+    )
+
+
+def _init_worker(rules, is_trial, org_id):
+    """ Compile the rules once per worker process """
+    global _trie, _call
+    _trie = RuleTrie.from_hashes(*rules)
+    _call = (is_trial, org_id)
+
+
+def screen_chunk(numbers):
+    """ Split a chunk of numbers in an (allowed, restricted) pair of lists
+
+        Numbers without a rule are allowed, as the demo apps do.
+    """
+    allowed = []
+    restricted = []
+    decide = _trie.decide
+    is_trial, org_id = _call
+    for number in numbers:
+        if decide(number, is_trial, org_id)[0] == R_RESTRICT:
+            restricted.append(number)
+        else:
+            allowed.append(number)
+    return allowed, restricted
+
+
+def chunks(lines, chunk_size=CHUNK_SIZE):
+    """ The numbers of lines, one per line, in lists of chunk_size
+
+        Blank lines are skipped, the numbers are matched as given, like
+        query_rule does.
+    """
+    chunk = []
+    for line in lines:
+        number = line.strip()
+        if not number:
+            continue
+        chunk.append(number)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def range_lines(numbers, start, end):
+    """ The lines of the binary file numbers that start in [start, end),
+        decoded and without the line ends
+
+        A line running over start belongs to the range before, so ranges
+        that follow each other split the lines between them. The file is
+        read READ_SIZE bytes at a time, up to the end of a line.
+    """
+    if start:
+        numbers.seek(start - 1)
+        numbers.readline()
+    position = numbers.tell()
+    while position < end:
+        block = numbers.read(min(READ_SIZE, end - position))
+        if not block:
+            return
+        if not block.endswith(b"\n"):
+            block += numbers.readline()
+        position += len(block)
+        yield from block.decode("ascii", "replace").splitlines()
+
+
+def write_numbers(output, numbers):
+    """ Write numbers to output, one per line """
+    if numbers:
+        output.write("\n".join(numbers) + "\n")
+
+
+def screen_range(path, start, end, allowed_path, restricted_path,
+                 chunk_size=CHUNK_SIZE):
+    """ Screen the numbers of the lines of path starting in [start, end)
+
+        Writes them to the files at allowed_path and restricted_path and
+        returns the (allowed, restricted) counts. Runs in a worker, after
+        _init_worker.
+    """
+    allowed_count = restricted_count = 0
+    with open(path, "rb") as numbers, \
+            open(allowed_path, "w") as allowed, \
+            open(restricted_path, "w") as restricted:
+        for chunk in chunks(range_lines(numbers, start, end), chunk_size):
+            allowed_numbers, restricted_numbers = screen_chunk(chunk)
+            write_numbers(allowed, allowed_numbers)
+            write_numbers(restricted, restricted_numbers)
+            allowed_count += len(allowed_numbers)
+            restricted_count += len(restricted_numbers)
+    return allowed_count, restricted_count
+
+
+def screen_file(path, allowed_path, restricted_path, rules, is_trial=False,
+                org_id=None, workers=None, chunk_size=CHUNK_SIZE,
+                min_range_bytes=MIN_RANGE_BYTES):
+    """ Screen the numbers of the file at path, one per line, with a pool of
+        worker processes
+
+        rules is a (generic, trial, orgs) tuple as rules_for() returns,
+        workers defaults to the number of CPUs and is lowered so that each
+        has at least min_range_bytes of input, a single one screens in the
+        calling process. The allowed and restricted numbers are written to
+        the files at allowed_path and restricted_path in the order of the
+        input, returns their (allowed, restricted) counts.
+    """
+    size = os.path.getsize(path)
+    workers = min(
+        workers or os.cpu_count() or 1, max(1, size // min_range_bytes)
+    )
+    if workers == 1:
+        _init_worker(rules, is_trial, org_id)
+        return screen_range(
+            path, 0, size, allowed_path, restricted_path, chunk_size
+        )
+    bounds = [size * i // workers for i in range(workers + 1)]
+    parts = tempfile.mkdtemp(
+        dir=os.path.dirname(os.path.abspath(allowed_path))
+    )
+    try:
+        calls = [
+            (path, bounds[i], bounds[i + 1],
+             os.path.join(parts, "{}.allowed".format(i)),
+             os.path.join(parts, "{}.restricted".format(i)),
+             chunk_size)
+            for i in range(workers)
+        ]
+        pool = multiprocessing.Pool(
+            workers, _init_worker, (rules, is_trial, org_id)
+        )
+        try:
+            counts = pool.starmap(screen_range, calls, chunksize=1)
+        finally:
+            pool.terminate()
+            pool.join()
+        for output_path, index in ((allowed_path, 3), (restricted_path, 4)):
+            with open(output_path, "wb") as output:
+                for call in calls:
+                    with open(call[index], "rb") as part:
+                        shutil.copyfileobj(part, output)
+    finally:
+        shutil.rmtree(parts)
+    return (
+        sum(count[0] for count in counts), sum(count[1] for count in counts)
+    )
@@ -0,0 +1,158 @@
+# -*- mode: Python; tab-width: 4; indent-tabs-mode: nil; -*-
+# ex: set tabstop=4 :
+# Please do not change the lines above. See PEP 8, PEP 263.
+""" In process rule engine compiled from the rules stored in redis
+
+    Redis stays the source of truth, this just makes it possible to answer
+    queries without a round trip once the rules are loaded.
+"""
+
+R_ALLOW = "allow"
+R_RESTRICT = "restrict"
+ORG_ENABLE = "enable"
+# organization rules are stored with a single character per rule
+RULE_CODES = {R_ALLOW: "a", R_RESTRICT: "r"}
+RULES_BY_CODE = {code: rule for rule, code in RULE_CODES.items()}
+
+TIER_GENERIC = "generic"
+TIER_TRIAL = "trial"
+TIER_ORG = "org"
+# announces that every tier changed, e.x. after replacing all the rules
+TIER_ALL = "all"
+
+
+def decode(value):
+    """ Redis returns bytes unless asked otherwise, we work with str """
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    return value
+
+
+def decode_hash(rules):
+    """ Decode the fields and values of a hash read from redis """
+    return {decode(field): decode(value) for field, value in rules.items()}
+
+
+def decode_rule(value):
+    """ The rule keyword for a rule code, other values are returned as is """
+    value = decode(value)
+    return RULES_BY_CODE.get(value, value)
+
+
+def is_trial_flag(is_trial):
+    """ Interpret the trial flag the same way the Lua script does """
+    return str(is_trial).upper() == "TRUE"
+
+
+class _Node(object):
+    """ A digit in the trie, with the rules of each tier that end here """
+
+    __slots__ = ("children", "generic", "trial", "orgs")
+
+    def __init__(self):
+        self.children = {}
+        self.generic = None
+        self.trial = None
+        self.orgs = None
+
+
+class RuleTrie(object):
+    """ Digit trie holding the generic, trial and organization rules
+
+        Gives the same answers as phone.redis.lua: organization specific
+        rules take precedence over trial rules, which take precedence over
+        generic ones, and within a tier the longest matching prefix wins.
+        All tiers are resolved in a single walk over the digits of the
+        phone number.
+    """
+
+    def __init__(self):
+        self._root = _Node()
+        self._orgs = set()
+
+    @classmethod
+    def from_hashes(cls, generic, trial, orgs):
+        """ Compile the contents of the rules and rules:trial hashes as
+            returned by HGETALL, and orgs: the hash of each organization
+            by org_id
+        """
+        trie = cls()
+        for prefix, rule in generic.items():
+            trie.add_generic_rule(decode(prefix), decode(rule))
+        for prefix, rule in trial.items():
+            trie.add_trial_rule(decode(prefix), decode(rule))
+        for org_id, rules in orgs.items():
+            org_id = decode(org_id)
+            for prefix, rule in rules.items():
+                trie.add_org_rule(decode(prefix), decode_rule(rule), org_id)
+        return trie
+
+    def add_generic_rule(self, prefix, rule):
+        """ Add a generic rule, invalid rules are ignored like in Lua """
+        if rule in (R_ALLOW, R_RESTRICT):
+            self._node(prefix).generic = rule
+
+    def add_trial_rule(self, prefix, rule):
+        """ Add a trial specific rule """
+        if rule in (R_ALLOW, R_RESTRICT):
+            self._node(prefix).trial = rule
+
+    def add_org_rule(self, prefix, rule, org_id):
+        """ Add an organization specific rule """
+        if rule in (R_ALLOW, R_RESTRICT):
+            node = self._node(prefix)
+            if node.orgs is None:
+                node.orgs = {}
+            node.orgs[org_id] = rule
+            self._orgs.add(org_id)
+
+    def _node(self, prefix):
+        """ Find or create the node for prefix """
+        node = self._root
+        for digit in prefix:
+            child = node.children.get(digit)
+            if child is None:
+                child = node.children[digit] = _Node()
+            node = child
+        return node
+
+    def lookup(self, phone_no, is_trial=False, org_id=None):
+        """ Returns the deciding rule keyword or None """
+        return self.decide(phone_no, is_trial, org_id)[0]
+
+    def decide(self, phone_no, is_trial=False, org_id=None):
+        """ Returns the deciding (rule, tier), (None, None) if there's no
+            rule
+        """
+        is_trial = is_trial_flag(is_trial)
+        org_specific = org_id is not None and org_id in self._orgs
+        generic = trial = org = None
+        node = self._root
+        for digit in phone_no:
+            node = node.children.get(digit)
+            if node is None:
+                break
+            if node.generic is not None:
+                generic = node.generic
+            if is_trial and node.trial is not None:
+                trial = node.trial
+            if org_specific and node.orgs is not None:
+                org = node.orgs.get(org_id, org)
+        if org:
+            return org, TIER_ORG
+        if trial:
+            return trial, TIER_TRIAL
+        if generic:
+            return generic, TIER_GENERIC
+        return None, None
+
+    def query_rule(self, phone_no, is_trial=False, org_id=None):
+        """ Same contract as RuleOperations.query_rule
+
+            Returns True if the phone_no is allowed, False if it's restricted
+            or None if there's no rule
+        """
+        rule = self.lookup(phone_no, is_trial, org_id)
+        if rule is None:
+            return None
+        return rule == R_ALLOW
@@ -0,0 +1,173 @@
+# -*- mode: Python; tab-width: 4; indent-tabs-mode: nil; -*-
+# ex: set tabstop=4 :
+# Please do not change the lines above. See PEP 8, PEP 263.
+
+import unittest
+from unittest.mock import AsyncMock, Mock
+from phone_rule_engine.aio import AsyncRuleOperations
+
+
+class TestAsyncOperations(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.redis = Mock()
+        self.redis.register_script = lambda script: AsyncMock(script=script)
+        self.redis.exists = AsyncMock(return_value=0)
+        self.testee = AsyncRuleOperations(self.redis)
+
+    async def test_query(self):
+        self.testee._script.return_value = b"restrict"
+        self.assertFalse(await self.testee.query_rule("+407", True, "org"))
+        self.testee._script.assert_awaited_once_with(
+            keys=self.testee._query_keys("org"),
+            args=("+407", "True", "org", "0", 0)
+        )
+
+    async def test_query_many(self):
+        pipe = self.redis.pipeline.return_value
+        pipe.execute = AsyncMock(return_value=[[b"allow", b""], [b"restrict"]])
+        self.assertEqual(
+            [True, None, False],
+            await self.testee.query_rules_many(
+                ["407", "408", "409"], chunk_size=2
+            )
+        )
+        self.assertEqual(2, self.testee._many_script.await_count)
+
+    async def test_query_concurrently(self):
+        results = {"407": b"allow", "408": None, "409": b"restrict"}
+        self.testee._script.side_effect = \
+            lambda keys, args: results[args[0]]
+        self.assertEqual(
+            [True, None, False],
+            await self.testee.query_rules_concurrently(
+                ["407", ("408", True, None), "409"], concurrency=2
+            )
+        )
+
+    async def test_trace(self):
+        self.testee._script.return_value = [b"allow", b"org", b"40", 4, 10]
+        trace = await self.testee.trace_rule("407", False, "org")
+        self.assertEqual((True, "org", "40", 4), trace[:4])
+        self.testee._script.assert_awaited_once_with(
+            keys=self.testee._query_keys("org"),
+            args=("407", "False", "org", "0", 0, "1")
+        )
+
+    async def test_explain(self):
+        pipe = self.redis.pipeline.return_value
+        pipe.execute = AsyncMock(return_value=[
+            [[[b"org", b"40", b"allow"], [b"generic", b"4", b"restrict"]]]
+        ])
+        explanation = await self.testee.explain_rule("407", False, "org")
+        self.assertEqual((True, "org", "40"), explanation[:3])
+        self.assertEqual(1, len(explanation.shadowed))
+        self.testee._explain_script.assert_awaited_once_with(
+            keys=self.testee._keys + ("rules:org:{org}", ),
+            args=("0", 0, "407", "False", "org"), client=pipe
+        )
+
+    async def test_needs_blocking_client(self):
+        for call in (
+                lambda: self.testee.replace_rules({}, {}),
+                lambda: self.testee.migrate_org_rules(),
+                lambda: self.testee.load_tier("generic"),
+                lambda: self.testee.load_org("org"),
+                lambda: self.testee.org_ids(),
+                lambda: self.testee.rebuild_effective_trial(),
+                lambda: self.testee.compile_blobs()):
+            with self.assertRaises(NotImplementedError):
+                call()
+
+    async def test_push_publishes_change(self):
+        pipe = self.redis.pipeline.return_value
+        pipe.execute = AsyncMock(return_value=[1, 1, 1, 4])
+        self.redis.publish = AsyncMock()
+        await self.testee.push_generic_rule("+40", "restrict")
+        pipe.hset.assert_called_once_with("rules", "40", "restrict")
+        self.testee._effective_script.assert_awaited_once()
+        self.redis.publish.assert_awaited_once_with(
+            "rules:changes", '{"version": 4, "tier": "generic"}'
+        )
+
+    async def test_push_bulk(self):
+        pipe = self.redis.pipeline.return_value
+        pipe.execute = AsyncMock(
+            return_value=[[b"allow", None], [b"r"], 1, 1, 1, 1, 1, 1, 7]
+        )
+        self.redis.publish = AsyncMock()
+        async with self.testee.transaction() as changes:
+            changes.push_generic_rule("40", "restrict")
+            changes.push_generic_rule("+41", "allow")
+            changes.push_org_rule("40", "allow", "org")
+        self.assertEqual({
+            "generic": {"40": "allow", "41": None},
+            "trial": {},
+            "org": {"org": {"40": "restrict"}},
+        }, changes.previous)
+        self.testee._effective_script.assert_awaited_once_with(
+            keys=self.testee._effective_keys(), args=["40", "41"],
+            client=pipe
+        )
+        self.redis.publish.assert_awaited_once_with(
+            "rules:changes", '{"version": 7, "tier": "all"}'
+        )
+
+    async def test_delete(self):
+        pipe = self.redis.pipeline.return_value
+        pipe.execute = AsyncMock(return_value=[[[b"a"], 0], 5])
+        self.redis.publish = AsyncMock()
+        self.assertEqual(
+            "allow", await self.testee.delete_org_rule("+40", "org")
+        )
+        self.testee._delete_org_script.assert_awaited_once_with(
+            keys=("rules:org:{org}", "rules:orgs"), args=["org", "40"],
+            client=pipe
+        )
+        pipe.execute = AsyncMock(return_value=[[b"restrict"], 1, [], 6])
+        self.assertEqual(
+            "restrict", await self.testee.delete_trial_rule("40")
+        )
+        self.assertEqual(2, self.testee._delete_script.await_count)
+
+    async def test_blobs(self):
+        self.testee.blobs = True
+        pipe = self.redis.pipeline.return_value
+        pipe.execute = AsyncMock(return_value=[1, 1, [1], 7])
+        self.redis.publish = AsyncMock()
+        await self.testee.push_org_rule("40", "allow", "org")
+        self.testee._compile_script.assert_awaited_once_with(
+            keys=("rules:org:{org}", "rules:org:{org}:blob"), args=("1", ),
+            client=pipe
+        )
+        pipe.set.assert_called_once_with("rules:blobs", 1)
+        self.testee._blob_script.return_value = b"allow"
+        self.assertTrue(await self.testee.query_rule("407", False, "org"))
+        self.testee._script.assert_not_awaited()
+
+    async def test_blobs_in_use(self):
+        pipe = self.redis.pipeline.return_value
+        pipe.execute = AsyncMock(return_value=[1, 1, [1], 7])
+        self.redis.publish = AsyncMock()
+        await self.testee.push_org_rule("40", "allow", "org")
+        self.testee._compile_script.assert_not_awaited()
+        self.redis.exists.return_value = 1
+        await self.testee.push_org_rule("40", "allow", "org")
+        self.testee._compile_script.assert_awaited_once_with(
+            keys=("rules:org:{org}", "rules:org:{org}:blob"), args=("1", ),
+            client=pipe
+        )
+
+    async def test_warmup(self):
+        with self.assertRaises(ValueError):
+            AsyncRuleOperations(self.redis, warmup=True)
+        with self.assertRaises(ValueError):
+            AsyncRuleOperations(self.redis, "prefix", True)
+        self.redis.script_load = AsyncMock(return_value="loaded-sha")
+        await self.testee.warmup()
+        self.assertEqual(3, self.redis.script_load.await_count)
+        self.assertEqual("loaded-sha", self.testee.script_sha)
+
+    async def test_validation(self):
+        with self.assertRaises(ValueError):
+            await self.testee.push_org_rule("40", "foobar", "org")
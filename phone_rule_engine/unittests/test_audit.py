@@ -0,0 +1,111 @@
+# -*- mode: Python; tab-width: 4; indent-tabs-mode: nil; -*-
+# ex: set tabstop=4 :
+# Please do not change the lines above. See PEP 8, PEP 263.
+
+import os
+import random
+import tempfile
+import unittest
+
+from phone_rule_engine.trie import RuleTrie
+
+try:
+    from phone_rule_engine import audit
+except ImportError:
+    audit = None
+
+
+@unittest.skipUnless(audit, "needs numpy")
+class TestRuleSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.generic = {"1": "allow", "12": "restrict", "0123": "restrict"}
+        self.trial = {"1": "restrict", "1234": "allow", "40": "nonsense"}
+        self.orgs = {"org": {"123": "allow", "9": "restrict"}}
+        self.snapshot = audit.RuleSnapshot(
+            self.generic, self.trial, self.orgs
+        )
+
+    def decide(self, numbers, is_trial=False, org_ids=None):
+        return [
+            audit.DECISIONS[decision] for decision in
+            self.snapshot.evaluate(numbers, is_trial, org_ids).tolist()
+        ]
+
+    def test_tiers(self):
+        numbers = ["1", "12", "123", "12345", "01234", "1234", "9", "+12", ""]
+        self.assertEqual(
+            [True, False, False, False, False, False, None, None, None],
+            self.decide(numbers)
+        )
+        self.assertEqual(
+            [False, False, False, True, False, True, None, None, None],
+            self.decide(numbers, "true")
+        )
+        self.assertEqual(
+            [False, False, True, True, False, True, False, None, None],
+            self.decide(numbers, True, ["org"] * len(numbers))
+        )
+
+    def test_per_number_flags(self):
+        self.assertEqual(
+            [True, False, None, False],
+            self.decide(
+                ["1", "1", "9", "9"], ["false", "TRUE", "true", "false"],
+                ["no-such-org", None, None, "org"]
+            )
+        )
+
+    def test_same_as_trie(self):
+        rng = random.Random(7)
+
+        def rules(count):
+            return {
+                str(rng.randrange(10 ** rng.randint(1, 6))):
+                rng.choice(("allow", "restrict"))
+                for _ in range(count)
+            }
+        self.snapshot = audit.RuleSnapshot(
+            rules(300), rules(100), {"a": rules(50), "b": rules(50)}
+        )
+        trie = RuleTrie.from_hashes(*(
+            self.snapshot.rules[tier] for tier in ("generic", "trial", "orgs")
+        ))
+        calls = [
+            (str(rng.randrange(10 ** 12)), rng.choice((True, False)),
+             rng.choice(("a", "b", None)))
+            for _ in range(5000)
+        ]
+        numbers, flags, org_ids = zip(*calls)
+        self.assertEqual(
+            [trie.query_rule(*call) for call in calls],
+            self.decide(list(numbers), list(flags), list(org_ids))
+        )
+
+    def test_save_load(self):
+        path = os.path.join(tempfile.mkdtemp(), "rules.json")
+        self.snapshot.save(path)
+        loaded = audit.RuleSnapshot.load(path)
+        self.assertEqual(self.snapshot.rules, loaded.rules)
+        self.assertEqual(3, len(loaded.generic))
+        # the invalid rule is ignored
+        self.assertEqual(2, len(loaded.trial))
+
+    def test_read_csv(self):
+        path = os.path.join(tempfile.mkdtemp(), "cdr.csv")
+        with open(path, "w") as cdr:
+            cdr.write("org,number,trial\norg,123,false\n,12,true\n,1,true\n")
+        chunks = list(audit.read_csv(path, "number", "trial", "org", 2))
+        self.assertEqual([
+            (["123", "12"], ["false", "true"], ["org", None]),
+            (["1"], ["true"], [None]),
+        ], chunks)
+        decisions = self.snapshot.evaluate(*chunks[0])
+        self.assertEqual(
+            {"allowed": 1, "restricted": 1, "no_rule": 0},
+            audit.count_decisions(decisions)
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+# -*- mode: Python; tab-width: 4; indent-tabs-mode: nil; -*-
+# ex: set tabstop=4 :
+# Please do not change the lines above. See PEP 8, PEP 263.
+
+import random
+import unittest
+
+from phone_rule_engine import blob
+from phone_rule_engine.trie import RuleTrie
+
+
+class TestBlob(unittest.TestCase):
+
+    def setUp(self):
+        self.rules = {
+            "1": "restrict",
+            "12": "allow",
+            "13": "restrict",
+            "123": "restrict",
+            "45": "foobar",
+            "4x": "allow",
+        }
+        self.testee = blob.pack(self.rules)
+
+    def test_layout(self):
+        self.assertEqual(
+            "PRT103" "030000001" "020000002" "010000001"
+            "123r" "12a13r" "1r",
+            self.testee
+        )
+
+    def test_unpack(self):
+        self.assertEqual({
+            "1": "restrict", "12": "allow", "13": "restrict",
+            "123": "restrict",
+        }, blob.unpack(self.testee.encode()))
+
+    def test_longest(self):
+        self.assertEqual(
+            ("restrict", "123"), blob.longest(self.testee, "1234")
+        )
+        self.assertEqual(("allow", "12"), blob.longest(self.testee, "12"))
+        self.assertEqual(("restrict", "1"), blob.longest(self.testee, "19"))
+        self.assertEqual((None, None), blob.longest(self.testee, "45"))
+        self.assertEqual((None, None), blob.longest(self.testee, "+12"))
+
+    def test_codes(self):
+        """ Codes are only valid in the organization hashes """
+        self.assertEqual("", blob.pack({"12": "a", "13": "r"}))
+        self.assertEqual(
+            "PRT101" "020000002" "12a13r",
+            blob.pack({"12": "a", "13": "r", "14": "allow"}, codes=True)
+        )
+
+    def test_empty(self):
+        self.assertEqual("", blob.pack({"45": "foobar"}))
+        self.assertEqual({}, blob.unpack(None))
+        self.assertEqual((None, None), blob.longest(None, "12"))
+
+    def test_not_a_blob(self):
+        with self.assertRaises(ValueError):
+            blob.unpack(b"allow")
+
+    def test_agrees_with_trie(self):
+        generator = random.Random(25)
+        rules = {
+            "".join(
+                generator.choice("0123456789")
+                for _ in range(generator.randint(1, 6))
+            ): generator.choice(("allow", "restrict"))
+            for _ in range(500)
+        }
+        packed = blob.pack(rules)
+        self.assertEqual(rules, blob.unpack(packed))
+        trie = RuleTrie.from_hashes(rules, {}, {})
+        for _ in range(2000):
+            number = str(generator.randint(0, 10 ** 8))
+            self.assertEqual(
+                trie.lookup(number), blob.longest(packed, number)[0], number
+            )
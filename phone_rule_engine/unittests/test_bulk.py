@@ -0,0 +1,55 @@
+# -*- mode: Python; tab-width: 4; indent-tabs-mode: nil; -*-
+# ex: set tabstop=4 :
+# Please do not change the lines above. See PEP 8, PEP 263.
+
+import unittest
+from phone_rule_engine.bulk import effective_trial_rules, rules_diff
+from phone_rule_engine.bulk import legacy_org_rules, org_fields
+
+
+class TestBulk(unittest.TestCase):
+
+    def test_effective_trial_rules(self):
+        self.assertEqual(
+            {"1": "allow", "12": "restrict", "4": "restrict"},
+            effective_trial_rules(
+                {"1": "allow", "123": "allow", "124": "allow",
+                 "4": "allow"},
+                {"12": "restrict", "4": "restrict"}
+            )
+        )
+
+    def test_org_fields(self):
+        self.assertEqual(
+            {"some-org:40": "allow", "some-org:41": "restrict"},
+            org_fields({
+                "some-org": {"40": "allow", "41": "restrict"},
+                "other-org": {},
+            })
+        )
+
+    def test_legacy_org_rules(self):
+        self.assertEqual(
+            {"some-org": {"40": "allow"}, "a:b": {"41": "restrict"}},
+            legacy_org_rules({
+                "some-org": "enable",
+                "some-org:40": "allow",
+                "some-org:42": "foobar",
+                "other-org:40": "allow",
+                "a:b": "enable",
+                "a:b:41": "restrict",
+            })
+        )
+
+    def test_rules_diff(self):
+        self.assertEqual(
+            {
+                "added": {"42": "allow"},
+                "removed": {"40": "allow"},
+                "changed": {"41": ("allow", "restrict")},
+            },
+            rules_diff(
+                {"40": "allow", "41": "allow", "43": "allow"},
+                {"41": "restrict", "42": "allow", "43": "allow"}
+            )
+        )
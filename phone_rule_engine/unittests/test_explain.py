@@ -0,0 +1,44 @@
+# -*- mode: Python; tab-width: 4; indent-tabs-mode: nil; -*-
+# ex: set tabstop=4 :
+# Please do not change the lines above. See PEP 8, PEP 263.
+
+import unittest
+from phone_rule_engine.explain import Explanation, RuleMatch
+from phone_rule_engine.explain import decode_matches, explanation
+from phone_rule_engine.explain import group_by_prefix
+
+
+class TestExplain(unittest.TestCase):
+
+    def test_explanation(self):
+        matches = decode_matches([
+            [b"org", b"12", b"allow"], [b"generic", b"123", b"restrict"]
+        ])
+        self.assertEqual(
+            Explanation(True, "org", "12", (
+                RuleMatch("generic", "123", "restrict"),
+            )),
+            explanation(matches)
+        )
+        self.assertEqual(
+            Explanation(None, None, None, ()), explanation([])
+        )
+
+    def test_group_by_prefix(self):
+        restricted = Explanation(False, "generic", "12", ())
+        allowed = Explanation(True, "org", "1", ())
+        unknown = Explanation(None, None, None, ())
+        numbers = ["120", "121", "130", "140"]
+        explanations = [restricted, restricted, allowed, unknown]
+        self.assertEqual(
+            {("generic", "12"): ["120", "121"]},
+            group_by_prefix(numbers, explanations)
+        )
+        self.assertEqual(
+            {("org", "1"): ["130"]},
+            group_by_prefix(numbers, explanations, decision=True)
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
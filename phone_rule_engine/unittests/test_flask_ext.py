@@ -0,0 +1,90 @@
+# -*- mode: Python; tab-width: 4; indent-tabs-mode: nil; -*-
+# ex: set tabstop=4 :
+# Please do not change the lines above. See PEP 8, PEP 263.
+
+import unittest
+from unittest.mock import Mock, patch
+
+try:
+    from flask import Flask
+    from redis.exceptions import ConnectionError
+    from phone_rule_engine import flask_ext
+except ImportError:
+    flask_ext = None
+
+
+@unittest.skipUnless(flask_ext, "needs flask and the redis client")
+class TestFlaskRuleEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = Mock()
+        self.redis.register_script = lambda script: Mock(
+            script=script, return_value=None
+        )
+        self.redis.script_load.return_value = "loaded-sha"
+        self.redis.get.return_value = b"3"
+        patcher = patch.object(
+            flask_ext.FlaskRuleEngine, "_client", return_value=self.redis
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.app = Flask(__name__)
+
+    def test_warm_on_init(self):
+        self.app.config["PHONE_RULES_POOL_PRELOAD"] = 2
+        rules = flask_ext.FlaskRuleEngine(self.app)
+        self.assertTrue(rules.ready)
+        pool = self.redis.connection_pool
+        self.assertEqual(2, pool.get_connection.call_count)
+        self.assertEqual(2, pool.release.call_count)
+        self.assertEqual("loaded-sha", rules.rule_ops.script_sha)
+        rules.rule_ops._script.assert_called_once()
+        self.assertIs(rules, self.app.extensions["phone_rules"])
+
+    def test_readiness(self):
+        self.redis.script_load.side_effect = ConnectionError()
+        rules = flask_ext.FlaskRuleEngine(self.app)
+        self.assertFalse(rules.ready)
+        client = self.app.test_client()
+        self.assertEqual(503, client.get("/ready").status_code)
+        self.redis.script_load.side_effect = None
+        response = client.get("/ready")
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(
+            {"ready": True, "script": "loaded-sha"}, response.get_json()
+        )
+
+    def test_decision_cache(self):
+        self.app.config["PHONE_RULES_CACHE"] = flask_ext.CACHE_DECISIONS
+        self.app.config["PHONE_RULES_WARM_ON_INIT"] = False
+        rules = flask_ext.FlaskRuleEngine(self.app)
+        rules.warm()
+        self.assertEqual(3, rules.cache.version)
+        self.redis.pubsub.return_value.run_in_thread.assert_called_once()
+        rules.query_rule("407")
+        rules.query_rule("407")
+        self.assertEqual(1, rules.cache.stats()["hits"])
+
+    def test_blobs(self):
+        self.app.config["PHONE_RULES_BLOBS"] = True
+        rules = flask_ext.FlaskRuleEngine(self.app)
+        self.assertTrue(rules.rule_ops.blobs)
+        rules.rule_ops._blob_script.assert_called_once()
+
+    def test_unknown_cache(self):
+        self.app.config["PHONE_RULES_CACHE"] = "foobar"
+        with self.assertRaises(ValueError):
+            flask_ext.FlaskRuleEngine(self.app)
+
+    def test_metrics(self):
+        self.app.config["PHONE_RULES_METRICS"] = True
+        self.app.config["PHONE_RULES_TRACE_EVERY"] = 0
+        rules = flask_ext.FlaskRuleEngine(self.app)
+        rules.query_rule("407")
+        response = self.app.test_client().get("/metrics")
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(response.content_type.startswith("text/plain"))
+        # the probe query of warm() and the one above
+        self.assertIn(
+            "phone_rules_query_seconds_count 2", response.get_data(True)
+        )
@@ -0,0 +1,49 @@
+# -*- mode: Python; tab-width: 4; indent-tabs-mode: nil; -*-
+# ex: set tabstop=4 :
+# Please do not change the lines above. See PEP 8, PEP 263.
+
+import unittest
+from phone_rule_engine.metrics import DecisionTrace, Histogram, RuleMetrics
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_histogram(self):
+        histogram = Histogram((1, 5))
+        for value in (0.5, 3, 3, 10):
+            histogram.observe(value)
+        self.assertEqual([
+            'x_bucket{le="1"} 1',
+            'x_bucket{le="5"} 3',
+            'x_bucket{le="+Inf"} 4',
+            'x_sum 16.5',
+            'x_count 4',
+        ], histogram.samples("x"))
+
+    def test_sampling(self):
+        metrics = RuleMetrics(trace_every=3)
+        self.assertEqual(
+            [True, False, False, True],
+            [metrics.sampled() for _ in range(4)]
+        )
+        self.assertFalse(RuleMetrics(trace_every=0).sampled())
+
+    def test_render(self):
+        metrics = RuleMetrics(namespace="rules")
+        metrics.observe(0.002)
+        metrics.observe_trace(
+            DecisionTrace(False, "trial", "12", 2, 0.0001, 0.0003)
+        )
+        metrics.observe_trace(DecisionTrace(None, None, None, 0, 0, 0.0002))
+        text = metrics.render()
+        self.assertIn("# TYPE rules_query_seconds histogram\n", text)
+        self.assertIn("rules_query_seconds_count 3\n", text)
+        self.assertIn("rules_traced_probes_sum 2\n", text)
+        self.assertIn(
+            'rules_traced_decisions_total{tier="trial",decision="restrict"} 1',
+            text
+        )
+        self.assertIn(
+            'rules_traced_decisions_total{tier="none",decision="none"} 1',
+            text
+        )
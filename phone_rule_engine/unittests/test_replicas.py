@@ -0,0 +1,81 @@
+# -*- mode: Python; tab-width: 4; indent-tabs-mode: nil; -*-
+# ex: set tabstop=4 :
+# Please do not change the lines above. See PEP 8, PEP 263.
+
+import unittest
+from unittest.mock import Mock
+
+try:
+    from redis.exceptions import ConnectionError, NoScriptError
+    from phone_rule_engine.replicas import ReplicaSet
+except ImportError:
+    ReplicaSet = None
+
+
+@unittest.skipUnless(ReplicaSet, "needs the redis client")
+class TestReplicaSet(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 100
+        self.replicas = [self._replica("6.2.7"), self._replica("7.0.0")]
+        self.testee = ReplicaSet(
+            self.replicas, retry_after=5, clock=lambda: self.now
+        )
+        self.script = Mock(sha="some-sha", script="return 1")
+        self.fallback = Mock(return_value=["from-primary"])
+
+    @staticmethod
+    def _replica(version):
+        replica = Mock()
+        replica.info.return_value = {
+            "redis_version": version, "master_link_status": "up"
+        }
+        replica.pipeline.return_value.execute.return_value = ["from-replica"]
+        return replica
+
+    def evalsha(self):
+        return self.testee.evalsha(
+            self.script, [(("k1", "k2"), ("407", "False"))], self.fallback
+        )
+
+    def test_round_robin(self):
+        self.assertEqual(["from-replica"], self.evalsha())
+        self.assertEqual(["from-replica"], self.evalsha())
+        self.replicas[0].pipeline.return_value.execute_command \
+            .assert_called_once_with(
+                "EVALSHA", "some-sha", 2, "k1", "k2", "407", "False"
+            )
+        self.replicas[1].pipeline.return_value.execute_command \
+            .assert_called_once_with(
+                "EVALSHA_RO", "some-sha", 2, "k1", "k2", "407", "False"
+            )
+        self.fallback.assert_not_called()
+
+    def test_fallback(self):
+        for replica in self.replicas:
+            replica.pipeline.return_value.execute.side_effect = \
+                ConnectionError()
+        self.assertEqual(["from-primary"], self.evalsha())
+        self.evalsha()
+        self.assertEqual(
+            1, self.replicas[0].pipeline.return_value.execute.call_count
+        )
+        self.now += 5
+        self.evalsha()
+        self.assertEqual(
+            2, self.replicas[0].pipeline.return_value.execute.call_count
+        )
+
+    def test_loads_missing_script(self):
+        self.replicas[0].pipeline.return_value.execute.side_effect = [
+            NoScriptError(), ["from-replica"]
+        ]
+        self.assertEqual(["from-replica"], self.evalsha())
+        self.replicas[0].script_load.assert_called_once_with("return 1")
+
+    def test_check(self):
+        self.replicas[1].info.return_value = {"master_link_status": "down"}
+        self.assertEqual([True, False], self.testee.check())
+        for _ in range(3):
+            self.evalsha()
+        self.replicas[1].pipeline.return_value.execute.assert_not_called()
@@ -0,0 +1,157 @@
+# -*- mode: Python; tab-width: 4; indent-tabs-mode: nil; -*-
+# ex: set tabstop=4 :
+# Please do not change the lines above. See PEP 8, PEP 263.
+
+import json
+import unittest
+from unittest.mock import Mock
+from phone_rule_engine.cache import RuleCache, DecisionCache
+
+
+class TestRuleCache(unittest.TestCase):
+
+    def setUp(self):
+        self.rule_ops = Mock()
+        self.rule_ops.blobs = False
+        self.rule_ops.snapshot.return_value = (
+            3,
+            {b"40": b"restrict"},
+            {b"41": b"restrict"},
+            {"some-org": {b"40": b"a"}},
+        )
+        self.testee = RuleCache(self.rule_ops)
+        self.testee.reload()
+
+    def _event(self, **event):
+        self.testee.handle_event({"data": json.dumps(event).encode()})
+
+    def test_serves_from_snapshot(self):
+        self.assertEqual(3, self.testee.version)
+        self.assertFalse(self.testee.query_rule("407"))
+        self.assertTrue(self.testee.query_rule("407", False, "some-org"))
+
+    def test_reload_from_blobs(self):
+        self.rule_ops.blobs = True
+        self.rule_ops.load_blobs.return_value = (
+            5, {"40": "allow"}, {}, {"some-org": {"40": "restrict"}}
+        )
+        self.testee.reload()
+        self.assertEqual(5, self.testee.version)
+        self.assertTrue(self.testee.query_rule("407"))
+        self.assertFalse(self.testee.query_rule("407", False, "some-org"))
+
+    def test_reload_tier(self):
+        self.rule_ops.load_tier.return_value = (4, {b"40": b"allow"})
+        self._event(version=4, tier="generic")
+        self.rule_ops.load_tier.assert_called_once_with("generic")
+        self.assertTrue(self.testee.query_rule("407"))
+        self.assertFalse(self.testee.query_rule("417", True))
+        self.assertEqual(4, self.testee.version)
+
+    def test_reload_org(self):
+        self.rule_ops.load_org.return_value = (4, {b"41": b"a"})
+        self._event(version=4, tier="org", org_id="some-org")
+        self.assertFalse(self.testee.query_rule("407", False, "some-org"))
+        self.assertTrue(self.testee.query_rule("417", True, "some-org"))
+
+    def test_old_events_are_ignored(self):
+        self._event(version=3, tier="generic")
+        self.rule_ops.load_tier.assert_not_called()
+        self.assertEqual(1, self.rule_ops.snapshot.call_count)
+
+    def test_missed_events_reload_everything(self):
+        self._event(version=6, tier="generic")
+        self.rule_ops.load_tier.assert_not_called()
+        self.assertEqual(2, self.rule_ops.snapshot.call_count)
+
+    def test_all_tiers_changed_reloads_everything(self):
+        self._event(version=4, tier="all")
+        self.rule_ops.load_tier.assert_not_called()
+        self.assertEqual(2, self.rule_ops.snapshot.call_count)
+
+    def test_refresh_if_stale(self):
+        self.rule_ops.get_version.return_value = 3
+        self.assertFalse(self.testee.refresh_if_stale())
+        self.rule_ops.get_version.return_value = 5
+        self.assertTrue(self.testee.refresh_if_stale())
+
+
+class TestDecisionCache(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0
+        self.rule_ops = Mock()
+        self.rule_ops.query_rule.return_value = False
+        self.testee = DecisionCache(
+            self.rule_ops, max_size=2, ttl=10, clock=lambda: self.now
+        )
+        self.testee.invalidate(3)
+
+    def _event(self, version):
+        self.testee.handle_event(
+            {"data": json.dumps({"version": version, "tier": "generic"})}
+        )
+
+    def test_repeated_calls_are_cached(self):
+        self.assertFalse(self.testee.query_rule("+407", "true", None))
+        self.assertFalse(self.testee.query_rule("407", True, ""))
+        self.rule_ops.query_rule.assert_called_once_with("407", True, None)
+        self.assertEqual(
+            {"hits": 1, "misses": 1, "size": 1, "version": 3},
+            self.testee.stats()
+        )
+
+    def test_queried_normalized(self):
+        """ Whichever form of a number comes first, both get its answer """
+        # redis has no rule for the number with the plus
+        self.rule_ops.query_rule.side_effect = \
+            lambda phone_no, *args: None if phone_no[0] == "+" else False
+        self.assertFalse(self.testee.query_rule("+4071"))
+        self.assertFalse(self.testee.query_rule("4071"))
+        self.rule_ops.query_rule.assert_called_once_with("4071", False, None)
+
+    def test_no_rule_is_cached(self):
+        self.rule_ops.query_rule.return_value = None
+        self.assertIsNone(self.testee.query_rule("407"))
+        self.assertIsNone(self.testee.query_rule("407"))
+        self.assertEqual(1, self.rule_ops.query_rule.call_count)
+
+    def test_callers_are_told_apart(self):
+        self.testee.query_rule("407")
+        self.testee.query_rule("407", True)
+        self.testee.query_rule("407", False, "some-org")
+        self.assertEqual(3, self.rule_ops.query_rule.call_count)
+
+    def test_least_recently_used_evicted(self):
+        self.testee.query_rule("407")
+        self.testee.query_rule("408")
+        self.testee.query_rule("407")
+        self.testee.query_rule("409")
+        self.testee.query_rule("407")
+        self.assertEqual(3, self.rule_ops.query_rule.call_count)
+        self.testee.query_rule("408")
+        self.assertEqual(4, self.rule_ops.query_rule.call_count)
+
+    def test_expires(self):
+        self.testee.query_rule("407")
+        self.now = 10
+        self.testee.query_rule("407")
+        self.assertEqual(2, self.rule_ops.query_rule.call_count)
+
+    def test_rule_change_invalidates(self):
+        self.testee.query_rule("407")
+        self._event(3)
+        self.testee.query_rule("407")
+        self.assertEqual(1, self.rule_ops.query_rule.call_count)
+        self._event(4)
+        self.testee.query_rule("407")
+        self.assertEqual(2, self.rule_ops.query_rule.call_count)
+        self.assertEqual(4, self.testee.version)
+
+    def test_decision_racing_a_change_is_not_cached(self):
+        def query_rule(*args):
+            self._event(4)
+            return True
+        self.rule_ops.query_rule.side_effect = query_rule
+        self.assertTrue(self.testee.query_rule("407"))
+        self.assertEqual(0, self.testee.stats()["size"])
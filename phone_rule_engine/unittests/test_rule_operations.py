@@ -4,12 +4,14 @@
 
 import unittest
 import phone_rule_engine
+from phone_rule_engine.metrics import RuleMetrics
 from unittest.mock import Mock
 
 class TestOperations(unittest.TestCase):
 
     def setUp(self):
         self.redis = Mock()
+        self.redis.exists.return_value = 0
         self.testee = phone_rule_engine.RuleOperations(self.redis)
 
     def test_prefix_normalization(self):
@@ -33,7 +35,10 @@ class TestOperations(unittest.TestCase):
         )
 
     def _mock_redis(self, response):
-        self.redis.register_script = lambda script: lambda keys, args: response
+        self.redis.register_script = lambda script: Mock(
+            script=script, return_value=response
+        )
+        self.testee = phone_rule_engine.RuleOperations(self.redis)
 
     def test_invalid_redis_response(self):
         self._mock_redis(b"foobar")
@@ -53,3 +58,326 @@ class TestOperations(unittest.TestCase):
         self.assertIsNone(
             self.testee.query_rule("+407")
         )
+
+    def test_push_publishes_change(self):
+        pipe = self.redis.pipeline.return_value
+        pipe.execute.return_value = [1, 1, 7]
+        self.testee.push_org_rule("+40", "allow", "some-org")
+        pipe.hset.assert_called_once_with("rules:org:{some-org}", "40", "a")
+        pipe.sadd.assert_called_once_with("rules:orgs", "some-org")
+        pipe.incr.assert_called_once_with("rules:version")
+        self.redis.publish.assert_called_once_with(
+            "rules:changes",
+            '{"version": 7, "tier": "org", "org_id": "some-org"}'
+        )
+
+    def test_query_many_chunks(self):
+        calls = []
+        self._mock_redis(None)
+        self.testee._many_script.side_effect = \
+            lambda keys, args, client: calls.append((keys[9:], args))
+        self.redis.pipeline.return_value.execute.return_value = [
+            [b"allow", b""], [b"restrict"]
+        ]
+        self.assertEqual(
+            [True, None, False],
+            self.testee.query_rules_many(
+                ["407", ("408", True, "some-org"), "409"], chunk_size=2
+            )
+        )
+        self.assertEqual([
+            (("rules:org:{some-org}", ),
+             ("0", 0, "407", "False", "", "408", "True", "some-org")),
+            ((), ("0", 0, "409", "False", ""))
+        ], calls)
+
+    def test_many_keys(self):
+        """ Each organization of a batch is declared once, in order """
+        self.assertEqual(
+            self.testee._keys + ("rules:org:{b}", "rules:org:{a}"),
+            self.testee._many_keys(
+                ("0", 0, "40", "False", "b", "41", "True", "",
+                 "42", "False", "a", "43", "False", "b")
+            )
+        )
+
+    def test_script_registered_once(self):
+        self.redis.register_script = Mock(
+            side_effect=lambda script: Mock(script=script, return_value=None)
+        )
+        self.testee = phone_rule_engine.RuleOperations(self.redis)
+        registered = self.redis.register_script.call_count
+        self.testee.query_rule("+407")
+        self.testee.query_rule("+407")
+        self.assertEqual(registered, self.redis.register_script.call_count)
+        self.assertEqual(40, len(self.testee.script_sha))
+
+    def test_warmup(self):
+        self.redis = Mock()
+        self.redis.script_load.return_value = "loaded-sha"
+        self.testee = phone_rule_engine.RuleOperations(self.redis, warmup=True)
+        # all but the explain, delete and blob scripts
+        self.assertEqual(
+            self.redis.register_script.call_count - 5,
+            self.redis.script_load.call_count
+        )
+        self.assertEqual("loaded-sha", self.testee.script_sha)
+
+    def test_warmup_blobs(self):
+        self.redis = Mock()
+        self.testee = phone_rule_engine.RuleOperations(
+            self.redis, warmup=True, blobs=True
+        )
+        self.assertEqual(
+            self.redis.register_script.call_count - 3,
+            self.redis.script_load.call_count
+        )
+
+    def test_query_blobs(self):
+        self._mock_redis(b"allow")
+        self.testee.blobs = True
+        self.assertTrue(self.testee.query_rule("407", True, "some-org"))
+        self.testee._blob_script.assert_called_once_with(
+            keys=("rules:blob", "rules:trial:blob",
+                  "rules:trial:effective:blob", "rules:org:{some-org}:blob",
+                  "rules:stats"),
+            args=("407", "True", "some-org", "0", 0)
+        )
+        self.testee._script.assert_not_called()
+
+    def test_push_compiles_blobs(self):
+        self._mock_redis(None)
+        self.testee.blobs = True
+        pipe = self.redis.pipeline.return_value
+        pipe.execute.return_value = [1, 1, 7]
+        self.testee.push_org_rule("+40", "allow", "some-org")
+        self.testee._compile_script.assert_called_once_with(
+            keys=("rules:org:{some-org}", "rules:org:{some-org}:blob"),
+            args=("1", ), client=pipe
+        )
+        self.testee.push_trial_rule("40", "allow")
+        self.testee._compile_script.assert_called_with(
+            keys=("rules:trial", "rules:trial:blob",
+                  "rules:trial:effective", "rules:trial:effective:blob"),
+            args=("0", "0"), client=pipe
+        )
+        pipe.set.assert_called_with("rules:blobs", 1)
+
+    def test_push_compiles_blobs_in_use(self):
+        self._mock_redis(None)
+        pipe = self.redis.pipeline.return_value
+        pipe.execute.return_value = [1, 1, 7]
+        self.testee.push_org_rule("40", "allow", "some-org")
+        self.testee._compile_script.assert_not_called()
+        self.redis.exists.assert_called_once_with(
+            "rules:blobs", "rules:blob"
+        )
+        self.redis.exists.return_value = 1
+        self.testee.push_org_rule("40", "allow", "some-org")
+        self.testee._compile_script.assert_called_once_with(
+            keys=("rules:org:{some-org}", "rules:org:{some-org}:blob"),
+            args=("1", ), client=pipe
+        )
+        pipe.set.assert_not_called()
+
+    def test_blob_calls_by_slot(self):
+        self.assertEqual([
+            (("rules", "rules:blob", "rules:trial", "rules:trial:blob",
+              "rules:trial:effective", "rules:trial:effective:blob"),
+             ("0", "0", "0")),
+            (("rules:org:{a}", "rules:org:{a}:blob"), ("1", )),
+            (("rules:org:{b}", "rules:org:{b}:blob"), ("1", )),
+        ], self.testee._blob_calls("all", org_ids={"b": {}, "a": {}}))
+
+    def test_script_flags(self):
+        self._mock_redis(None)
+        self.testee.debug = True
+        self.testee.stats_every = 3
+        self.testee.query_rule("407")
+        self.testee._script.assert_called_with(
+            keys=("rules", "rules:trial", "rules:org", "rules:stats",
+                  "rules:trial:effective", "rules:lengths",
+                  "rules:trial:effective:lengths", "rules:stems",
+                  "rules:trial:effective:stems"),
+            args=("407", "False", "", "1", 3)
+        )
+        self.testee.query_rule("407")
+        self.testee._script.assert_called_with(
+            keys=("rules", "rules:trial", "rules:org", "rules:stats",
+                  "rules:trial:effective", "rules:lengths",
+                  "rules:trial:effective:lengths", "rules:stems",
+                  "rules:trial:effective:stems"),
+            args=("407", "False", "", "1", 0)
+        )
+        self.testee.query_rule("407", False, "some-org")
+        self.assertEqual(
+            "rules:org:{some-org}",
+            self.testee._script.call_args[1]["keys"][2]
+        )
+
+    def test_get_stats(self):
+        self.redis.hgetall.return_value = {b"decision:none": b"30"}
+        self.assertEqual({"decision:none": 30}, self.testee.get_stats())
+        self.redis.hgetall.assert_called_once_with("rules:stats")
+
+    def test_replace_rules_dry_run(self):
+        self.redis.transaction.return_value = [5, {b"40": b"restrict"}, {}]
+        diff = self.testee.replace_rules(
+            {"+40": "ALLOW"}, {"41": "restrict"}, dry_run=True
+        )
+        self.assertEqual({"40": ("restrict", "allow")}, diff["generic"]["changed"])
+        self.assertEqual({"41": "restrict"}, diff["trial"]["added"])
+        self.assertNotIn("org", diff)
+        self.redis.pipeline.return_value.execute_command.assert_not_called()
+        self.redis.publish.assert_not_called()
+
+    def test_replace_rules_validates(self):
+        with self.assertRaises(ValueError):
+            self.testee.replace_rules({"40": "foobar"}, {})
+        self.redis.pipeline.assert_not_called()
+
+    def test_stems(self):
+        self.assertEqual(
+            {"": 1, "4": 1, "40": 1, "41": 1, "412": 1},
+            phone_rule_engine._stems([b"40", "412"])
+        )
+
+
+class TestClusterOperations(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = Mock()
+        self.redis.exists.return_value = 0
+        self.redis.register_script = lambda script: Mock(
+            script=script, return_value=b"restrict"
+        )
+        self.testee = phone_rule_engine.RuleOperations(
+            self.redis, cluster=True
+        )
+
+    def test_keys(self):
+        self.assertEqual("{rules}:rules:version", self.testee.version_key)
+        self.assertEqual("{rules}:rules:orgs", self.testee.orgs_key)
+        self.assertEqual("{rules}:rules:trial", self.testee._key("trial"))
+        self.assertEqual(
+            "rules:org:{some-org}", self.testee._org_key("some-org")
+        )
+        self.assertTrue(all(
+            key.startswith("{rules}:") for key in self.testee._keys
+        ))
+
+    def test_org_rule_decides(self):
+        self.redis.hmget.return_value = [None, b"a", b"r"]
+        self.assertTrue(self.testee.query_rule("407", False, "some-org"))
+        self.redis.hmget.assert_called_once_with(
+            "rules:org:{some-org}", ["407", "40", "4"]
+        )
+        self.testee._script.assert_not_called()
+
+    def test_falls_back_to_script(self):
+        self.redis.hmget.return_value = [None, None, None]
+        self.assertFalse(self.testee.query_rule("407", True, "some-org"))
+        self.assertEqual(
+            ("407", "True", ""), self.testee._script.call_args[1]["args"][:3]
+        )
+
+    def test_query_many(self):
+        pipe = self.redis.pipeline.return_value
+        pipe.execute.return_value = [[b"a", None], [None, None]]
+        self.testee._many_script.return_value = [b"restrict", b""]
+        self.assertEqual(
+            [True, False, None],
+            self.testee.query_rules_many(
+                [("40", False, "org-1"), ("41", True, "org-2"), "42"]
+            )
+        )
+        self.redis.pipeline.assert_called_once_with(transaction=False)
+        self.assertEqual(
+            ("41", "True", "", "42", "False", ""),
+            self.testee._many_script.call_args[1]["args"][2:]
+        )
+
+    def test_push_runs_script_outside_pipeline(self):
+        pipe = self.redis.pipeline.return_value
+        pipe.execute.return_value = [1, 1, 1, 3]
+        self.testee.push_generic_rule("40", "allow")
+        self.redis.pipeline.assert_called_once_with(transaction=False)
+        self.assertNotIn("client", self.testee._effective_script.call_args[1])
+        self.assertEqual(2, pipe.execute.call_count)
+
+
+class TestReplicaOperations(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = Mock()
+        self.redis.register_script = lambda script: Mock(
+            script=script, return_value=b"restrict"
+        )
+        self.replicas = Mock()
+        self.replicas.evalsha.return_value = [b"allow"]
+        self.testee = phone_rule_engine.RuleOperations(
+            self.redis, replicas=self.replicas
+        )
+
+    def test_query_on_replica(self):
+        self.assertTrue(self.testee.query_rule("407"))
+        self.testee._script.assert_not_called()
+        self.assertEqual(
+            [(self.testee._keys, ("407", "False", "", "0", 0))],
+            self.replicas.evalsha.call_args[0][1]
+        )
+
+    def test_counted_query_on_primary(self):
+        self.testee.stats_every = 2
+        self.assertFalse(self.testee.query_rule("407"))
+        self.replicas.evalsha.assert_not_called()
+
+    def test_query_many_on_replica(self):
+        self.replicas.evalsha.return_value = [[b"allow"], [b""]]
+        self.assertEqual(
+            [True, None],
+            self.testee.query_rules_many(["40", "41"], chunk_size=1)
+        )
+        self.redis.pipeline.assert_not_called()
+
+    def test_no_replicas_in_cluster(self):
+        with self.assertRaises(ValueError):
+            phone_rule_engine.RuleOperations(
+                self.redis, cluster=True, replicas=self.replicas
+            )
+
+
+class TestTraceOperations(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = Mock()
+        self.redis.register_script = lambda script: Mock(
+            script=script, return_value=[b"restrict", b"trial", b"12", 3, 25]
+        )
+        self.testee = phone_rule_engine.RuleOperations(self.redis)
+
+    def test_trace(self):
+        trace = self.testee.trace_rule("123", True, "some-org")
+        self.assertEqual(
+            (False, "trial", "12", 3, 0.000025),
+            trace[:5]
+        )
+        self.testee._script.assert_called_once_with(
+            keys=self.testee._query_keys("some-org"),
+            args=("123", "True", "some-org", "0", 0, "1")
+        )
+
+    def test_no_decision(self):
+        self.testee._script.return_value = [b"", b"", b"", 0, 5]
+        trace = self.testee.trace_rule("40")
+        self.assertEqual((None, None, None, 0), trace[:4])
+
+    def test_sampled_queries_are_traced(self):
+        metrics = RuleMetrics(trace_every=2)
+        self.testee.metrics = metrics
+        self.assertFalse(self.testee.query_rule("123", True))
+        self.testee._script.return_value = b"restrict"
+        self.assertFalse(self.testee.query_rule("123", True))
+        self.assertEqual(2, metrics.latency.count)
+        self.assertEqual(1, metrics.probes.count)
+        self.assertEqual({("trial", "restrict"): 1}, metrics.decisions)
@@ -0,0 +1,73 @@
+# -*- mode: Python; tab-width: 4; indent-tabs-mode: nil; -*-
+# ex: set tabstop=4 :
+# Please do not change the lines above. See PEP 8, PEP 263.
+
+import unittest
+import phone_rule_engine
+from unittest.mock import Mock
+from phone_rule_engine.trie import RuleTrie
+
+
+class TestRuleTrie(unittest.TestCase):
+
+    def setUp(self):
+        self.testee = RuleTrie.from_hashes(
+            {
+                b"1": b"restrict",
+                b"12": b"allow",
+                b"123": b"restrict",
+                b"45": b"foobar",
+            },
+            {
+                b"12": b"restrict",
+                b"1235": b"allow",
+            },
+            {
+                b"some-org": {b"1234": b"a"},
+                "other-org": {"1": "allow", "2": "foobar"},
+            }
+        )
+
+    def test_generic_nesting(self):
+        self.assertFalse(self.testee.query_rule("10"))
+        self.assertTrue(self.testee.query_rule("120"))
+        self.assertFalse(self.testee.query_rule("1230"))
+        self.assertIsNone(self.testee.query_rule("40744931029"))
+
+    def test_decide(self):
+        self.assertEqual(
+            ("allow", "org"), self.testee.decide("12345", True, "some-org")
+        )
+        self.assertEqual(("allow", "trial"), self.testee.decide("1235", True))
+        self.assertEqual(("restrict", "generic"), self.testee.decide("1235"))
+        self.assertEqual((None, None), self.testee.decide("4567"))
+
+    def test_invalid_rules_are_ignored(self):
+        self.assertIsNone(self.testee.query_rule("4567"))
+
+    def test_trial_precedence(self):
+        self.assertFalse(self.testee.query_rule("120", True))
+        self.assertFalse(self.testee.query_rule("1230", "true"))
+        self.assertTrue(self.testee.query_rule("12350", "True"))
+        self.assertTrue(self.testee.query_rule("120", "False"))
+
+    def test_org_precedence(self):
+        self.assertTrue(self.testee.query_rule("12340", True, "some-org"))
+        self.assertFalse(self.testee.query_rule("1230", True, "some-org"))
+
+    def test_org_rule_codes_and_keywords(self):
+        self.assertTrue(self.testee.query_rule("10", False, "other-org"))
+        self.assertIsNone(self.testee.query_rule("20", False, "other-org"))
+        self.assertFalse(self.testee.query_rule("10", False, "unknown-org"))
+
+    def test_compile_from_redis(self):
+        redis = Mock()
+        redis.smembers.return_value = {b"some-org"}
+        redis.transaction = lambda read, *watches: read(redis) or (
+            b"3", {b"40": b"restrict"}, {}, {b"4070": b"a"}
+        )
+        trie = phone_rule_engine.RuleOperations(redis, "x").compile_rules()
+        redis.hgetall.assert_any_call("x:rules")
+        redis.hgetall.assert_any_call("x:rules:org:{some-org}")
+        self.assertFalse(trie.query_rule("407"))
+        self.assertTrue(trie.query_rule("40701", False, "some-org"))
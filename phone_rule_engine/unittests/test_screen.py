@@ -0,0 +1,103 @@
+# -*- mode: Python; tab-width: 4; indent-tabs-mode: nil; -*-
+# ex: set tabstop=4 :
+# Please do not change the lines above. See PEP 8, PEP 263.
+
+import io
+import os
+import tempfile
+import unittest
+from unittest.mock import Mock, patch
+from phone_rule_engine import screen
+
+
+class TestScreen(unittest.TestCase):
+
+    def setUp(self):
+        self.rules = (
+            {"1": "restrict", "12": "allow"},
+            {"13": "restrict"},
+            {"org": {"14": "allow"}},
+        )
+
+    def test_chunks(self):
+        self.assertEqual(
+            [["1", "2"], ["3"]],
+            list(screen.chunks(["1\n", "\n", " 2\n", "3"], chunk_size=2))
+        )
+
+    def test_screen_chunk(self):
+        screen._init_worker(self.rules, False, "org")
+        self.assertEqual(
+            (["12", "14", "2"], ["1", "13"]),
+            screen.screen_chunk(["1", "12", "13", "14", "2"])
+        )
+
+    def test_range_lines(self):
+        """ Every line belongs to the range it starts in """
+        numbers = io.BytesIO(b"12\n345\n\n6\n")
+        self.assertEqual(
+            [["12", "345"], ["", "6"], []],
+            [
+                list(screen.range_lines(numbers, start, end))
+                for start, end in ((0, 4), (4, 9), (9, 11))
+            ]
+        )
+
+    def test_screen_file_in_order(self):
+        """ The parts of the workers are joined in the order of the input
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "numbers")
+            with open(path, "w") as numbers:
+                numbers.writelines(
+                    "{}\n".format(number) for number in range(100, 200)
+                )
+            outputs = {}
+            for workers in (1, 3):
+                allowed = os.path.join(directory, "allowed")
+                restricted = os.path.join(directory, "restricted")
+                self.assertEqual((10, 90), screen.screen_file(
+                    path, allowed, restricted, self.rules, "true", None,
+                    workers=workers, chunk_size=7, min_range_bytes=1
+                ))
+                with open(allowed) as allowed, \
+                        open(restricted) as restricted:
+                    outputs[workers] = (allowed.read(), restricted.read())
+            self.assertEqual(
+                "".join("{}\n".format(n) for n in range(120, 130)),
+                outputs[3][0]
+            )
+            self.assertEqual(outputs[1], outputs[3])
+            # the part files are gone
+            self.assertEqual(
+                ["allowed", "numbers", "restricted"],
+                sorted(os.listdir(directory))
+            )
+
+    def test_small_lists_in_process(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "numbers")
+            with open(path, "w") as numbers:
+                numbers.write("12\n13\n")
+            with patch.object(screen.multiprocessing, "Pool") as pool:
+                self.assertEqual((1, 1), screen.screen_file(
+                    path, path + ".allowed", path + ".restricted",
+                    self.rules, True, None, workers=4
+                ))
+            pool.assert_not_called()
+
+    def test_rules_for(self):
+        rule_ops = Mock()
+        rule_ops.snapshot.return_value = (
+            1, {b"1": b"allow"}, {b"2": b"restrict"},
+            {b"org": {b"3": b"r"}, b"other": {b"4": b"a"}}
+        )
+        self.assertEqual(
+            ({"1": "allow"}, {"2": "restrict"}, {"org": {"3": "restrict"}}),
+            screen.rules_for(rule_ops, "org")
+        )
+        self.assertEqual({}, screen.rules_for(rule_ops)[2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+# -*- mode: Python; tab-width: 4; indent-tabs-mode: nil; -*-
+# ex: set tabstop=4 :
+# Please do not change the lines above. See PEP 8, PEP 263.
+
+import random
+import unittest
+from unittest.mock import Mock
+from phone_rule_engine.whatif import Flip, RuleChange, TrafficSample, WhatIf
+
+
+class TestWhatIf(unittest.TestCase):
+
+    def setUp(self):
+        self.testee = WhatIf(
+            {"1": "allow", "12": "restrict"},
+            {"1": "restrict"},
+            {"org": {"123": "allow"}},
+        )
+        self.sample = TrafficSample([
+            ("1200", False, None),
+            ("1200", False, None),
+            ("1234", False, "org"),
+            ("1234", "true", ""),
+            ("1300", True, None),
+            ("1300", False, "org"),
+            ("400", False, None),
+        ])
+
+    def test_sample(self):
+        self.assertEqual(7, len(self.sample))
+        self.assertEqual(
+            ["1200", "1234", "1234", "1300", "1300", "400"],
+            [self.sample.calls[i][0] for i in range(6)]
+        )
+        self.assertEqual(range(1, 3), self.sample.under("123"))
+        self.assertEqual(range(0, 5), self.sample.under("1"))
+        self.assertEqual(range(6, 6), self.sample.under("5"))
+
+    def test_generic_change(self):
+        report = self.testee.simulate(
+            [RuleChange("generic", "+12", "allow")], self.sample
+        )
+        self.assertEqual(7, report.total)
+        # the trial call is decided by the trial rule either way
+        self.assertEqual(4, report.evaluated)
+        self.assertEqual(
+            {Flip(None, "generic", False, True): 2}, dict(report.flips)
+        )
+        self.assertEqual(0, report.newly_restricted())
+
+    def test_only_the_org_and_trial_calls(self):
+        report = self.testee.simulate([
+            RuleChange("org", "13", "RESTRICT", "org"),
+            RuleChange("trial", "1", None),
+            RuleChange("org", "123", None, "org"),
+        ], self.sample)
+        self.assertEqual({
+            Flip("org", "org", True, False): 1,
+            Flip(None, "generic", False, True): 1,
+            Flip("org", "generic", True, False): 1,
+        }, dict(report.flips))
+        self.assertEqual(3, report.flipped)
+        self.assertEqual({"org": 2, None: 1}, report.by_org())
+        self.assertEqual(2, report.newly_restricted())
+
+    def test_invalid_changes(self):
+        for change in (RuleChange("org", "1", "allow"),
+                       RuleChange("nonsense", "1", "allow"),
+                       RuleChange("generic", "1x", "allow"),
+                       RuleChange("generic", "1", "deny")):
+            self.assertRaises(
+                ValueError, self.testee.simulate, [change], self.sample
+            )
+
+    def test_same_as_evaluating_everything(self):
+        rng = random.Random(3)
+
+        def prefix():
+            return str(rng.randrange(10 ** rng.randint(1, 4)))
+
+        def rules(count):
+            return {
+                prefix(): rng.choice(("allow", "restrict"))
+                for _ in range(count)
+            }
+        testee = WhatIf(rules(200), rules(50), {"a": rules(30)})
+        sample = TrafficSample(
+            (str(rng.randrange(10 ** 6)), rng.choice((True, False)),
+             rng.choice(("a", "b", None)))
+            for _ in range(3000)
+        )
+        changes = [
+            RuleChange(
+                rng.choice(("generic", "trial", "org")), prefix(),
+                rng.choice(("allow", "restrict", None)), "a"
+            )
+            for _ in range(20)
+        ]
+        proposed = testee.proposed(changes)
+        expected = sum(
+            count for call, count in zip(sample.calls, sample.counts)
+            if testee.current.query_rule(*call) !=
+            proposed.query_rule(*call)
+        )
+        self.assertEqual(
+            expected, testee.simulate(changes, sample).flipped
+        )
+
+    def test_from_redis(self):
+        rule_ops = Mock()
+        rule_ops.snapshot.return_value = (
+            3, {b"1": b"allow"}, {}, {b"org": {b"12": b"r"}}
+        )
+        testee = WhatIf.from_redis(rule_ops)
+        self.assertEqual({"org": {"12": "restrict"}}, testee.orgs)
+        self.assertFalse(testee.current.query_rule("123", False, "org"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,213 @@
+# -*- mode: Python; tab-width: 4; indent-tabs-mode: nil; -*-
+# ex: set tabstop=4 :
+# Please do not change the lines above. See PEP 8, PEP 263.
+""" What-if simulation of rule changes against a sample of past traffic
+
+    The sample is sorted by phone number, so the calls under a prefix are a
+    contiguous range found with two bisections. A change set only
+    re-evaluates the calls under the prefixes it changes, with the current
+    and the proposed rules compiled into RuleTrie, which follows the order
+    of precedence of phone.redis.lua.
+"""
+
+from bisect import bisect_left
+from collections import Counter, namedtuple
+import csv
+
+from phone_rule_engine import RuleOperations
+from phone_rule_engine.trie import RuleTrie, R_ALLOW, R_RESTRICT
+from phone_rule_engine.trie import TIER_GENERIC, TIER_TRIAL, TIER_ORG
+from phone_rule_engine.trie import decode, decode_hash, decode_rule
+from phone_rule_engine.trie import is_trial_flag
+
+# rule is None to remove the rule at prefix, org_id is only for org rules
+RuleChange = namedtuple("RuleChange", ("tier", "prefix", "rule", "org_id"))
+RuleChange.__new__.__defaults__ = (None,)
+
+# a group of calls whose decision changes: the org_id of the calls, the tier
+# deciding after the change ( before, if no rule decides after ), and the
+# decisions as query_rule returns them
+Flip = namedtuple("Flip", ("org_id", "tier", "before", "after"))
+
+# sorts after every digit, so prefix + PAST_DIGITS bounds the numbers
+# starting with prefix
+PAST_DIGITS = ":"
+
+
+class TrafficSample(object):
+    """ Calls made, indexed by phone number
+
+        Each call is a (phone_no, is_trial, org_id) tuple, repeated calls
+        are counted rather than kept.
+    """
+
+    def __init__(self, calls):
+        counts = Counter(
+            (decode(phone_no), is_trial_flag(is_trial), org_id or None)
+            for phone_no, is_trial, org_id in calls
+        )
+        self.calls = sorted(counts, key=lambda call: call[0])
+        self.counts = [counts[call] for call in self.calls]
+        self._numbers = [call[0] for call in self.calls]
+
+    @classmethod
+    def from_csv(cls, path, column="number", trial_column=None,
+                 org_column=None):
+        """ Read the calls from a CSV file with a header """
+        with open(path, newline="") as source:
+            return cls(
+                (
+                    row[column],
+                    row[trial_column] if trial_column else False,
+                    row[org_column] if org_column else None,
+                )
+                for row in csv.DictReader(source)
+            )
+
+    def __len__(self):
+        return sum(self.counts)
+
+    def under(self, prefix):
+        """ The range of indexes of the calls to numbers starting with prefix
+        """
+        return range(
+            bisect_left(self._numbers, prefix),
+            bisect_left(self._numbers, prefix + PAST_DIGITS)
+        )
+
+
+class SimulationReport(object):
+    """ The outcome of WhatIf.simulate """
+
+    def __init__(self, total, evaluated, flips):
+        # calls in the sample, and those under a changed prefix
+        self.total = total
+        self.evaluated = evaluated
+        # Counter of the calls by Flip
+        self.flips = flips
+
+    @property
+    def flipped(self):
+        """ The number of calls whose decision changes """
+        return sum(self.flips.values())
+
+    def by_org(self):
+        """ The number of flipped calls by org_id """
+        counts = Counter()
+        for flip, count in self.flips.items():
+            counts[flip.org_id] += count
+        return counts
+
+    def newly_restricted(self):
+        """ The number of calls that were not restricted and would be """
+        return sum(
+            count for flip, count in self.flips.items()
+            if flip.after is False
+        )
+
+
+class WhatIf(object):
+    """ Simulates rule changes against a TrafficSample
+
+        Built from the rules as read from redis, decoded, see from_redis().
+        The rules themselves are left alone, each simulate() call compiles
+        the proposed rules separately.
+    """
+
+    def __init__(self, generic, trial, orgs):
+        self.generic = generic
+        self.trial = trial
+        self.orgs = orgs
+        self.current = RuleTrie.from_hashes(generic, trial, orgs)
+
+    @classmethod
+    def from_redis(cls, rule_ops):
+        """ Simulate against the rules in redis now """
+        _, generic, trial, orgs = rule_ops.snapshot()
+        return cls(
+            decode_hash(generic), decode_hash(trial),
+            {
+                decode(org_id): {
+                    decode(prefix): decode_rule(rule)
+                    for prefix, rule in rules.items()
+                }
+                for org_id, rules in orgs.items()
+            }
+        )
+
+    def proposed(self, changes):
+        """ The rules with the changes applied, as a RuleTrie """
+        generic = dict(self.generic)
+        trial = dict(self.trial)
+        orgs = dict(self.orgs)
+        for change in changes:
+            if change.tier == TIER_GENERIC:
+                rules = generic
+            elif change.tier == TIER_TRIAL:
+                rules = trial
+            else:
+                rules = orgs[change.org_id] = dict(
+                    orgs.get(change.org_id, {})
+                )
+            if change.rule is None:
+                rules.pop(change.prefix, None)
+            else:
+                rules[change.prefix] = change.rule
+        return RuleTrie.from_hashes(generic, trial, orgs)
+
+    def simulate(self, changes, sample):
+        """ Count the calls of the sample whose decision the changes flip
+
+            Returns a SimulationReport. Raises ValueError for an invalid
+            change, before evaluating anything.
+        """
+        changes = [_validate(change) for change in changes]
+        proposed = self.proposed(changes)
+        affected = set()
+        for change in changes:
+            for index in sample.under(change.prefix):
+                _, is_trial, org_id = sample.calls[index]
+                if change.tier == TIER_TRIAL and not is_trial:
+                    continue
+                if change.tier == TIER_ORG and org_id != change.org_id:
+                    continue
+                affected.add(index)
+        flips = Counter()
+        for index in affected:
+            call = sample.calls[index]
+            before, before_tier = self.current.decide(*call)
+            after, after_tier = proposed.decide(*call)
+            if before != after:
+                flips[Flip(
+                    call[2], after_tier or before_tier,
+                    _decision(before), _decision(after)
+                )] += sample.counts[index]
+        return SimulationReport(
+            len(sample), sum(sample.counts[index] for index in affected),
+            flips
+        )
+
+
+def _validate(change):
+    """ The change with its prefix and rule normalized like RuleOperations
+        does when pushing a rule
+    """
+    if change.tier not in (TIER_GENERIC, TIER_TRIAL, TIER_ORG):
+        raise ValueError("Unknown tier: {}".format(change.tier))
+    if change.tier == TIER_ORG and change.org_id is None:
+        raise ValueError("An org rule change needs an org_id")
+    rule = change.rule
+    if rule is not None:
+        rule = rule.lower()
+        if rule not in (R_ALLOW, R_RESTRICT):
+            raise ValueError("Unknown rule: {}".format(change.rule))
+    return change._replace(
+        prefix=RuleOperations._prefix(change.prefix), rule=rule
+    )
+
+
+def _decision(rule):
+    """ The rule as query_rule answers it """
+    if rule is None:
+        return None
+    return rule == R_ALLOW
@@ -4,16 +4,32 @@
 
 import os
 from flask import Flask
+from flask import jsonify
 from flask import request
-from flask_redis import FlaskRedis
-from phone_rule_engine import RuleOperations
+from phone_rule_engine.flask_ext import FlaskRuleEngine, CACHE_DECISIONS
 
 
 app = Flask(__name__)
 app.config["REDIS_URL"] = os.environ.get(
     "REDIS_URL", "redis://localhost:6379/0"
 )
-rules_op = RuleOperations(FlaskRedis(app))
+app.config["PHONE_RULES_POOL_SIZE"] = int(
+    os.environ.get("REDIS_POOL_SIZE", 20)
+)
+# users redial the same numbers many times a day, repeated calls are decided
+# without a round trip to redis until the rules change
+app.config["PHONE_RULES_CACHE"] = CACHE_DECISIONS
+app.config["PHONE_RULES_DECISION_CACHE_SIZE"] = int(
+    os.environ.get("DECISION_CACHE_SIZE", 10000)
+)
+app.config["PHONE_RULES_DECISION_CACHE_TTL"] = float(
+    os.environ.get("DECISION_CACHE_TTL", 60)
+)
+# query latencies and the tiers deciding are served at /metrics
+app.config["PHONE_RULES_METRICS"] = True
+# the development server doesn't fork, warm up right away, the readiness
+# endpoint is at /ready
+rules = FlaskRuleEngine(app)
 
 
 @app.before_request
@@ -25,7 +41,7 @@ def check_if_can_call():
         return
     is_trial = request.args.get('is_trial')
     org_id = request.args.get('org_id')
-    rule = rules_op.query_rule(phone_number, is_trial, org_id)
+    rule = rules.query_rule(phone_number, is_trial, org_id)
     if rule:
         app.logger.info(
             "Allowing call to (%s, %s, %s) based on explicit rule",
@@ -54,5 +70,10 @@ def hello(phone_number):
     )
 
 
+@app.route("/decision_cache")
+def decision_cache():
+    return jsonify(rules.cache.stats())
+
+
 if __name__ == "__main__":
     app.run()
@@ -0,0 +1,79 @@
+# -*- mode: Python; tab-width: 4; indent-tabs-mode: nil; -*-
+# ex: set tabstop=4 :
+# Please do not change the lines above. See PEP 8, PEP 263.
+""" The asyncio counterpart of phone_rule_flask, served by Quart """
+
+import os
+from quart import Quart
+from quart import request
+from redis.asyncio import StrictRedis
+from phone_rule_engine.aio import AsyncRuleOperations
+
+
+app = Quart(__name__)
+app.config["REDIS_URL"] = os.environ.get(
+    "REDIS_URL", "redis://localhost:6379/0"
+)
+rules_op = AsyncRuleOperations(StrictRedis.from_url(app.config["REDIS_URL"]))
+
+
+@app.before_serving
+async def load_scripts():
+    await rules_op.warmup()
+
+
+@app.before_request
+async def check_if_can_call():
+    if not request.view_args:
+        return
+    phone_number = request.view_args.get("phone_number")
+    if not phone_number:
+        return
+    is_trial = request.args.get('is_trial')
+    org_id = request.args.get('org_id')
+    rule = await rules_op.query_rule(phone_number, is_trial, org_id)
+    if rule:
+        app.logger.info(
+            "Allowing call to (%s, %s, %s) based on explicit rule",
+            phone_number, is_trial, org_id
+        )
+        return
+    if rule is None:
+        app.logger.info(
+            "Implicitly allowing call to (%s, %s, %s)",
+            phone_number, is_trial, org_id
+        )
+        return
+    app.logger.info(
+        "Blocking call to (%s, %s, %s)",
+        phone_number, is_trial, org_id
+    )
+    return "Calls to this number are not allowed\n", 200
+
+
+@app.route("/phone_call/<phone_number>", methods=("POST", ))
+async def hello(phone_number):
+    is_trial = request.args.get('is_trial', "false").lower() == "true"
+    org_id = request.args.get('org_id')
+    return "Calling {} (is_trial: {}, org_id: {}) ...\n".format(
+        phone_number, is_trial, org_id
+    )
+
+
+@app.route("/screen", methods=("POST", ))
+async def screen():
+    """ Check the numbers posted one per line, all of them concurrently """
+    is_trial = request.args.get('is_trial')
+    org_id = request.args.get('org_id')
+    numbers = (await request.get_data(as_text=True)).split()
+    rules = await rules_op.query_rules_concurrently(numbers, is_trial, org_id)
+    return "".join(
+        "{} {}\n".format(
+            number, "restricted" if rule is False else "allowed"
+        )
+        for number, rule in zip(numbers, rules)
+    )
+
+
+if __name__ == "__main__":
+    app.run()
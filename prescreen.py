@@ -0,0 +1,65 @@
+# -*- mode: Python; tab-width: 4; indent-tabs-mode: nil; -*-
+# ex: set tabstop=4 :
+# Please do not change the lines above. See PEP 8, PEP 263.
+"""
+ Screen a contact list against the rules of an organization
+
+ The list has one number per line, it's split between worker processes
+ that each hold a compiled snapshot of the rules and screen their part of
+ the file, see phone_rule_engine.screen. The allowed and restricted numbers
+ are written to separate files, in the order of the input.
+"""
+import argparse
+import time
+
+import redis
+
+from phone_rule_engine import RuleOperations
+from phone_rule_engine import screen
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Split a list of numbers in allowed and restricted ones'
+    )
+    parser.add_argument("input", help="file with one number per line")
+    parser.add_argument("--org-id", help="screen for this organization")
+    parser.add_argument("--trial", action="store_true",
+                        help="screen for a trial user")
+    parser.add_argument("--allowed",
+                        help="output for the allowed numbers, "
+                             "defaults to <input>.allowed")
+    parser.add_argument("--restricted",
+                        help="output for the restricted numbers, "
+                             "defaults to <input>.restricted")
+    parser.add_argument("--workers", type=int,
+                        help="worker processes, defaults to the CPU count")
+    parser.add_argument("--chunk-size", type=int, default=screen.CHUNK_SIZE,
+                        help="numbers a worker decides at a time")
+    parser.add_argument("--host", default="localhost",
+                        help="redis host to read the rules from")
+    parser.add_argument("--port", default="6379",
+                        help="redis port to read the rules from")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    rules = screen.rules_for(
+        RuleOperations(redis.StrictRedis(host=args.host, port=args.port)),
+        args.org_id
+    )
+    started = time.perf_counter()
+    allowed_count, restricted_count = screen.screen_file(
+        args.input,
+        args.allowed or args.input + ".allowed",
+        args.restricted or args.input + ".restricted",
+        rules, args.trial, args.org_id, args.workers, args.chunk_size
+    )
+    print("Screened {} numbers in {:.1f}s".format(
+        allowed_count + restricted_count, time.perf_counter() - started
+    ))
+    print("{} allowed, {} restricted".format(allowed_count, restricted_count))
+
+if __name__ == "__main__":
+    main()
@@ -11,6 +11,11 @@ from functools import lru_cache
 
 from phone_rule_engine  import RuleOperations
 
+try:
+    from phone_rule_engine import audit
+except ImportError:
+    audit = None
+
 
 class LuaTestCase(unittest.TestCase):
     """ Implements a descriptive test for Lua scripts
@@ -55,10 +60,26 @@ class LuaTestCase(unittest.TestCase):
 
     def expect(self, expected):
         """ Check the expected output fo running the script """
+        self.expect_many(expected)
         for each in expected:
             result = each[-1]
             args = [str(x) for x in each[:-1]]
             redis_result = self.rule_op.query_rule(*args)
+            self.assertEqual(
+                redis_result,
+                self.rule_op.compile_rules().query_rule(*args),
+                "The compiled rules disagree with redis for {}".format(args)
+            )
+            self.assertEqual(
+                redis_result,
+                self.rule_op.trace_rule(*args).decision,
+                "The trace disagrees with the query for {}".format(args)
+            )
+            self.assertEqual(
+                redis_result,
+                self.rule_op.explain_rule(*args).decision,
+                "The explanation disagrees with the query for {}".format(args)
+            )
             if redis_result == True:
                 redis_result = "allow"
             if redis_result == False:
@@ -71,3 +92,23 @@ class LuaTestCase(unittest.TestCase):
                     args, result, redis_result
                 )
             )
+
+    def expect_many(self, expected):
+        """ Check that the batch query agrees with the expected output """
+        numbers = [
+            (str(x[0]), str(x[1]), str(x[2])) for x in expected
+        ]
+        results = [
+            {True: "allow", False: "restrict"}.get(x, x)
+            for x in self.rule_op.query_rules_many(numbers, chunk_size=2)
+        ]
+        self.assertEqual([x[-1] for x in expected], results)
+        if audit is not None:
+            snapshot = audit.RuleSnapshot.from_redis(self.rule_op)
+            numbers, flags, org_ids = zip(*numbers)
+            self.assertEqual(results, [
+                {True: "allow", False: "restrict"}.get(
+                    audit.DECISIONS[x], audit.DECISIONS[x]
+                )
+                for x in snapshot.evaluate(numbers, flags, org_ids).tolist()
+            ], "The audit snapshot disagrees with redis")
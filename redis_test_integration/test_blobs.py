@@ -0,0 +1,195 @@
+# -*- mode: Python; tab-width: 4; indent-tabs-mode: nil; -*-
+# ex: set tabstop=4 :
+# Please do not change the lines above. See PEP 8, PEP 263.
+""" Integration test for deciding from the rule blobs """
+from uuid import uuid4
+
+import redis_test
+from phone_rule_engine import RuleOperations
+from phone_rule_engine import blob
+from phone_rule_engine.trie import decode_hash
+# imported as modules, so the tests don't run twice without blobs
+import test_delete_rules
+import test_generic_rules
+import test_org_rules
+import test_push_bulk
+import test_replace_rules
+import test_trial_rules
+
+
+class BlobGiven(object):
+    """ Decide from the blobs, checking them against the hashes """
+
+    def setUp(self):
+        super(BlobGiven, self).setUp()
+        self.rule_op = RuleOperations(self.redis, str(uuid4()), blobs=True)
+
+    def expect_many(self, expected):
+        # the first step of expect
+        self.expect_blobs()
+        super(BlobGiven, self).expect_many(expected)
+
+    def expect_blobs(self):
+        """ Every blob is what blob.pack makes of its hash """
+        keys = [
+            (self.rule_op._key("generic"), False),
+            (self.rule_op._key("trial"), False),
+            (self.rule_op.effective_trial_key, False),
+        ] + [
+            (self.rule_op._org_key(org_id), True)
+            for org_id in self.rule_op.org_ids()
+        ]
+        for key, codes in keys:
+            self.assertEqual(
+                blob.pack(self.redis.hgetall(key), codes),
+                (self.redis.get(self.rule_op._blob_key(key)) or b"").decode(),
+                "The blob of {} is stale".format(key)
+            )
+
+
+class BlobGenericTestCase(BlobGiven, test_generic_rules.NoCrosstalkTestCase):
+    pass
+
+
+class BlobStatsTestCase(BlobGiven, test_generic_rules.StatsTestCase):
+    pass
+
+
+class BlobTrialTestCase(BlobGiven, test_org_rules.TrialSpecificTestCase):
+    pass
+
+
+class BlobOrgTestCase(BlobGiven,
+                      test_trial_rules.OrganisationSpecificTestCase):
+    pass
+
+
+class BlobPushBulkTestCase(BlobGiven, test_push_bulk.PushBulkTestCase):
+    pass
+
+
+class BlobReplaceTestCase(BlobGiven, test_replace_rules.BulkTrialTestCase):
+    pass
+
+
+class BlobDeleteTestCase(BlobGiven, test_delete_rules.DeleteRulesTestCase):
+    pass
+
+
+class BlobTestCase(BlobGiven, redis_test.LuaTestCase):
+    """ Test writing and loading the blobs """
+
+    def given_rules(self):
+        self.given({
+            "rules": {"12": "restrict", "12345": "allow"},
+            "rules:trial": {"123": "allow"},
+            "rules:org": {"1234": "restrict"},
+        })
+
+    def test_load_blobs(self):
+        self.given_rules()
+        version, generic, trial, orgs = self.rule_op.snapshot()
+        self.assertEqual((
+            version, decode_hash(generic), decode_hash(trial),
+            {self.test_org_id: {"1234": "restrict"}}
+        ), self.rule_op.load_blobs())
+
+    def test_clear_org_deletes_its_blob(self):
+        self.given_rules()
+        self.rule_op.clear_org(self.test_org_id)
+        self.assertIsNone(self.redis.get(self.rule_op._blob_key(
+            self.rule_op._org_key(self.test_org_id)
+        )))
+        self.assertEqual({}, self.rule_op.load_blobs()[3])
+
+    def test_replace_deletes_blobs_of_orgs_gone(self):
+        self.given_rules()
+        self.rule_op.replace_rules({"40": "allow"}, {}, {"other-org": {
+            "41": "restrict"
+        }})
+        self.assertIsNone(self.redis.get(self.rule_op._blob_key(
+            self.rule_op._org_key(self.test_org_id)
+        )))
+        self.expect((
+            ("12", False, self.test_org_id, None),
+            ("407", True, self.test_org_id, "allow"),
+            ("417", False, "other-org", "restrict"),
+        ))
+
+    def test_compile_blobs(self):
+        """ Rules written without blobs are compiled on demand """
+        rule_op = self.rule_op
+        self.rule_op = RuleOperations(
+            self.redis, rule_op.key_prefix[:-1], cluster=rule_op.cluster
+        )
+        self.given_rules()
+        self.assertEqual(({}, {}, {}), rule_op.load_blobs()[1:])
+        self.rule_op = rule_op
+        self.rule_op.compile_blobs()
+        self.expect((
+            ("1230", False, "", "restrict"),
+            ("1230", True, "", "allow"),
+            ("12345", True, self.test_org_id, "restrict"),
+        ))
+
+    def test_writes_without_blobs(self):
+        """ Clients without blobs keep the blobs up to date once in use """
+        writer = RuleOperations(
+            self.redis, self.rule_op.key_prefix[:-1],
+            cluster=self.rule_op.cluster
+        )
+        writer.push_generic_rule("12", "restrict")
+        self.assertIsNone(self.redis.get(
+            self.rule_op._blob_key(self.rule_op._key("generic"))
+        ))
+        writer.compile_blobs()
+        writer.push_generic_rule("40", "allow")
+        writer.push_trial_rule("123", "allow")
+        writer.push_org_rule("41", "restrict", "other-org")
+        writer.delete_generic_rule("12")
+        self.expect((
+            ("1200", False, "", None),
+            ("1230", True, "", "allow"),
+            ("407", True, "", "allow"),
+            ("417", False, "other-org", "restrict"),
+        ))
+
+    def test_writes_after_a_client_with_blobs(self):
+        """ A write with blobs marks them in use for the other clients """
+        self.given_rules()
+        writer = RuleOperations(
+            self.redis, self.rule_op.key_prefix[:-1],
+            cluster=self.rule_op.cluster
+        )
+        writer.push_org_rule("12345", "allow", self.test_org_id)
+        writer.push_generic_rule("12", "allow")
+        writer.replace_rules({"40": "restrict"}, {"12": "allow"})
+        self.expect((
+            ("407", False, "", "restrict"),
+            ("1200", True, "", "allow"),
+            ("12345", True, self.test_org_id, "allow"),
+        ))
+
+    def test_codes_only_in_organizations(self):
+        """ A code written to a tier hash is as invalid as in its lookups """
+        self.given_rules()
+        self.redis.hset(self.rule_op._key("generic"), "45", "a")
+        self.rule_op.compile_blobs()
+        self.expect((
+            ("4500", False, "", None),
+            ("1200", False, "", "restrict"),
+            ("12345", True, self.test_org_id, "restrict"),
+        ))
+
+    def test_rebuild_effective_trial(self):
+        """ A rebuild recompiles the blobs of the rules written directly """
+        self.given_rules()
+        version = self.rule_op.get_version()
+        self.redis.hset(self.rule_op._key("generic"), "12", "allow")
+        self.rule_op.rebuild_effective_trial()
+        self.assertEqual(version + 1, self.rule_op.get_version())
+        self.expect((
+            ("1200", False, "", "allow"),
+            ("1200", True, "", "allow"),
+            ("12345", True, self.test_org_id, "restrict"),
+        ))
@@ -0,0 +1,136 @@
+# -*- mode: Python; tab-width: 4; indent-tabs-mode: nil; -*-
+# ex: set tabstop=4 :
+# Please do not change the lines above. See PEP 8, PEP 263.
+""" Run the rule tests against a redis cluster
+
+    Skipped unless REDIS_CLUSTER_PORT names a node of a running cluster, see
+    test_cluster.sh. Needs a redis client with cluster support ( 4.1+ ).
+"""
+
+import os
+import unittest
+from uuid import uuid4
+
+import redis_test
+from phone_rule_engine import RuleOperations
+# imported as modules, so the tests don't run twice against a single redis
+import test_org_rules
+import test_trial_rules
+import test_replace_rules
+import test_push_bulk
+import test_delete_rules
+import test_blobs
+
+try:
+    from redis.cluster import RedisCluster
+except ImportError:
+    RedisCluster = None
+
+CLUSTER_PORT = os.environ.get("REDIS_CLUSTER_PORT")
+
+
+@unittest.skipUnless(CLUSTER_PORT and RedisCluster,
+                     "REDIS_CLUSTER_PORT not set or no cluster support")
+class ClusterGiven(object):
+    """ Talk to the cluster instead of a single redis """
+
+    def setUp(self):
+        super(ClusterGiven, self).setUp()
+        self.redis = RedisCluster(host='localhost', port=CLUSTER_PORT)
+        self.rule_op = RuleOperations(self.redis, str(uuid4()), cluster=True)
+
+
+class ClusterTrialTestCase(ClusterGiven,
+                           test_org_rules.TrialSpecificTestCase):
+    pass
+
+
+class ClusterTrialCrosstalkTestCase(ClusterGiven,
+                                    test_org_rules.TrialCrosstalkTestCase):
+    pass
+
+
+class ClusterOrgTestCase(ClusterGiven,
+                         test_trial_rules.OrganisationSpecificTestCase):
+    pass
+
+
+class ClusterBulkTestCase(ClusterGiven, test_replace_rules.BulkTrialTestCase):
+    pass
+
+
+class ClusterPushBulkTestCase(ClusterGiven, test_push_bulk.PushBulkTestCase):
+    pass
+
+
+class ClusterPushBulkOrgTestCase(ClusterGiven,
+                                 test_push_bulk.PushBulkOrgTestCase):
+    pass
+
+
+class ClusterDeleteRulesTestCase(ClusterGiven,
+                                 test_delete_rules.DeleteRulesTestCase):
+    pass
+
+
+class ClusterBlobGiven(ClusterGiven):
+    """ Decide from the blobs on the cluster """
+
+    def setUp(self):
+        super(ClusterBlobGiven, self).setUp()
+        self.rule_op = RuleOperations(
+            self.redis, str(uuid4()), cluster=True, blobs=True
+        )
+
+
+class ClusterBlobTestCase(ClusterBlobGiven, test_blobs.BlobTestCase):
+    pass
+
+
+class ClusterBlobOrgTestCase(ClusterBlobGiven, test_blobs.BlobOrgTestCase):
+    pass
+
+
+class ClusterBlobDeleteTestCase(ClusterBlobGiven,
+                                test_blobs.BlobDeleteTestCase):
+    pass
+
+
+class ClusterShardingTestCase(ClusterGiven, redis_test.LuaTestCase):
+    """ Test that the organizations are spread over the cluster """
+
+    def given_orgs(self, count):
+        org = {
+            "org-{}".format(i): {"1{}".format(i % 10): "allow"}
+            for i in range(count)
+        }
+        self.rule_op.replace_rules({"1": "restrict"}, {}, org)
+        return org
+
+    def test_orgs_on_many_nodes(self):
+        org = self.given_orgs(30)
+        nodes = set(
+            self.redis.get_node_from_key(self.rule_op._org_key(org_id)).name
+            for org_id in org
+        )
+        self.assertTrue(len(nodes) > 1, nodes)
+        self.assertEqual(sorted(org), self.rule_op.org_ids())
+
+    def test_org_queries(self):
+        self.given_orgs(30)
+        self.rule_op.push_org_rule("123", "restrict", "org-2")
+        self.expect((
+            ("123", False, "org-2", "restrict"),
+            ("129", False, "org-2", "allow"),
+            ("129", False, "org-3", "restrict"),
+            ("139", True, "org-3", "allow"),
+            ("139", True, "no-such-org", "restrict"),
+            ("900", False, "org-3", None),
+        ))
+
+    def test_snapshot(self):
+        org = self.given_orgs(3)
+        version, generic, _, orgs = self.rule_op.snapshot()
+        self.assertEqual(self.rule_op.get_version(), version)
+        self.assertEqual({b"1": b"restrict"}, generic)
+        self.assertEqual(sorted(org), sorted(orgs))
@@ -0,0 +1,36 @@
+#!/bin/bash
+#
+# Bring up a redis cluster in docker and run the cluster tests against it,
+# needs a redis client with cluster support
+#
+set -e 
+
+cd "$(dirname "$(realpath "$0")")";
+
+source ../common.sh
+
+REDIS_CLUSTER_CONTAINER_NAME="${REDIS_TEST_CONTAINER_NAME}-cluster"
+# nodes on 7000-7005, three masters with a replica each
+REDIS_CLUSTER_IMAGE="grokzen/redis-cluster:6.2.0"
+
+if ! [ -d venv-cluster ] ; then 
+    echo "Creating virtual environment"
+    virtualenv --python=python3 venv-cluster
+fi
+
+echo "Install dependencies..."
+venv-cluster/bin/pip install 'redis>=4.1' --upgrade
+
+echo "Starting the redis cluster in a container"
+docker rm -f $REDIS_CLUSTER_CONTAINER_NAME > /dev/null 2>&1 || true
+docker run -d --name $REDIS_CLUSTER_CONTAINER_NAME --net host \
+    -e IP=127.0.0.1 $REDIS_CLUSTER_IMAGE > /dev/null
+until docker exec $REDIS_CLUSTER_CONTAINER_NAME \
+        redis-cli -p 7000 cluster info 2>/dev/null | grep -q 'cluster_state:ok' ; do
+    sleep 1
+done
+
+echo
+export REDIS_CLUSTER_PORT=7000
+export PYTHONPATH=`realpath $PWD/../`:$PYTHONPATH
+exec venv-cluster/bin/python -m unittest test_cluster
@@ -0,0 +1,95 @@
+# -*- mode: Python; tab-width: 4; indent-tabs-mode: nil; -*-
+# ex: set tabstop=4 :
+# Please do not change the lines above. See PEP 8, PEP 263.
+""" Integration test for deleting rules """
+import redis_test
+
+
+class DeleteRulesTestCase(redis_test.LuaTestCase):
+    """ Test removing rules and what they leave behind """
+
+    def given_rules(self):
+        self.given({
+            "rules": {"12": "restrict", "12345": "allow", "13": "allow"},
+            "rules:trial": {"123": "restrict"},
+            "rules:org": {"12": "allow", "1234": "restrict"},
+        })
+
+    def lengths(self, key):
+        return [int(x) for x in self.redis.zrange(key + ":lengths", 0, -1)]
+
+    def stems(self, key):
+        return sorted(x.decode() for x in self.redis.hkeys(key + ":stems"))
+
+    def test_delete_generic(self):
+        self.given_rules()
+        key = self.rule_op._key("generic")
+        self.assertEqual("allow", self.rule_op.delete_generic_rule("+12345"))
+        self.assertIsNone(self.rule_op.delete_generic_rule("40"))
+        self.assertEqual([2], self.lengths(key))
+        self.assertEqual(["", "1", "12", "13"], self.stems(key))
+        self.expect((
+            ("12345", False, "", "restrict"),
+            ("12345", True, "", "restrict"),
+            ("130", True, "", "allow"),
+        ))
+
+    def test_delete_trial(self):
+        self.given_rules()
+        key = self.rule_op.effective_trial_key
+        self.assertEqual("restrict", self.rule_op.delete_trial_rule("123"))
+        self.assertEqual([], self.lengths(self.rule_op._key("trial")))
+        # the generic rules under the trial rule are effective again
+        self.assertEqual([2, 5], self.lengths(key))
+        self.assertEqual(
+            ["", "1", "12", "123", "1234", "12345", "13"], self.stems(key)
+        )
+        self.expect((
+            ("1234", True, "", "restrict"),
+            ("12345", True, "", "allow"),
+        ))
+
+    def test_delete_org(self):
+        self.given_rules()
+        self.assertEqual(
+            "allow", self.rule_op.delete_org_rule("12", self.test_org_id)
+        )
+        self.assertEqual([self.test_org_id], self.rule_op.org_ids())
+        self.expect((
+            ("120", False, self.test_org_id, "restrict"),
+            ("130", False, self.test_org_id, "allow"),
+        ))
+        self.assertEqual(
+            "restrict",
+            self.rule_op.delete_org_rule("1234", self.test_org_id)
+        )
+        self.assertEqual([], self.rule_op.org_ids())
+        self.assertFalse(
+            self.redis.exists(self.rule_op._org_key(self.test_org_id))
+        )
+        self.assertIsNone(
+            self.rule_op.delete_org_rule("1234", self.test_org_id)
+        )
+        self.expect((("12345", False, self.test_org_id, "allow"),))
+
+    def test_clear_org(self):
+        self.given_rules()
+        version = self.rule_op.get_version()
+        self.assertEqual(
+            {"12": "allow", "1234": "restrict"},
+            self.rule_op.clear_org(self.test_org_id)
+        )
+        self.assertEqual(version + 1, self.rule_op.get_version())
+        self.assertEqual([], self.rule_op.org_ids())
+        self.assertEqual({}, self.rule_op.clear_org(self.test_org_id))
+        self.expect((
+            ("1234", False, self.test_org_id, "restrict"),
+        ))
+        trace = self.rule_op.trace_rule("1234", False, self.test_org_id)
+        self.assertEqual("generic", trace.tier)
+
+    def test_validation(self):
+        with self.assertRaises(ValueError):
+            self.rule_op.delete_generic_rule("1x")
+        with self.assertRaises(ValueError):
+            self.rule_op.delete_org_rule("", self.test_org_id)
@@ -10,6 +10,9 @@
     - there is no relation between 123 and 23
 """
 import redis_test
+from phone_rule_engine.explain import Explanation, RuleMatch
+from phone_rule_engine.explain import group_by_prefix
+from phone_rule_engine.metrics import RuleMetrics
 
 
 class GenericTestCase(redis_test.LuaTestCase):
@@ -84,6 +87,19 @@ class GenericTestCase(redis_test.LuaTestCase):
             ("10", "restrict"),
         ))
 
+    def test_invalid_rules_ignored(self):
+        """ An invalid rule falls back to the next shorter prefix """
+        self.given({
+            "rules": {
+                "12": "restrict",
+            }
+        })
+        self.redis.hset(self.rule_op.key_prefix + "rules", "123", "foobar")
+        self.expect((
+            ("1234", "restrict"),
+            ("12", "restrict"),
+        ))
+
     def expect(self, expected_result):
         return super(GenericTestCase, self).expect(
             [(x[0], False, "any-org-id", x[1]) for x in expected_result]
@@ -155,3 +171,219 @@ class NoCrosstalkTestCase(GenericTestCase):
             },
         })
         super(NoCrosstalkTestCase, self).test_multi_level_nesting()
+
+
+class ScriptCacheTestCase(GenericTestCase):
+    """ Test that the rules keep working when redis forgets the scripts """
+
+    def expect(self, expected_result):
+        self.redis.script_flush()
+        super(ScriptCacheTestCase, self).expect(expected_result)
+
+    def test_warmup(self):
+        self.redis.script_flush()
+        sha = self.rule_op.script_sha
+        self.rule_op.warmup()
+        self.assertEqual(sha, self.rule_op.script_sha)
+        self.assertEqual([True], self.redis.script_exists(sha))
+
+
+class StatsTestCase(redis_test.LuaTestCase):
+    """ Test the decision and warning counters """
+
+    def test_counters(self):
+        """ Every sampled call counts with the sampling interval """
+        self.rule_op.stats_every = 1
+        self.rule_op.debug = True
+        self.given({
+            "rules": {"12": "restrict"},
+            "rules:trial": {"123": "allow"},
+        })
+        self.rule_op.query_rule("120")
+        self.rule_op.query_rule("1230", True)
+        self.rule_op.query_rules_many(["40", "41"])
+        self.assertEqual({
+            "decision:generic:restrict": 1,
+            "decision:trial:allow": 1,
+            "decision:none": 2,
+            "warn:trial_allow": 1,
+        }, self.rule_op.get_stats())
+
+    def test_sampling(self):
+        """ Only one in stats_every calls is counted """
+        self.rule_op.stats_every = 10
+        for _ in range(20):
+            self.rule_op.query_rule("40")
+        self.assertEqual({"decision:none": 20}, self.rule_op.get_stats())
+
+
+class TraceTestCase(redis_test.LuaTestCase):
+    """ Test the decision traces and metrics """
+
+    def setUp(self):
+        super(TraceTestCase, self).setUp()
+        self.given({
+            "rules": {"12": "restrict", "1234": "allow"},
+            "rules:trial": {"123": "restrict"},
+            "rules:org": {"12345": "allow"},
+        })
+
+    def assertTrace(self, tier, prefix, probes, *args):
+        trace = self.rule_op.trace_rule(*args)
+        self.assertEqual(
+            (tier, prefix, probes), (trace.tier, trace.prefix, trace.probes)
+        )
+        self.assertTrue(0 <= trace.server_seconds <= trace.seconds)
+
+    def test_tiers(self):
+        self.assertTrace("org", "12345", 6, "123456", False,
+                         self.test_org_id)
+        # every prefix of the organization without rules, then the generic
+        # lengths in use: 4 and 2
+        self.assertTrace("generic", "1234", 8, "123456", False, "other-org")
+        # the effective trial rules have lengths 4, 3 and 2, no rule starts
+        # with 1239 or 129
+        self.assertTrace("trial", "123", 2, "1239", True)
+        self.assertTrace("generic", "12", 1, "1299", True)
+        self.assertTrace(None, None, 0, "40", False)
+
+    def test_metrics(self):
+        metrics = RuleMetrics(trace_every=2)
+        self.rule_op.metrics = metrics
+        for _ in range(4):
+            self.assertFalse(self.rule_op.query_rule("129"))
+        self.rule_op.trace_rule("40")
+        self.assertEqual(4 + 1, metrics.latency.count)
+        self.assertEqual(2 + 1, metrics.probes.count)
+        self.assertEqual(
+            {("generic", "restrict"): 2, ("none", "none"): 1},
+            metrics.decisions
+        )
+        self.assertIn(
+            'phone_rules_traced_decisions_total'
+            '{tier="generic",decision="restrict"} 2',
+            metrics.render()
+        )
+
+
+class ExplainTestCase(redis_test.LuaTestCase):
+    """ Test the explanations of the decisions """
+
+    def setUp(self):
+        super(ExplainTestCase, self).setUp()
+        self.given({
+            "rules": {"12": "restrict", "1234": "allow"},
+            "rules:trial": {"123": "restrict"},
+            "rules:org": {"12": "allow"},
+        })
+
+    def test_shadowed(self):
+        self.assertEqual(
+            Explanation(True, "org", "12", (
+                RuleMatch("trial", "123", "restrict"),
+                RuleMatch("generic", "1234", "allow"),
+            )),
+            self.rule_op.explain_rule("123456", True, self.test_org_id)
+        )
+        self.assertEqual(
+            Explanation(False, "trial", "123", (
+                RuleMatch("generic", "1234", "allow"),
+            )),
+            self.rule_op.explain_rule("123456", True)
+        )
+        self.assertEqual(
+            Explanation(None, None, None, ()),
+            self.rule_op.explain_rule("40", True, self.test_org_id)
+        )
+
+    def test_group_by_prefix(self):
+        numbers = ["1200", "1201", "1234", "1230", "40"]
+        explanations = self.rule_op.explain_rules_many(
+            numbers, True, chunk_size=2
+        )
+        self.assertEqual(
+            {
+                ("generic", "12"): ["1200", "1201"],
+                ("trial", "123"): ["1234", "1230"],
+            },
+            group_by_prefix(numbers, explanations)
+        )
+
+
+class PrefixLengthsTestCase(redis_test.LuaTestCase):
+    """ Test the indexes of the prefix lengths in use """
+
+    def test_only_lengths_in_use_are_indexed(self):
+        self.given({
+            "rules": {"12": "restrict", "45": "allow", "12345": "allow"},
+        })
+        self.assertEqual(
+            [b"2", b"5"],
+            self.redis.zrange(self.rule_op.key_prefix + "rules:lengths", 0, -1)
+        )
+
+    def test_rebuild(self):
+        """ Rules written directly to redis are found after a rebuild """
+        self.given({
+            "rules": {"12": "restrict"},
+        })
+        self.redis.hset(self.rule_op.key_prefix + "rules", "1234", "allow")
+        self.assertFalse(self.rule_op.query_rule("12345"))
+        self.rule_op.rebuild_prefix_lengths()
+        self.expect((
+            ("12345", False, "", "allow"),
+            ("1235", False, "", "restrict"),
+        ))
+
+
+class StemsTestCase(redis_test.LuaTestCase):
+    """ Test the indexes of the prefixes rules start with """
+
+    def test_every_prefix_is_a_stem(self):
+        self.given({
+            "rules": {"12": "restrict", "134": "allow"},
+            "rules:org": {"45": "allow"},
+        })
+        self.assertEqual(
+            {b"", b"1", b"12", b"13", b"134"},
+            set(self.redis.hkeys(self.rule_op.key_prefix + "rules:stems"))
+        )
+        self.expect((
+            ("1345", False, "", "allow"),
+            ("1355", False, "", None),
+            ("2345", False, "", None),
+            ("4567", False, self.test_org_id, "allow"),
+            ("4767", False, self.test_org_id, None),
+        ))
+
+    def test_missing_index(self):
+        """ Rules written before the index existed are still found """
+        self.given({
+            "rules": {"12": "restrict", "134": "allow"},
+            "rules:trial": {"1": "allow"},
+        })
+        self.redis.delete(
+            self.rule_op.key_prefix + "rules:stems",
+            self.rule_op.effective_trial_key + ":stems"
+        )
+        self.expect((
+            ("1345", False, "", "allow"),
+            ("1255", False, "", "restrict"),
+            ("1255", True, "", "allow"),
+            ("2345", False, "", None),
+        ))
+
+    def test_stale_stems(self):
+        """ Stems of removed rules only cost extra lookups """
+        self.given({
+            "rules": {"12": "restrict", "1234": "allow"},
+        })
+        self.redis.hdel(self.rule_op.key_prefix + "rules", "1234")
+        self.expect((
+            ("12345", False, "", "restrict"),
+        ))
+        self.rule_op.rebuild_prefix_lengths()
+        self.assertEqual(
+            {b"", b"1", b"12"},
+            set(self.redis.hkeys(self.rule_op.key_prefix + "rules:stems"))
+        )
@@ -149,3 +149,172 @@ class TrialCrosstalkTestCase(TrialSpecificTestCase):
             }
         })
         super(TrialCrosstalkTestCase, self).test_trial_allowance()
+
+
+class EffectiveTrialTestCase(redis_test.LuaTestCase):
+    """ Test that the effective trial rules follow every change """
+
+    def test_generic_pushed_after_trial(self):
+        """ A more specific generic rule doesn't override a trial rule """
+        self.rule_op.push_trial_rule("12", "restrict")
+        self.rule_op.push_generic_rule("123", "allow")
+        self.rule_op.push_generic_rule("13", "allow")
+        self.expect((
+            ("1234", True, "any-org-id", "restrict"),
+            ("1234", False, "any-org-id", "allow"),
+            ("130", True, "any-org-id", "allow"),
+        ))
+
+    def test_trial_pushed_after_generic(self):
+        """ A trial rule shadows the more specific generic rules """
+        self.rule_op.push_generic_rule("123", "allow")
+        self.rule_op.push_trial_rule("12", "restrict")
+        self.rule_op.push_trial_rule("12", "allow")
+        self.expect((
+            ("1234", True, "any-org-id", "allow"),
+            ("120", True, "any-org-id", "allow"),
+        ))
+
+    def test_only_rules_under_the_prefix(self):
+        """ A push only recomputes the prefixes under it, found trough the
+            stems indexes
+        """
+        self.rule_op.push_rules_bulk(
+            {"4{}".format(i): "allow" for i in range(100)},
+            {"12": "restrict"}
+        )
+        self.rule_op.push_generic_rule("1234", "allow")
+        self.rule_op.push_generic_rule("12345", "restrict")
+        recomputed = self.rule_op._effective_script(
+            keys=self.rule_op._effective_keys(), args=("123", )
+        )
+        # 123, 1234 and 12345, as stems of the generic rules
+        self.assertEqual(3, recomputed)
+        self.rule_op.push_trial_rule("1", "allow")
+        self.expect((
+            ("12345", True, "", "restrict"),
+            ("120", True, "", "restrict"),
+            ("110", True, "", "allow"),
+            ("410", True, "", "allow"),
+            ("12345", False, "", "restrict"),
+        ))
+
+    def test_rules_without_stems(self):
+        """ Rules written before the stems indexes are still recomputed """
+        self.redis.hset(self.rule_op.key_prefix + "rules", "123", "allow")
+        self.rule_op.push_trial_rule("12", "restrict")
+        self.assertEqual(
+            {b"12": b"restrict"},
+            self.redis.hgetall(self.rule_op.effective_trial_key)
+        )
+        self.rule_op.delete_trial_rule("12")
+        self.assertEqual(
+            {b"123": b"allow"},
+            self.redis.hgetall(self.rule_op.effective_trial_key)
+        )
+
+    def test_rebuild(self):
+        """ Rules written directly to redis are picked up by a rebuild """
+        self.redis.hset(self.rule_op.key_prefix + "rules", "123", "allow")
+        self.redis.hset(self.rule_op.key_prefix + "rules", "45", "restrict")
+        self.redis.hset(
+            self.rule_op.key_prefix + "rules:trial", "12", "restrict"
+        )
+        self.rule_op.rebuild_effective_trial()
+        self.assertEqual(
+            {b"12": b"restrict", b"45": b"restrict"},
+            self.redis.hgetall(self.rule_op.effective_trial_key)
+        )
+
+    def test_without_effective_trial_rules(self):
+        """ Until rebuild_effective_trial runs after an upgrade, the trial
+            rules are looked up before the generic ones
+        """
+        self.rule_op.stats_every = 1
+        self.rule_op.push_trial_rule("12", "restrict")
+        self.rule_op.push_generic_rule("123", "allow")
+        self.rule_op.push_generic_rule("45", "restrict")
+        self.redis.delete(
+            self.rule_op.effective_trial_key,
+            self.rule_op.effective_trial_key + ":lengths",
+            self.rule_op.effective_trial_key + ":stems"
+        )
+        self.expect((
+            ("1234", True, "", "restrict"),
+            ("450", True, "", "restrict"),
+            ("130", True, "", None),
+            ("1234", False, "", "allow"),
+        ))
+        self.assertEqual(
+            ("trial", "12"), self.rule_op.trace_rule("1234", True)[1:3]
+        )
+        self.assertTrue(self.rule_op.get_stats()["warn:no_effective_trial"])
+        self.rule_op.rebuild_effective_trial()
+        self.assertEqual(
+            {b"12": b"restrict", b"45": b"restrict"},
+            self.redis.hgetall(self.rule_op.effective_trial_key)
+        )
+
+
+class OrgStorageTestCase(redis_test.LuaTestCase):
+    """ Test the hash of rule codes of each organization """
+
+    def org_key(self, org_id):
+        return "{}rules:org:{{{}}}".format(self.rule_op.key_prefix, org_id)
+
+    def test_rule_codes(self):
+        self.given({
+            "rules:org": {"12": "allow", "123": "restrict"},
+        })
+        self.assertEqual(
+            {b"12": b"a", b"123": b"r"},
+            self.redis.hgetall(self.org_key(self.test_org_id))
+        )
+        self.assertEqual([self.test_org_id], self.rule_op.org_ids())
+
+    def test_migrate(self):
+        """ The rules of enabled organizations move to their own hash """
+        legacy = self.rule_op.key_prefix + "rules:org"
+        self.redis.hmset(legacy, {
+            "some-org": "enable",
+            "some-org:12": "allow",
+            "some-org:123": "restrict",
+            "other-org:12": "allow",
+        })
+        self.rule_op.push_org_rule("123", "allow", "some-org")
+        self.assertEqual(
+            {"some-org": {"12": "allow", "123": "restrict"}},
+            self.rule_op.migrate_org_rules(dry_run=True)
+        )
+        self.assertTrue(self.redis.exists(legacy))
+        self.rule_op.migrate_org_rules()
+        self.assertFalse(self.redis.exists(legacy))
+        self.assertEqual(["some-org"], self.rule_op.org_ids())
+        self.expect((
+            ("1234", False, "some-org", "allow"),
+            ("1200", False, "some-org", "allow"),
+            ("1200", False, "other-org", None),
+        ))
+
+    def test_batch_of_organizations(self):
+        """ Each number of a batch is decided with its own organization """
+        self.rule_op.push_org_rule("12", "allow", "some-org")
+        self.rule_op.push_org_rule("12", "restrict", "other-org")
+        self.rule_op.push_generic_rule("1", "restrict")
+        numbers = [
+            ("1200", False, "other-org"),
+            ("1201", False, "some-org"),
+            ("1202", False, None),
+            ("1203", False, "other-org"),
+        ]
+        self.assertEqual(
+            [False, True, False, False],
+            self.rule_op.query_rules_many(numbers, chunk_size=3)
+        )
+        self.assertEqual(
+            [("org", "12"), ("org", "12"), ("generic", "1"), ("org", "12")],
+            [
+                (explanation.tier, explanation.prefix) for explanation
+                in self.rule_op.explain_rules_many(numbers, chunk_size=3)
+            ]
+        )
@@ -0,0 +1,127 @@
+# -*- mode: Python; tab-width: 4; indent-tabs-mode: nil; -*-
+# ex: set tabstop=4 :
+# Please do not change the lines above. See PEP 8, PEP 263.
+""" Integration test for pushing many rules in one transaction """
+import json
+
+import redis_test
+from test_generic_rules import NoCrosstalkTestCase
+from test_org_rules import TrialSpecificTestCase
+from test_trial_rules import OrganisationSpecificTestCase
+
+
+class PushBulkGiven(object):
+    """ Load the test data with push_rules_bulk instead of the push methods
+    """
+
+    def given(self, data):
+        test_data = {}
+        test_data.update(self.defaultGiven)
+        test_data.update(data)
+        self.rule_op.push_rules_bulk(
+            test_data["rules"],
+            test_data["rules:trial"],
+            {self.test_org_id: test_data["rules:org"]}
+        )
+
+
+class PushBulkGenericTestCase(PushBulkGiven, NoCrosstalkTestCase):
+    """ The generic decisions are the same for rules pushed in bulk """
+
+
+class PushBulkTrialTestCase(PushBulkGiven, TrialSpecificTestCase):
+    """ The trial decisions are the same for rules pushed in bulk """
+
+
+class PushBulkOrgTestCase(PushBulkGiven, OrganisationSpecificTestCase):
+    """ The organization decisions are the same for rules pushed in bulk """
+
+
+class PushBulkTestCase(redis_test.LuaTestCase):
+    """ Test pushing many rules at once """
+
+    def test_previous_rules(self):
+        self.given({
+            "rules": {"12": "restrict"},
+            "rules:org": {"123": "allow"},
+        })
+        previous = self.rule_op.push_rules_bulk(
+            {"12": "allow", "+13": "restrict"},
+            org={self.test_org_id: {"123": "restrict", "14": "allow"}}
+        )
+        self.assertEqual({
+            "generic": {"12": "restrict", "13": None},
+            "trial": {},
+            "org": {self.test_org_id: {"123": "allow", "14": None}},
+        }, previous)
+        self.expect((
+            ("120", False, "", "allow"),
+            ("130", True, "", "restrict"),
+            ("1234", False, self.test_org_id, "restrict"),
+            ("140", False, self.test_org_id, "allow"),
+        ))
+
+    def test_one_version_and_event(self):
+        version = self.rule_op.get_version()
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(self.rule_op.changes_channel)
+        pubsub.get_message(timeout=1)
+        self.rule_op.push_rules_bulk(
+            org={self.test_org_id: {str(i): "allow" for i in range(10, 60)}}
+        )
+        self.assertEqual(version + 1, self.rule_op.get_version())
+        event = json.loads(pubsub.get_message(timeout=1)["data"].decode())
+        self.assertEqual(
+            {"version": version + 1, "tier": "org",
+             "org_id": self.test_org_id},
+            event
+        )
+        self.rule_op.push_rules_bulk({"1": "allow"}, {"1": "restrict"})
+        event = json.loads(pubsub.get_message(timeout=1)["data"].decode())
+        self.assertEqual("all", event["tier"])
+        pubsub.close()
+
+    def test_nothing_to_push(self):
+        version = self.rule_op.get_version()
+        self.assertEqual(
+            {"generic": {}, "trial": {}, "org": {}},
+            self.rule_op.push_rules_bulk(org={self.test_org_id: {}})
+        )
+        self.assertEqual(version, self.rule_op.get_version())
+
+    def test_effective_trial_matches_pushes(self):
+        """ The effective trial rules are those of pushing one at a time """
+        generic = {"1": "allow", "123": "allow", "13": "restrict"}
+        trial = {"12": "restrict", "1234": "allow"}
+        self.given({"rules": generic, "rules:trial": trial})
+        pushed = self.redis.hgetall(self.rule_op.effective_trial_key)
+        self.rule_op.replace_rules({}, {})
+        self.rule_op.push_rules_bulk(generic, trial)
+        self.assertEqual(
+            pushed, self.redis.hgetall(self.rule_op.effective_trial_key)
+        )
+
+    def test_transaction(self):
+        with self.rule_op.transaction() as changes:
+            changes.push_generic_rule("12", "restrict")
+            changes.push_trial_rule("12", "ALLOW")
+            changes.push_org_rule("123", "allow", self.test_org_id)
+            changes.push_generic_rule("12", "allow")
+        self.assertEqual({"12": None}, changes.previous["generic"])
+        self.expect((
+            ("120", False, "", "allow"),
+            ("1234", False, self.test_org_id, "allow"),
+        ))
+
+    def test_invalid_change_writes_nothing(self):
+        version = self.rule_op.get_version()
+        with self.assertRaises(ValueError):
+            with self.rule_op.transaction() as changes:
+                changes.push_generic_rule("12", "restrict")
+                changes.push_generic_rule("1x", "restrict")
+        with self.assertRaises(ValueError):
+            self.rule_op.push_rules_bulk(
+                {"12": "restrict"}, org={self.test_org_id: {"13": "deny"}}
+            )
+        self.assertEqual(version, self.rule_op.get_version())
+        self.expect((("120", False, "", None),))
@@ -0,0 +1,88 @@
+# -*- mode: Python; tab-width: 4; indent-tabs-mode: nil; -*-
+# ex: set tabstop=4 :
+# Please do not change the lines above. See PEP 8, PEP 263.
+""" Integration test for replacing all the rules at once """
+import redis_test
+from test_generic_rules import NoCrosstalkTestCase
+from test_org_rules import TrialSpecificTestCase
+
+
+class BulkGiven(object):
+    """ Load the test data with replace_rules instead of the push methods """
+
+    def given(self, data):
+        test_data = {}
+        test_data.update(self.defaultGiven)
+        test_data.update(data)
+        self.rule_op.replace_rules(
+            test_data["rules"],
+            test_data["rules:trial"],
+            {self.test_org_id: test_data["rules:org"]}
+        )
+
+
+class BulkGenericTestCase(BulkGiven, NoCrosstalkTestCase):
+    """ The generic decisions are the same for bulk loaded rules """
+
+
+class BulkTrialTestCase(BulkGiven, TrialSpecificTestCase):
+    """ The trial decisions are the same for bulk loaded rules """
+
+
+class ReplaceRulesTestCase(redis_test.LuaTestCase):
+    """ Test swapping in a whole rule set """
+
+    def test_replaces_everything(self):
+        """ Rules missing from the new set are gone, lengths included """
+        self.given({
+            "rules": {"12": "restrict", "12345": "allow"},
+            "rules:trial": {"40": "restrict"},
+            "rules:org": {"123": "allow"},
+        })
+        self.rule_op.replace_rules({"13": "restrict"}, {})
+        self.expect((
+            ("12345", False, "", None),
+            ("130", True, "", "restrict"),
+            ("400", True, "", None),
+            ("1234", False, self.test_org_id, "allow"),
+        ))
+        self.assertEqual(
+            [b"2"],
+            self.redis.zrange(self.rule_op.key_prefix + "rules:lengths", 0, -1)
+        )
+        self.assertFalse(
+            self.redis.exists(self.rule_op.key_prefix + "rules:trial")
+        )
+        self.assertEqual([], self.redis.keys(self.rule_op.key_prefix + "*:staging"))
+
+    def test_effective_trial_matches_pushes(self):
+        """ The bulk computed effective trial rules are the incremental ones
+        """
+        generic = {"1": "allow", "123": "allow", "13": "restrict"}
+        trial = {"12": "restrict", "1234": "allow"}
+        self.given({"rules": generic, "rules:trial": trial})
+        pushed = self.redis.hgetall(self.rule_op.effective_trial_key)
+        self.rule_op.replace_rules(generic, trial)
+        self.assertEqual(
+            pushed, self.redis.hgetall(self.rule_op.effective_trial_key)
+        )
+
+    def test_diff_and_dry_run(self):
+        self.given({
+            "rules": {"12": "restrict", "13": "allow"},
+        })
+        version = self.rule_op.get_version()
+        diff = self.rule_op.replace_rules(
+            {"12": "allow", "14": "allow"}, {}, dry_run=True
+        )
+        self.assertEqual({
+            "added": {"14": "allow"},
+            "removed": {"13": "allow"},
+            "changed": {"12": ("restrict", "allow")},
+        }, diff["generic"])
+        self.assertEqual(version, self.rule_op.get_version())
+        self.assertFalse(self.rule_op.query_rule("120"))
+
+        self.rule_op.replace_rules({"12": "allow", "14": "allow"}, {})
+        self.assertEqual(version + 1, self.rule_op.get_version())
+        self.assertTrue(self.rule_op.query_rule("120"))
@@ -0,0 +1,90 @@
+# -*- mode: Python; tab-width: 4; indent-tabs-mode: nil; -*-
+# ex: set tabstop=4 :
+# Please do not change the lines above. See PEP 8, PEP 263.
+""" Run the rule tests with the queries answered by a replica
+
+    Skipped unless REDIS_REPLICA_PORT names a replica of the redis at
+    REDIS_PORT, see test_replicas.sh.
+"""
+
+import os
+import unittest
+from uuid import uuid4
+
+import redis
+
+import redis_test
+from phone_rule_engine import RuleOperations
+from phone_rule_engine.replicas import ReplicaSet
+# imported as modules, so the tests don't run twice against a single redis
+import test_generic_rules
+import test_trial_rules
+
+REPLICA_PORT = os.environ.get("REDIS_REPLICA_PORT")
+
+
+@unittest.skipUnless(REPLICA_PORT, "REDIS_REPLICA_PORT not set")
+class ReplicaGiven(object):
+    """ Query a replica, waiting for it to catch up with the writes """
+
+    def setUp(self):
+        super(ReplicaGiven, self).setUp()
+        self.replica = redis.StrictRedis(host='localhost', port=REPLICA_PORT)
+        self.rule_op = RuleOperations(
+            self.redis, str(uuid4()), replicas=ReplicaSet([self.replica])
+        )
+
+    def expect_many(self, expected):
+        # the first step of expect
+        self.redis.execute_command("WAIT", 1, 1000)
+        super(ReplicaGiven, self).expect_many(expected)
+
+
+class ReplicaGenericTestCase(ReplicaGiven,
+                             test_generic_rules.NoCrosstalkTestCase):
+    pass
+
+
+class ReplicaOrgTestCase(ReplicaGiven,
+                         test_trial_rules.OrganisationSpecificTestCase):
+    pass
+
+
+class ReplicaRoutingTestCase(ReplicaGiven, redis_test.LuaTestCase):
+    """ Test which server answers the queries """
+
+    def evalsha_calls(self, client):
+        stats = client.info("commandstats")
+        return sum(
+            stats.get(command, {}).get("calls", 0)
+            for command in ("cmdstat_evalsha", "cmdstat_evalsha_ro")
+        )
+
+    def test_queries_on_replica(self):
+        self.given({"rules": {"12": "allow"}})
+        primary_calls = self.evalsha_calls(self.redis)
+        replica_calls = self.evalsha_calls(self.replica)
+        self.expect((
+            ("123", False, None, "allow"),
+            ("13", True, None, None),
+        ))
+        # one batch, then each expectation queried, traced and explained
+        self.assertEqual(7, self.evalsha_calls(self.replica) - replica_calls)
+        self.assertEqual(primary_calls, self.evalsha_calls(self.redis))
+
+    def test_counted_queries_on_primary(self):
+        self.given({"rules": {"12": "allow"}})
+        self.rule_op.stats_every = 1
+        self.expect((("123", False, None, "allow"), ))
+        self.assertEqual(
+            {"decision:generic:allow": 2}, self.rule_op.get_stats()
+        )
+
+    def test_fallback_to_primary(self):
+        down = redis.StrictRedis(host='localhost', port=1)
+        self.rule_op.replicas = ReplicaSet([down, self.replica])
+        self.given({"rules": {"12": "restrict"}})
+        self.expect((("123", False, None, "restrict"), ) * 3)
+        self.assertEqual([False, True], self.rule_op.replicas.check())
+        self.rule_op.replicas = ReplicaSet([down])
+        self.expect((("123", False, None, "restrict"), ))
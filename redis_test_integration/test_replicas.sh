@@ -0,0 +1,42 @@
+#!/bin/bash
+#
+# Bring up a redis primary and a replica of it in docker and run the replica
+# tests against them
+#
+set -e 
+
+cd "$(dirname "$(realpath "$0")")";
+
+source ../common.sh
+
+REDIS_PRIMARY_CONTAINER_NAME="${REDIS_TEST_CONTAINER_NAME}-primary"
+REDIS_REPLICA_CONTAINER_NAME="${REDIS_TEST_CONTAINER_NAME}-replica"
+REDIS_VERSION="6.2"
+export REDIS_PORT=6390
+export REDIS_REPLICA_PORT=6391
+
+if ! [ -d venv ] ; then 
+    echo "Creating virtual environment"
+    virtualenv --python=python3 venv
+fi
+
+echo "Install dependencies..."
+venv/bin/pip install -r requirements.txt --upgrade
+
+echo "Starting the primary and the replica in containers"
+docker rm -f $REDIS_PRIMARY_CONTAINER_NAME $REDIS_REPLICA_CONTAINER_NAME \
+    > /dev/null 2>&1 || true
+docker run -d --name $REDIS_PRIMARY_CONTAINER_NAME --net host \
+    redis:$REDIS_VERSION redis-server --port $REDIS_PORT > /dev/null
+docker run -d --name $REDIS_REPLICA_CONTAINER_NAME --net host \
+    redis:$REDIS_VERSION redis-server --port $REDIS_REPLICA_PORT \
+    --replicaof 127.0.0.1 $REDIS_PORT > /dev/null
+until docker exec $REDIS_REPLICA_CONTAINER_NAME \
+        redis-cli -p $REDIS_REPLICA_PORT info replication 2>/dev/null \
+        | grep -q 'master_link_status:up' ; do
+    sleep 1
+done
+
+echo
+export PYTHONPATH=`realpath $PWD/../`:$PYTHONPATH
+exec venv/bin/python -m unittest test_replicas
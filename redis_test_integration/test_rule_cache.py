@@ -0,0 +1,85 @@
+# -*- mode: Python; tab-width: 4; indent-tabs-mode: nil; -*-
+# ex: set tabstop=4 :
+# Please do not change the lines above. See PEP 8, PEP 263.
+""" Integration test for keeping local rule caches in sync trough pub/sub """
+import time
+import redis_test
+from phone_rule_engine.cache import RuleCache, DecisionCache
+
+
+class RuleCacheTestCase(redis_test.LuaTestCase):
+    """ Test that changes are propagated to subscribed caches """
+
+    def setUp(self):
+        super(RuleCacheTestCase, self).setUp()
+        self.cache = RuleCache(self.rule_op)
+        self.thread = self.cache.subscribe(sleep_time=0.001)
+
+    def tearDown(self):
+        self.thread.stop()
+
+    def wait_for_version(self, version):
+        deadline = time.time() + 5
+        while self.cache.version != version and time.time() < deadline:
+            time.sleep(0.001)
+        self.assertEqual(version, self.cache.version)
+
+    def test_changes_are_propagated(self):
+        """ Each tier is reloaded after a push """
+        self.assertIsNone(self.cache.query_rule("1234", True, self.test_org_id))
+        self.given({
+            "rules": {"12": "restrict"},
+        })
+        self.wait_for_version(1)
+        self.assertFalse(self.cache.query_rule("1234"))
+        self.given({
+            "rules:trial": {"123": "allow"},
+            "rules:org": {"1234": "restrict"},
+        })
+        self.wait_for_version(3)
+        self.assertTrue(self.cache.query_rule("1235", True))
+        self.assertFalse(
+            self.cache.query_rule("1234", True, self.test_org_id)
+        )
+        self.assertEqual(self.rule_op.get_version(), self.cache.version)
+
+
+class DecisionCacheTestCase(redis_test.LuaTestCase):
+    """ Test that cached decisions are dropped when the rules change """
+
+    def setUp(self):
+        super(DecisionCacheTestCase, self).setUp()
+        self.cache = DecisionCache(self.rule_op)
+        self.thread = self.cache.subscribe(sleep_time=0.001)
+
+    def tearDown(self):
+        self.thread.stop()
+
+    def wait_for_version(self, version):
+        deadline = time.time() + 5
+        while self.cache.version != version and time.time() < deadline:
+            time.sleep(0.001)
+        self.assertEqual(version, self.cache.version)
+
+    def test_plus_first(self):
+        """ A number asked with a plus first is restricted in both forms """
+        self.given({
+            "rules": {"407": "restrict"},
+        })
+        self.wait_for_version(1)
+        self.assertFalse(self.cache.query_rule("+4071"))
+        self.assertFalse(self.cache.query_rule("4071"))
+
+    def test_push_invalidates(self):
+        self.given({
+            "rules": {"12": "restrict"},
+        })
+        self.wait_for_version(1)
+        self.assertFalse(self.cache.query_rule("1234"))
+        self.assertFalse(self.cache.query_rule("+1234"))
+        self.assertEqual(1, self.cache.stats()["hits"])
+        self.given({
+            "rules": {"123": "allow"},
+        })
+        self.wait_for_version(2)
+        self.assertTrue(self.cache.query_rule("1234"))